@@ -0,0 +1,76 @@
+"""
+Record the shape of API traffic for replay.
+
+With TRAFFIC_CAPTURE set to a file, a sample of the API requests is appended
+to it, one JSON line each. A line holds when the request arrived, its
+method, the URL rule it matched (e.g. ``/api/v1/<task_uuid>/status``), the
+response status, how long the request took, and the sizes of the request
+and response bodies. Only these are recorded. URL values, headers, bodies
+and tokens are never written. The client is identified by a keyed hash of
+its token, so the traffic of one user can be told apart from another's
+without identifying them. Lines are short enough that the gunicorn workers
+can append to the same file. benchmarks/traffic_replay.py replays them.
+"""
+import os
+import json
+import time
+import hmac
+import random
+import hashlib
+
+from flask import g, request
+
+from config import TRAFFIC_CAPTURE, TRAFFIC_CAPTURE_SAMPLE, SECRET_KEY
+
+_file = None
+_pid = None
+
+
+def _client(headers):
+    token = headers.get('Authorization', '')
+    if not token:
+        return None
+    return hmac.new((SECRET_KEY or '').encode(), token.encode(), hashlib.sha256).hexdigest()[:16]
+
+
+def _write(line):
+    global _file, _pid
+    # Each worker opens the file itself after the fork
+    if _file is None or _pid != os.getpid():
+        _file = open(TRAFFIC_CAPTURE, 'a', buffering=1)
+        _pid = os.getpid()
+    _file.write(line)
+
+
+def start():
+    """Note the arrival of a request chosen for capture"""
+    if TRAFFIC_CAPTURE and random.random() < TRAFFIC_CAPTURE_SAMPLE:
+        g.capture_start = (time.time(), time.perf_counter())
+
+
+def record(response):
+    """Append a sanitized record of a captured request"""
+    started = g.pop('capture_start', None)
+    if started is None:
+        return response
+    # Capture must never change the response, so every failure is only logged
+    try:
+        rule = request.url_rule.rule if request.url_rule is not None else None
+        entry = {
+            'ts': round(started[0], 3),
+            'method': request.method,
+            'endpoint': rule,
+            'status': response.status_code,
+            'ms': round((time.perf_counter() - started[1]) * 1000, 2),
+            'request_bytes': request.content_length or 0,
+            'response_bytes': response.content_length if not response.is_streamed else None,
+            'client': _client(request.headers),
+        }
+        if rule and rule.endswith('/publish/bulk') and request.is_json:
+            body = request.get_json(silent=True)
+            servables = body.get('servables') if isinstance(body, dict) else None
+            entry['items'] = len(servables) if isinstance(servables, list) else 0
+        _write(json.dumps(entry) + '\n')
+    except Exception as e:
+        print('Traffic capture failed:', e)
+    return response
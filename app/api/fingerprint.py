@@ -0,0 +1,163 @@
+import os
+import json
+import hashlib
+
+from github_fetcher import parse_repository
+
+from . import queries
+from .utils import _aws_client, github
+
+# Metadata that changes on every publication and does not affect the built container
+_VOLATILE_DLHUB_FIELDS = ('owner', 'publication_date', 'user_id', 'shorthand_name', 'id', 'funcx_token',
+                          'transfer_method', 'build_location', 'ecr_uri', 'ecr_arn', 'funcx_id', 'identifier',
+                          'fingerprint', 'reuse')
+_VOLATILE_FIELDS = ('user_id', 'shorthand_name')
+
+
+def normalize_metadata(input_data):
+    """
+    Strip per-publication fields from a servable description.
+
+    :param input_data: servable description
+    :return: copy of the description that only holds what goes into the container
+    """
+    normalized = {k: v for k, v in input_data.items() if k not in _VOLATILE_FIELDS}
+    normalized['dlhub'] = {k: v for k, v in input_data.get('dlhub', {}).items()
+                           if k not in _VOLATILE_DLHUB_FIELDS}
+    return normalized
+
+
+def _hash_file(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(2 ** 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _hash_s3_prefix(location):
+    """Digest of the objects under an S3 prefix, from their keys, sizes and ETags"""
+    bucket = location.split("//")[1].split("/")[0]
+    prefix = location.split(bucket)[1][1:]
+    s3 = _aws_client('s3')
+    h = hashlib.sha256()
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        for obj in sorted(page.get('Contents', []), key=lambda o: o['Key']):
+            h.update("{}:{}:{};".format(obj['Key'][len(prefix):], obj['Size'], obj['ETag']).encode())
+    return h.hexdigest()
+
+
+def _repository_head(repository, ref=None):
+    """Commit sha a ref of a GitHub repository points to, by default its default branch"""
+    return github.get_head(parse_repository(repository), ref)
+
+
+def artifact_digest(input_data):
+    """
+    Digest of the files a servable is built from.
+
+    :param input_data: servable description
+    :return: digest, or None if the artifacts cannot be identified
+    """
+    try:
+        if 'repository' in input_data:
+            return 'git:' + _repository_head(input_data['repository'], input_data.get('ref'))
+        transfer = input_data['dlhub'].get('transfer_method', {})
+        if 'S3' in transfer:
+            return 's3:' + _hash_s3_prefix(transfer['S3'])
+        if 'path' in transfer and os.path.exists(transfer['path']):
+            return 'file:' + _hash_file(transfer['path'])
+    except Exception as e:
+        print('Failed to digest artifacts:', e)
+    return None
+
+
+def fingerprint_servable(input_data):
+    """
+    Fingerprint a publication from its owner, normalized metadata and artifact contents.
+
+    The owner is part of the fingerprint, so a build is only reused for
+    publications by the user who published it. Its funcX function and image
+    are registered under that user, and a protected servable's image must not
+    serve another user's publication.
+
+    :param input_data: servable description, with its owner stamped
+    :return: hex fingerprint, or None if the owner or the artifacts cannot be identified
+    """
+    owner = input_data.get('dlhub', {}).get('owner')
+    if not owner:
+        return None
+    digest = artifact_digest(input_data)
+    if digest is None:
+        return None
+    metadata = json.dumps(normalize_metadata(input_data), sort_keys=True, default=str)
+    return hashlib.sha256("{}\n{}\n{}".format(owner, digest, metadata).encode()).hexdigest()
+
+
+def find_fingerprint(cur, conn, fingerprint):
+    """
+    Look up an earlier build of an identical servable.
+
+    :param fingerprint: fingerprint of the publication
+    :return: dict with the servable_uuid, ecr_uri, ecr_arn and funcx_id to reuse, or None
+    """
+    if not fingerprint:
+        return None
+    try:
+        row = queries.fetchone(cur, 'find_fingerprint', fingerprint)
+        return dict(row) if row else None
+    except Exception as e:
+        print(e)
+        conn.rollback()
+        return None
+
+
+def build_record(output):
+    """
+    Get what to remember about the build a finished publication flow produced.
+
+    :param output: the flow's output, as a JSON string or dict
+    :return: parameters of the record_fingerprint statement, or None if there is nothing to record
+    """
+    if isinstance(output, str):
+        output = json.loads(output)
+    dlhub = (output or {}).get('dlhub', {})
+    if not dlhub.get('fingerprint') or not dlhub.get('funcx_id') or dlhub.get('reuse'):
+        return None
+    return dlhub['fingerprint'], dlhub['id'], dlhub.get('ecr_uri'), dlhub.get('ecr_arn'), dlhub['funcx_id']
+
+
+def record_fingerprint(cur, conn, output):
+    """
+    Remember the build produced by a finished publication flow.
+
+    :param output: the flow's output, as a JSON string or dict
+    :return:
+    """
+    try:
+        record = build_record(output)
+        if record is None:
+            return
+        queries.execute(cur, 'record_fingerprint', *record)
+        conn.commit()
+    except Exception as e:
+        print(e)
+        conn.rollback()
+
+
+def apply_fingerprint(cur, conn, input_data):
+    """
+    Fingerprint a publication and mark it to reuse an identical earlier build.
+
+    :param input_data: servable description, modified in place
+    :return: whether an earlier build will be reused
+    """
+    fingerprint = fingerprint_servable(input_data)
+    if not fingerprint:
+        return False
+    input_data['dlhub']['fingerprint'] = fingerprint
+    reuse = find_fingerprint(cur, conn, fingerprint)
+    if reuse:
+        input_data['dlhub']['reuse'] = reuse
+        return True
+    return False
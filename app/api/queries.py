@@ -0,0 +1,174 @@
+"""
+Named, server-side prepared statements for the API's queries.
+
+Each statement is prepared once per database session, the first time it is
+used, and then run with EXECUTE so Postgres reuses its plan. Parameters are
+always passed separately from the SQL. Every execution is counted and timed
+in ``stats``, and is also reported to any hooks added with ``add_hook``.
+"""
+import time
+import threading
+
+STATEMENTS = {
+    # Users
+    'user_by_name': "SELECT * from users where user_name = $1",
+    'create_user': "INSERT into users (user_name, globus_name, namespace, globus_uuid) values ($1, $2, $3, $4) "
+                   "RETURNING id",
+
+    # Servables
+    'latest_servable_by_name': "SELECT * from servables where dlhub_name = $1 order by id desc limit 1",
+    'ready_servables': "SELECT distinct on (dlhub_name) * from servables where status = 'READY' "
+                       "order by dlhub_name, id desc",
+    'servable_whitelisted': "SELECT 1 from servables, users, servable_whitelist where users.globus_name = $1 and "
+                            "users.id = servable_whitelist.user_id and servables.uuid = $2 and "
+                            "servables.id = servable_whitelist.servable_id limit 1",
+    'servable_by_uuid': "SELECT * from servables where uuid = $1",
+    'servable_by_author': "SELECT * from servables where uuid = $1 and author = $2",
+    'delete_servable': "UPDATE servables set status = 'DELETED' where uuid = $1",
+
+    # Tasks
+    'create_task': "INSERT INTO tasks (uuid, type, input, arn, status, result) values ($1, $2, $3, $4, 'RUNNING', $5)",
+    'latest_task': "SELECT t.arn, t.status, t.result, r.encoding, r.data, l.invocation "
+                   "FROM tasks t "
+                   "JOIN LATERAL (SELECT invocation FROM invocation_logs "
+                   "WHERE invocation_logs.task_uuid = t.uuid "
+                   "ORDER BY invocation DESC LIMIT 1) l ON true "
+                   "LEFT JOIN task_results r ON r.task_uuid = t.uuid "
+                   "WHERE t.uuid = $1",
+    'set_task_status': "UPDATE tasks set status = $2 where uuid = $1",
+    'set_task_result': "UPDATE tasks set result = $2, status = coalesce($3, status) where uuid = $1",
+    'store_task_result': "INSERT INTO task_results (task_uuid, encoding, data) values ($1, $2, $3) "
+                         "ON CONFLICT (task_uuid) DO UPDATE SET encoding = EXCLUDED.encoding, data = EXCLUDED.data",
+    'delete_task_result': "DELETE FROM task_results where task_uuid = $1",
+    'running_tasks': "SELECT t.type, t.arn, (SELECT min(invocation) FROM invocation_logs "
+                     "WHERE invocation_logs.task_uuid = t.uuid) AS submitted "
+                     "FROM tasks t WHERE t.status = 'RUNNING'",
+    'queued_backlog': "SELECT queued FROM tasks WHERE status = 'QUEUED'",
+    'queued_tasks': "SELECT uuid, owner, priority, queued, flow_arn, input FROM "
+                    "(SELECT uuid, owner, priority, queued, flow_arn, input, "
+                    "row_number() OVER (PARTITION BY owner ORDER BY priority, queued) AS n "
+                    "FROM tasks WHERE status = 'QUEUED') q WHERE n <= $1",
+    'scheduled_tasks': "SELECT uuid, owner, arn FROM tasks WHERE status = 'RUNNING' AND owner IS NOT NULL",
+    'start_queued_task': "UPDATE tasks set arn = $2, status = 'RUNNING' where uuid = $1 and status = 'QUEUED'",
+    'fail_queued_task': "UPDATE tasks set status = 'FAILED', result = $2 where uuid = $1 and status = 'QUEUED'",
+    'try_lock': "SELECT pg_try_advisory_xact_lock($1) AS locked",
+    'notify_scheduler': "SELECT pg_notify('dlhub_scheduler', '')",
+    'task_arrivals': "SELECT t.input, min(l.invocation) AS submitted FROM tasks t "
+                     "JOIN invocation_logs l ON l.task_uuid = t.uuid "
+                     "WHERE t.type = 'ingest' GROUP BY t.uuid, t.input "
+                     "HAVING min(l.invocation) >= $1 ORDER BY submitted",
+
+    # Publication fingerprints
+    'find_fingerprint': "SELECT servable_uuid, ecr_uri, ecr_arn, funcx_id from servable_fingerprints "
+                        "where fingerprint = $1",
+    'record_fingerprint': "INSERT INTO servable_fingerprints (fingerprint, servable_uuid, ecr_uri, ecr_arn, funcx_id) "
+                          "values ($1, $2, $3, $4, $5) ON CONFLICT (fingerprint) DO NOTHING",
+
+    # Web sessions
+    'load_session': "SELECT data from web_sessions where sid = $1 and expires > now()",
+    'save_session': "INSERT INTO web_sessions (sid, data, expires) values ($1, $2, $3) "
+                    "ON CONFLICT (sid) DO UPDATE SET data = EXCLUDED.data, expires = EXCLUDED.expires",
+    'delete_session': "DELETE FROM web_sessions where sid = $1",
+    'expire_sessions': "DELETE FROM web_sessions where expires <= now()",
+}
+
+# SQLSTATE of EXECUTE on a statement that is not prepared
+_INVALID_SQL_STATEMENT_NAME = '26000'
+
+# psycopg2.extensions.TRANSACTION_STATUS_IDLE, no transaction is open
+_TRANSACTION_IDLE = 0
+
+# Names of the statements prepared in each database session, by backend pid
+_prepared = {}
+_hooks = []
+_lock = threading.Lock()
+
+stats = {}
+
+
+def add_hook(hook):
+    """
+    Call a function after every query.
+
+    :param hook: called with the statement name, its duration in seconds and the row count
+    """
+    _hooks.append(hook)
+
+
+def remove_hook(hook):
+    """Stop calling a function added with add_hook"""
+    _hooks.remove(hook)
+
+
+def reset_stats():
+    """Clear the query counts and timings"""
+    with _lock:
+        stats.clear()
+
+
+def _prepare(cur, name):
+    session = cur.connection.get_backend_pid()
+    prepared = _prepared.setdefault(session, set())
+    if name not in prepared:
+        cur.execute("PREPARE {} AS {}".format(name, STATEMENTS[name]))
+        prepared.add(name)
+
+
+def execute(cur, name, *params):
+    """
+    Run a named statement.
+
+    If the statement started the transaction, the transaction is rolled back
+    when it fails, so the connection can still be used afterwards. A
+    transaction the caller already had open is left for the caller to roll
+    back, so its earlier work and locks are never discarded here.
+
+    :param cur: cursor to run it with
+    :param name: name of the statement in STATEMENTS
+    :param params: values for its parameters, in order
+    :return: the cursor
+    """
+    sql = "EXECUTE {}".format(name)
+    if params:
+        sql += " ({})".format(", ".join(["%s"] * len(params)))
+
+    start = time.perf_counter()
+    own_transaction = cur.connection.get_transaction_status() == _TRANSACTION_IDLE
+    try:
+        _prepare(cur, name)
+        try:
+            cur.execute(sql, params)
+        except Exception as e:
+            if getattr(e, 'pgcode', None) != _INVALID_SQL_STATEMENT_NAME:
+                raise
+            # The statement was deallocated since it was prepared. The others may still
+            # exist, and preparing them again would fail, so only this one is forgotten
+            _prepared.get(cur.connection.get_backend_pid(), set()).discard(name)
+            if not own_transaction:
+                raise
+            cur.connection.rollback()
+            _prepare(cur, name)
+            cur.execute(sql, params)
+    except Exception:
+        if own_transaction:
+            cur.connection.rollback()
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        with _lock:
+            entry = stats.setdefault(name, {'count': 0, 'seconds': 0.0})
+            entry['count'] += 1
+            entry['seconds'] += elapsed
+        for hook in _hooks:
+            hook(name, elapsed, cur.rowcount)
+    return cur
+
+
+def fetchone(cur, name, *params):
+    """Run a named statement and return its first row, or None"""
+    return execute(cur, name, *params).fetchone()
+
+
+def fetchall(cur, name, *params):
+    """Run a named statement and return all of its rows"""
+    return execute(cur, name, *params).fetchall()
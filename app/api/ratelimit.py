@@ -0,0 +1,147 @@
+"""
+Per-user token-bucket admission control for expensive endpoints.
+
+Each user has one bucket per endpoint group. A bucket holds up to ``burst``
+tokens and refills at ``rate`` tokens per second. A request is admitted
+while the bucket has tokens, and is otherwise rejected straight away with a
+429 and a Retry-After header giving the time until enough tokens are back.
+Requests that cost more than one token (e.g. bulk publication) are admitted
+once the bucket is full enough for them, and may leave it in debt. Buckets
+live in the worker process by default. With RATE_LIMIT_STORE set, all the
+workers on a host share them through a SQLite file.
+"""
+import math
+import time
+import sqlite3
+import threading
+
+from flask import abort, jsonify
+
+from config import RATE_LIMIT_STORE, RATE_LIMIT_ENABLED
+
+# Endpoint group: (tokens per second, burst)
+RATE_LIMITS = {
+    'publish': (0.5, 20),
+    'status': (5, 50),
+    'servables': (1, 10),
+    'signed_url': (2, 20),
+    'run': (5, 50),
+}
+
+
+def _refill(tokens, last, rate, burst, now):
+    return min(burst, tokens + (now - last) * rate)
+
+
+def _take(tokens, rate, burst, cost):
+    """Spend tokens from a refilled bucket
+
+    Returns:
+        (float, float): tokens left, and seconds to wait (0 if admitted)
+    """
+    if tokens >= min(cost, burst):
+        return tokens - cost, 0
+    return tokens, (min(cost, burst) - tokens) / rate
+
+
+class LocalStore:
+    """Buckets held in this process"""
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, cost, now):
+        with self._lock:
+            tokens, last = self._buckets.get(key, (burst, now))
+            tokens, wait = _take(_refill(tokens, last, rate, burst, now), rate, burst, cost)
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._prune(now)
+        return wait
+
+    def _prune(self, now):
+        # A bucket untouched for an hour is full again for any of the limits above
+        for key in [k for k, v in self._buckets.items() if now - v[1] > 3600]:
+            del self._buckets[key]
+
+
+class SQLiteStore:
+    """Buckets shared by the processes on a host through a SQLite file"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=1, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=OFF")
+            db.execute("CREATE TABLE IF NOT EXISTS buckets (key text PRIMARY KEY, tokens real, last real)")
+            self._local.db = db
+        return db
+
+    def take(self, key, rate, burst, cost, now):
+        db = self._connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute("SELECT tokens, last FROM buckets WHERE key = ?", (key,)).fetchone()
+            tokens, last = row if row else (burst, now)
+            tokens, wait = _take(_refill(tokens, last, rate, burst, now), rate, burst, cost)
+            db.execute("INSERT OR REPLACE INTO buckets (key, tokens, last) VALUES (?, ?, ?)", (key, tokens, now))
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        return wait
+
+
+class RateLimiter:
+    """Token buckets per user and endpoint group"""
+
+    def __init__(self, limits=RATE_LIMITS, store=None):
+        self.limits = limits
+        self.store = store or LocalStore()
+
+    def check(self, user, endpoint, cost=1):
+        """
+        Spend tokens for a request.
+
+        :param user: who is making the request
+        :param endpoint: endpoint group in limits
+        :param cost: number of tokens the request costs
+        :return: 0 if the request is admitted, otherwise seconds until it would be
+        """
+        if endpoint not in self.limits:
+            return 0
+        rate, burst = self.limits[endpoint]
+        try:
+            return self.store.take("{}:{}".format(endpoint, user), rate, burst, cost, time.time())
+        except Exception as e:
+            # Fail open, a broken store must not take the API down
+            print('Rate limit store error:', e)
+            return 0
+
+
+limiter = RateLimiter(store=SQLiteStore(RATE_LIMIT_STORE) if RATE_LIMIT_STORE else None)
+
+
+def admit(user, endpoint, cost=1):
+    """
+    Abort the request with a 429 if the user is over their budget for the endpoint.
+
+    :param user: name of the user, as returned by _get_user
+    :param endpoint: endpoint group in RATE_LIMITS
+    :param cost: number of tokens the request costs
+    """
+    if not RATE_LIMIT_ENABLED:
+        return
+    wait = limiter.check(user, endpoint, cost)
+    if wait > 0:
+        resp = jsonify({'status': 'FAILED', 'error': 'Rate limit exceeded, retry later.'})
+        resp.status_code = 429
+        resp.headers['Retry-After'] = str(max(1, math.ceil(wait)))
+        abort(resp)
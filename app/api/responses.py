@@ -0,0 +1,128 @@
+"""
+JSON encoding and compression of API responses.
+
+Responses are encoded with orjson when it is installed. orjson handles
+datetimes, UUIDs and numpy values natively, and anything else falls back to
+``str``. Without orjson the standard library encoder is used with
+``default=str``. The ``compress_response`` hook compresses responses larger
+than MIN_COMPRESS_BYTES with the best encoding the client accepts, preferring
+zstd, then brotli, then gzip. zstd and brotli are only offered when
+``zstandard`` and ``brotli`` are installed.
+"""
+import gzip
+import json
+
+from flask import Response, request
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MIN_COMPRESS_BYTES = 1024
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+ZSTD_LEVEL = 3
+
+_COMPRESSORS = {'gzip': lambda data: gzip.compress(data, compresslevel=GZIP_LEVEL)}
+if brotli is not None:
+    _COMPRESSORS['br'] = lambda data: brotli.compress(data, quality=BROTLI_QUALITY)
+if zstandard is not None:
+    _COMPRESSORS['zstd'] = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress
+
+# Server preference when the client accepts several equally
+_PREFERENCE = ('zstd', 'br', 'gzip')
+
+
+def dumps(obj):
+    """
+    Encode an object as JSON.
+
+    :param obj: object to encode
+    :return: UTF-8 encoded JSON
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, default=str, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(obj, default=str).encode()
+
+
+def json_response(obj, status=200):
+    """
+    Build a JSON response.
+
+    :param obj: body of the response
+    :param status: HTTP status code
+    :return: flask Response
+    """
+    return Response(dumps(obj), status=status, mimetype='application/json')
+
+
+def _accepted_encodings(header):
+    """Parse an Accept-Encoding header into {encoding: q}"""
+    accepted = {}
+    for part in header.split(','):
+        name, _, params = part.strip().partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if name:
+            accepted[name.strip().lower()] = q
+    return accepted
+
+
+def negotiate_encoding(header):
+    """
+    Choose a content encoding for a response.
+
+    :param header: the request's Accept-Encoding header
+    :return: name of the encoding, or None to send it uncompressed
+    """
+    accepted = _accepted_encodings(header or '')
+    wildcard = accepted.get('*', 0)
+    best, best_q = None, 0
+    for name in _PREFERENCE:
+        q = accepted.get(name, wildcard)
+        if name in _COMPRESSORS and q > best_q:
+            best, best_q = name, q
+    return best
+
+
+def compress_response(response):
+    """
+    Compress a response if it is large enough and the client accepts it.
+
+    Registered with ``after_request`` on the API blueprint.
+
+    :param response: the response to send
+    :return: the response, compressed in place when worthwhile
+    """
+    response.vary.add('Accept-Encoding')
+    if (response.direct_passthrough or 'Content-Encoding' in response.headers
+            or response.status_code < 200 or response.status_code in (204, 304)):
+        return response
+
+    data = response.get_data()
+    if len(data) < MIN_COMPRESS_BYTES:
+        return response
+
+    encoding = negotiate_encoding(request.headers.get('Accept-Encoding'))
+    if encoding is None:
+        return response
+
+    response.set_data(_COMPRESSORS[encoding](data))
+    response.headers['Content-Encoding'] = encoding
+    return response
@@ -0,0 +1,297 @@
+"""
+Fair-share scheduling of publication flows.
+
+Publications are queued in the tasks table with status QUEUED, along with
+their owner, priority class and flow. The dispatcher starts queued flows in
+this order:
+
+- by priority class, with production publications ahead of test ones
+  (``dlhub.test``);
+- within a class, the owner with the fewest builds running goes first, so a
+  bulk upload by one user does not hold up everyone else's publications;
+- within an owner, the oldest publication goes first.
+
+An owner never has more than PUBLISH_MAX_PER_USER builds running, and when
+PUBLISH_MAX_RUNNING is set no more than that many run in total.
+
+Publishing only queues the publication and nudges the scheduler loop
+(``python -m app.api.scheduler``) with a notification, so a request never
+waits on Step Functions. The loop dispatches when nudged, and at least every
+few seconds, and also notices finished builds. Finished builds are otherwise
+only seen when their owner checks the status. Loops on different hosts take
+turns through an advisory lock, and only the one holding it checks on
+running builds. Executions are named after
+their task, so a flow started by a dispatcher that failed before recording
+it is not started twice. A publication whose flow fails to start for a
+reason that may pass, such as throttling, stays queued and is tried again.
+"""
+import json
+import time
+import select
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from . import queries, task_store
+from config import PUBLISH_MAX_PER_USER, PUBLISH_MAX_RUNNING
+
+# Priority classes, lower goes first
+PRIORITIES = {'production': 0, 'test': 1}
+
+# Key of the advisory lock held while dispatching
+_DISPATCH_LOCK = 4470328
+
+# Channel of the 'notify_scheduler' statement, run when publications are queued
+NUDGE_CHANNEL = 'dlhub_scheduler'
+
+# Step Functions errors that starting the flow again will not fix
+_PERMANENT_START_ERRORS = ('InvalidArn', 'InvalidExecutionInput', 'InvalidName', 'StateMachineDeleting',
+                           'StateMachineDoesNotExist', 'ValidationException')
+
+
+def priority_of(input_data):
+    """Priority class of a publication"""
+    dlhub = input_data.get('dlhub', {}) if isinstance(input_data, dict) else {}
+    return PRIORITIES['test' if dlhub.get('test') else 'production']
+
+
+def owner_of(input_data):
+    """Namespace of the user publishing a servable"""
+    dlhub = input_data.get('dlhub', {}) if isinstance(input_data, dict) else {}
+    return dlhub.get('owner', '')
+
+
+def plan(queued, running, max_per_user=PUBLISH_MAX_PER_USER, max_running=PUBLISH_MAX_RUNNING):
+    """
+    Choose the queued publications to start now.
+
+    :param queued: dicts with the owner, priority and queued time of each queued publication
+    :param running: number of builds running per owner
+    :param max_per_user: most builds an owner may have running
+    :param max_running: most builds running in total, 0 for no limit
+    :return: the publications to start, in the order to start them
+    """
+    running = dict(running)
+    slots = max_running - sum(running.values()) if max_running else len(queued)
+    by_owner = {}
+    for task in sorted(queued, key=lambda t: (t['priority'], t['queued'])):
+        by_owner.setdefault(task['owner'], []).append(task)
+
+    picked = []
+    while slots > 0:
+        candidates = [(tasks[0]['priority'], running.get(owner, 0), tasks[0]['queued'], owner)
+                      for owner, tasks in by_owner.items() if tasks and running.get(owner, 0) < max_per_user]
+        if not candidates:
+            break
+        owner = min(candidates)[3]
+        picked.append(by_owner[owner].pop(0))
+        running[owner] = running.get(owner, 0) + 1
+        slots -= 1
+    return picked
+
+
+class FlowStarter:
+    """Starts and checks publication flows in AWS Step Functions"""
+
+    def start(self, flow_arn, input_data, name):
+        """
+        Start a flow.
+
+        :param name: name of the execution, the same name and input start it only once
+        :return: the start_execution response
+        """
+        from .utils import _start_execution
+        return _start_execution(flow_arn, input_data, name=name)
+
+    def describe(self, arn):
+        """The describe_execution response of an execution, with its status and, once finished, its output"""
+        from .utils import _aws_client
+        return _aws_client('stepfunctions').describe_execution(executionArn=arn)
+
+
+class FakeFlowStarter(FlowStarter):
+    """
+    Records flows instead of starting them, for trying out the scheduler.
+
+    Executions run until ``finish`` is called on them.
+    """
+
+    def __init__(self):
+        self.started = []
+        self.statuses = {}
+
+    def start(self, flow_arn, input_data, name):
+        arn = '{}:{}'.format(flow_arn.replace(':stateMachine:', ':execution:'), name)
+        if arn not in self.statuses:
+            self.started.append((arn, input_data))
+            self.statuses[arn] = 'RUNNING'
+        return {'executionArn': arn}
+
+    def describe(self, arn):
+        return {'status': self.statuses[arn]}
+
+    def finish(self, arn, status='SUCCEEDED'):
+        self.statuses[arn] = status
+
+
+def submit(cur, conn, flow_arn, inputs):
+    """
+    Queue publications for the scheduler loop to start.
+
+    :param flow_arn: ARN of the state machine
+    :param inputs: list of inputs, one per publication
+    :return: list of status dicts in the order of inputs
+    """
+    tasks = [(input_data, owner_of(input_data), priority_of(input_data)) for input_data in inputs]
+    task_uuids = task_store.queue_tasks(cur, conn, flow_arn, tasks)
+    if not task_uuids:
+        return [{"status": "FAILED", "error": "Could not queue the publication"} for _ in inputs]
+    return [{"status": "QUEUED", "task_id": task_uuid} for task_uuid in task_uuids]
+
+
+def _reconcile(cur, starter, running, max_workers=8):
+    """
+    Record the builds that finished since their owner last checked, and the fingerprints of those that succeeded.
+
+    :param running: tasks recorded as running
+    :return: the tasks that are still running
+    """
+    from .fingerprint import build_record
+
+    def describe(task):
+        try:
+            return starter.describe(task['arn'])
+        except Exception as e:
+            print('Could not check {}: {}'.format(task['arn'], e))
+            return {'status': 'RUNNING'}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        descriptions = list(pool.map(describe, running))
+
+    still_running = []
+    for task, description in zip(running, descriptions):
+        if description['status'] == 'RUNNING':
+            still_running.append(task)
+            continue
+        task_store.write_result(cur, task['uuid'], description.get('output') or '', description['status'])
+        if description['status'] == 'SUCCEEDED':
+            try:
+                record = build_record(description.get('output'))
+            except ValueError:
+                record = None
+            if record is not None:
+                queries.execute(cur, 'record_fingerprint', *record)
+    return still_running
+
+
+def _permanent(error):
+    """Whether a flow that failed to start with this error will never start"""
+    if isinstance(error, ValueError):
+        return True
+    code = getattr(error, 'response', {}).get('Error', {}).get('Code')
+    return code in _PERMANENT_START_ERRORS
+
+
+def dispatch(cur, conn, starter=None, reconcile=False, max_workers=8):
+    """
+    Start the queued publications the schedule allows.
+
+    Does nothing if another dispatcher is running.
+
+    :param starter: FlowStarter to start flows with
+    :param reconcile: first check whether running builds have finished
+    :param max_workers: flows started, or running builds checked, at once
+    :return: dict of the task uuids considered to their new status
+    """
+    starter = starter or FlowStarter()
+    try:
+        if not queries.fetchone(cur, 'try_lock', _DISPATCH_LOCK)['locked']:
+            conn.rollback()
+            return {}
+        scheduled = queries.fetchall(cur, 'scheduled_tasks')
+        if reconcile:
+            scheduled = _reconcile(cur, starter, scheduled, max_workers)
+        running = {}
+        for task in scheduled:
+            running[task['owner']] = running.get(task['owner'], 0) + 1
+        queued = queries.fetchall(cur, 'queued_tasks', PUBLISH_MAX_PER_USER)
+        picked = plan(queued, running)
+
+        def start(task):
+            input_data = json.loads(task['input']) if isinstance(task['input'], str) else task['input']
+            return starter.start(task['flow_arn'], input_data, task['uuid'])
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = [pool.submit(start, task) for task in picked]
+
+        started = {}
+        for task, future in zip(picked, futures):
+            try:
+                arn = future.result()['executionArn']
+            except Exception as e:
+                if not _permanent(e):
+                    print('Could not start {}, will retry: {}'.format(task['uuid'], e))
+                    started[task['uuid']] = 'QUEUED'
+                    continue
+                print('Could not start {}: {}'.format(task['uuid'], e))
+                queries.execute(cur, 'fail_queued_task', task['uuid'], str(e))
+                started[task['uuid']] = 'FAILED'
+                continue
+            queries.execute(cur, 'start_queued_task', task['uuid'], arn)
+            started[task['uuid']] = 'RUNNING'
+        # Releases the lock
+        conn.commit()
+        return started
+    except Exception as e:
+        print('Dispatch failed:', e)
+        conn.rollback()
+        return {}
+
+
+def _wait_for_nudge(conn, timeout):
+    """Wait until publications are queued, or for timeout seconds"""
+    if not conn.notifies:
+        select.select([conn], [], [], timeout)
+        conn.poll()
+    del conn.notifies[:]
+
+
+def run(interval=5, max_backoff=300):
+    """
+    Dispatch queued publications and reconcile finished builds forever.
+
+    Dispatches as soon as publications are queued, and otherwise every
+    interval seconds. The database connection is reopened if it fails,
+    waiting longer after each failure in a row.
+    """
+    from config import _get_db_connection
+    starter = FlowStarter()
+    db = None
+    backoff = interval
+    while True:
+        try:
+            if db is None or db[0].closed:
+                db = _get_db_connection()
+                db[1].execute("LISTEN {}".format(NUDGE_CHANNEL))
+                db[0].commit()
+            started = dispatch(db[1], db[0], starter, reconcile=True)
+            if started:
+                print('Started {} publications'.format(sum(status == 'RUNNING' for status in started.values())))
+            _wait_for_nudge(db[0], interval)
+        except Exception as e:
+            print('Scheduler failed, retrying in {:.0f}s: {}'.format(backoff, e))
+            if db is not None:
+                try:
+                    db[0].close()
+                except Exception:
+                    pass
+                db = None
+            time.sleep(backoff)
+            backoff = min(backoff * 2, max_backoff)
+            continue
+        backoff = interval
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Start queued publication flows")
+    parser.add_argument('--interval', type=float, default=5, help='most seconds between dispatches')
+    run(parser.parse_args().interval)
@@ -0,0 +1,122 @@
+import zlib
+import json
+import uuid
+
+from . import queries
+
+# Results larger than this are compressed into task_results instead of tasks.result
+RESULT_INLINE_BYTES = 64 * 1024
+
+
+def _arn(response):
+    return response.get('executionArn', '') if response else ''
+
+
+def create_task(cur, conn, input_data, response, task_uuid, task_type='ingest', result=''):
+    """
+    Insert a task into the database.
+
+    :param input_data: input of the task
+    :param response: response of starting its flow, if any
+    :param task_uuid: uuid of the task
+    :return:
+    """
+    try:
+        queries.execute(cur, 'create_task', task_uuid, task_type, json.dumps(input_data or []), _arn(response), result)
+        conn.commit()
+    except Exception as e:
+        print(e)
+        conn.rollback()
+    return {"status": "RUNNING", "task_id": task_uuid}
+
+
+def queue_tasks(cur, conn, flow_arn, tasks):
+    """
+    Insert publications waiting for the scheduler to start their flow, and nudge the scheduler loop.
+
+    :param flow_arn: ARN of the state machine to start
+    :param tasks: list of (input_data, owner, priority) tuples
+    :return: list of the new task uuids, or an empty list if they could not be inserted
+    """
+    if not tasks:
+        return []
+    task_uuids = [str(uuid.uuid4()) for _ in tasks]
+    rows = [(task_uuid, json.dumps(input_data or []), owner, priority, flow_arn)
+            for task_uuid, (input_data, owner, priority) in zip(task_uuids, tasks)]
+    import psycopg2.extras
+
+    try:
+        query = ("INSERT INTO tasks (uuid, type, input, arn, status, result, owner, priority, flow_arn, queued) "
+                 "values %s")
+        psycopg2.extras.execute_values(cur, query, rows,
+                                       template="(%s, 'ingest', %s, '', 'QUEUED', '', %s, %s, %s, now())")
+        # Wakes the scheduler loop once the publications are committed
+        queries.execute(cur, 'notify_scheduler')
+        conn.commit()
+    except Exception as e:
+        print(e)
+        conn.rollback()
+        return []
+    return task_uuids
+
+
+def _decode_result(encoding, data):
+    data = bytes(data)
+    if encoding == 'zlib':
+        data = zlib.decompress(data)
+    return data.decode()
+
+
+def get_latest(cur, task_uuid):
+    """
+    Get a task with its most recent invocation.
+
+    :param task_uuid: uuid of the task
+    :return: dict with arn, status, result and invocation, or None if the task has no invocations
+    """
+    row = queries.fetchone(cur, 'latest_task', task_uuid)
+    if row is None:
+        return None
+    result = row['result']
+    if row['data'] is not None:
+        result = _decode_result(row['encoding'], row['data'])
+    return {'arn': row['arn'], 'status': row['status'], 'result': result, 'invocation': row['invocation']}
+
+
+def set_status(cur, conn, task_uuid, status):
+    """Update the status of a task"""
+    queries.execute(cur, 'set_task_status', task_uuid, status)
+    conn.commit()
+
+
+def write_result(cur, task_uuid, result, status=None):
+    """
+    Store the result of a task in the current transaction, compressing large results into side storage.
+
+    :param task_uuid: uuid of the task
+    :param result: result as a string
+    :param status: new status of the task, if it changed
+    :return:
+    """
+    import psycopg2
+
+    data = result.encode()
+    if len(data) > RESULT_INLINE_BYTES:
+        queries.execute(cur, 'store_task_result', task_uuid, 'zlib', psycopg2.Binary(zlib.compress(data, 6)))
+        result = ''
+    else:
+        queries.execute(cur, 'delete_task_result', task_uuid)
+    queries.execute(cur, 'set_task_result', task_uuid, result, status)
+
+
+def set_result(cur, conn, task_uuid, result, status=None):
+    """
+    Store the result of a task and commit.
+
+    :param task_uuid: uuid of the task
+    :param result: result as a string
+    :param status: new status of the task, if it changed
+    :return:
+    """
+    write_result(cur, task_uuid, result, status)
+    conn.commit()
@@ -0,0 +1,93 @@
+import time
+import base64
+import hashlib
+import threading
+
+from config import _load_dlhub_client, SECRET_KEY
+
+FUNCX_SCOPE = 'https://auth.globus.org/scopes/facd7ccc-c5f4-42aa-916b-a0e270e2c2a9/all'
+
+
+class DependentTokenCache:
+    """
+    Cache of dependent tokens per user and scope.
+
+    Tokens are encrypted at rest in memory with a key derived from the app
+    secret. Each entry lives until the token expires or for at most ``ttl``
+    seconds. A token is refreshed when it is within ``refresh_margin``
+    seconds of expiring. The cached token keeps being used if that refresh
+    fails and the token is still valid.
+    """
+
+    def __init__(self, secret=SECRET_KEY, ttl=3600, refresh_margin=600, max_entries=10000):
+        self._key = base64.urlsafe_b64encode(hashlib.sha256((secret or '').encode()).digest())
+        self._cipher = None
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self.max_entries = max_entries
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    @property
+    def _fernet(self):
+        if self._cipher is None:
+            from cryptography.fernet import Fernet
+            self._cipher = Fernet(self._key)
+        return self._cipher
+
+    def get(self, user_id, scope, auth_token):
+        """
+        Get a dependent token for a user, asking GlobusAuth only when needed.
+
+        :param user_id: id of the user the token belongs to
+        :param scope: scope of the dependent token
+        :param auth_token: the user's access token to exchange if a new token is needed
+        :return: access token, or None if one could not be obtained
+        """
+        key = (user_id, scope)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+        cached = None
+        if entry and entry[1] > now:
+            try:
+                cached = self._fernet.decrypt(entry[0]).decode()
+            except Exception:
+                cached = None
+            if cached and entry[1] - now > self.refresh_margin:
+                return cached
+
+        try:
+            token, expires_at = self._fetch(scope, auth_token)
+        except Exception as e:
+            print('Failed to get dependent token:', e)
+            return cached
+
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                self._evict(now)
+            self._entries[key] = (self._fernet.encrypt(token.encode()), min(expires_at, now + self.ttl))
+        return token
+
+    def invalidate(self, user_id, scope=None):
+        """Forget a user's tokens, for one scope or all of them"""
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == user_id and (scope is None or k[1] == scope)]:
+                del self._entries[key]
+
+    def _evict(self, now):
+        """Drop expired entries, then the ones closest to expiring if still full"""
+        for key in [k for k, v in self._entries.items() if v[1] <= now]:
+            del self._entries[key]
+        while len(self._entries) >= self.max_entries:
+            del self._entries[min(self._entries, key=lambda k: self._entries[k][1])]
+
+    @staticmethod
+    def _fetch(scope, auth_token):
+        client = _load_dlhub_client()
+        auth_detail = client.oauth2_get_dependent_tokens(auth_token)
+        token = auth_detail.by_scopes[scope]
+        return token['access_token'], token['expires_at_seconds']
+
+
+dependent_tokens = DependentTokenCache()
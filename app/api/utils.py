@@ -1,11 +1,67 @@
-import base64
-import boto3
 import uuid
 import json
+import os
 
-from config import _load_dlhub_client, GIT_TOKEN
+from config import _load_dlhub_client, _get_db_connection, GIT_TOKEN, BROKER_FRONTEND
 from flask import request
-from github import Github
+from github_fetcher import GitHubFetcher, parse_repository
+
+from . import queries, scheduler, task_store
+
+_aws_clients = {}
+_broker_client = None
+_reply_db = None
+
+# Shared GitHub client, caches responses by ETag across requests
+github = GitHubFetcher(GIT_TOKEN)
+
+
+def _aws_client(service):
+    """Get this process's boto3 client for an AWS service
+
+    boto3 is imported and the client created on first use, so importing the
+    API stays fast. boto3 clients are thread-safe and are shared.
+
+    :param service: name of the service, e.g. 's3'
+    :return: the client
+    """
+    key = (service, os.getpid())
+    if key not in _aws_clients:
+        import boto3
+        _aws_clients[key] = boto3.client(service)
+    return _aws_clients[key]
+
+
+def _get_broker_client():
+    """Get the client for the host's broker sidecar. Its socket and thread start after fork, on first use"""
+    global _broker_client
+    if _broker_client is None:
+        from zmq_broker import BrokerClient
+        _broker_client = BrokerClient(BROKER_FRONTEND, _store_run_reply)
+    return _broker_client
+
+
+def _store_run_reply(request_id, status, frames):
+    """
+    Store the broker's reply to a run as the result of its task.
+
+    Runs on the broker client's thread, so it uses a database connection of its own.
+
+    :param request_id: uuid of the task, as bytes
+    :param status: OK or ERROR status frame
+    :param frames: reply frames, the result or error message first
+    """
+    global _reply_db
+    if _reply_db is None or _reply_db[0].closed:
+        _reply_db = _get_db_connection()
+    conn, cur = _reply_db
+    result = frames[0].decode() if frames else ''
+    try:
+        task_store.set_result(cur, conn, request_id.decode(), result,
+                              'COMPLETED' if status == b'OK' else 'FAILED')
+    except Exception as e:
+        print(e)
+        conn.rollback()
 
 
 def create_presigned_post(bucket_name, object_name,
@@ -24,7 +80,7 @@ def create_presigned_post(bucket_name, object_name,
     """
 
     # Generate a presigned S3 POST URL
-    s3_client = boto3.client('s3')
+    s3_client = _aws_client('s3')
     try:
         response = s3_client.generate_presigned_post(bucket_name,
                                                      object_name,
@@ -39,44 +95,81 @@ def create_presigned_post(bucket_name, object_name,
     return response
 
 
-def _start_flow(cur, conn, flow_arn, input_data):
+def create_presigned_url(bucket_name, object_name, client_method='get_object', expiration=3600):
+    """Generate a presigned URL to GET or PUT an S3 object
+
+    :param bucket_name: string
+    :param object_name: string
+    :param client_method: S3 method to sign, 'get_object' or 'put_object'
+    :param expiration: Time in seconds for the presigned URL to remain valid
+    :return: URL as string
+    :return: None if error.
+    """
+    s3_client = _aws_client('s3')
+    try:
+        response = s3_client.generate_presigned_url(client_method,
+                                                    Params={'Bucket': bucket_name, 'Key': object_name},
+                                                    ExpiresIn=expiration)
+    except Exception as e:
+        print(e)
+        return None
+    return response
+
+
+def _start_execution(flow_arn, input_data, sfn_client=None, name=None):
     """
-    Start an AWS SFN flow.
+    Start an execution of an AWS SFN flow without recording a task.
 
-    :return:
+    :param flow_arn: ARN of the state machine
+    :param input_data: input to the execution
+    :param sfn_client: Step Functions client to reuse, or None to create one
+    :param name: name of the execution, or None for a random one
+    :return: the start_execution response
     """
-    sfn_client = boto3.client('stepfunctions')
-    task_uuid = str(uuid.uuid4())
-    response = sfn_client.start_execution(
+    if sfn_client is None:
+        sfn_client = _aws_client('stepfunctions')
+    return sfn_client.start_execution(
         stateMachineArn=flow_arn,
-        name=str(uuid.uuid4()),
+        name=name or str(uuid.uuid4()),
         input=json.dumps(input_data)
     )
-    res = _create_task(cur, conn, input_data, response, task_uuid)
-    return res
 
 
-def _get_dlhub_file_from_github(repository):
+def _start_flow(cur, conn, flow_arn, input_data):
+    """
+    Queue an AWS SFN flow with the publication scheduler.
+
+    :return: status dict, QUEUED once the scheduler has the publication
+    """
+    return scheduler.submit(cur, conn, flow_arn, [input_data])[0]
+
+
+def _start_flows(cur, conn, flow_arn, inputs):
+    """
+    Queue many AWS SFN flows with the publication scheduler.
+
+    :param flow_arn: ARN of the state machine
+    :param inputs: list of inputs, one per execution
+    :return: list of status dicts in the order of inputs
+    """
+    return scheduler.submit(cur, conn, flow_arn, inputs)
+
+
+def _get_dlhub_file_from_github(repository, ref=None):
     """
     Use the github rest api to ensure the app.json file exists.
 
     :param repository:
+    :param ref: branch, tag or commit to read it from, defaults to the default branch
     :return:
     """
 
-    if 'github.com' not in repository:
+    repo = parse_repository(repository)
+    if repo is None:
         return None
 
-    repo = repository.replace("https://github.com/", "")
-    repo = repo.replace(".git", "")
-
     try:
-        g = Github(GIT_TOKEN)
-        r = g.get_repo(repo)
-        contents = r.get_contents("dlhub.json")
-        decoded = base64.b64decode(contents.content)
-
-        return json.loads(decoded)
+        return github.get_json(repo, "dlhub.json", ref)
     except Exception as e:
         print(e)
         return None
@@ -85,31 +178,6 @@ def _get_dlhub_file_from_github(repository):
 ############
 # Database #
 ############
-def _create_task(cur, conn, input_data, response, task_uuid, task_type='ingest', result=''):
-    """
-    Insert a task into the database.
-
-    :param input_data:
-    :param response:
-    :param task_uuid:
-    :return:
-    """
-    try:
-        arn_val = ''
-        if response:
-            if 'executionArn' in response:
-                arn_val = response['executionArn']
-        if not input_data:
-            input_data = []
-        query = "INSERT INTO tasks (uuid, type, input, arn, status, result) values (%s, %s, %s, %s, 'RUNNING', %s)"
-        cur.execute(query, (task_uuid, task_type, json.dumps(input_data), arn_val, result))
-        conn.commit()
-    except Exception as e:
-        print(e)
-    res = {"status": "RUNNING", "task_id": task_uuid}
-    return res
-
-
 def _introspect_token(headers):
     """
     Decode the token and retrieve the user's details
@@ -140,14 +208,9 @@ def _resolve_namespace_model(cur, conn, namespace, model_name):
     """
     servable_uuid = None
     try:
-        command = (
-            "SELECT * from servables where dlhub_name = '{}/{}' order by id desc limit 1".format(namespace, model_name))
-        print(command)
-        cur.execute(command)
-        rows = cur.fetchall()
-        if len(rows) > 0:
-            for r in rows:
-                servable_uuid = r['uuid']
+        row = queries.fetchone(cur, 'latest_servable_by_name', "{}/{}".format(namespace, model_name))
+        if row:
+            servable_uuid = row['uuid']
     except Exception as e:
         print(e)
     return servable_uuid
@@ -161,7 +224,7 @@ def _get_user(cur, conn, headers):
     :return:
     """
 
-    user_name, user_id = _introspect_token(headers)
+    user_name, globus_uuid = _introspect_token(headers)
     short_name = None
     user_id = None
 
@@ -171,8 +234,7 @@ def _get_user(cur, conn, headers):
 
     # Now check if it is in the database.
     try:
-        cur.execute("SELECT * from users where user_name = '%s'" % user_name)
-        rows = cur.fetchall()
+        rows = queries.fetchall(cur, 'user_by_name', user_name)
         if len(rows) > 0:
             for r in rows:
                 short_name = r['namespace']
@@ -180,12 +242,8 @@ def _get_user(cur, conn, headers):
         else:
             short_name = "{name}_{org}".format(name=user_name.split(
                 "@")[0], org=user_name.split("@")[1].split(".")[0])
-            cmd = "INSERT into users (user_name, globus_name, namespace, globus_uuid) values "\
-                  "('{name}', '{globus}', '{short}', '{globus_uuid}') RETURNING id".format(
-                      name=user_name, globus=user_name, short=short_name, globus_uuid=user_id)
-            cur.execute(cmd)
+            user_id = queries.fetchone(cur, 'create_user', user_name, user_name, short_name, globus_uuid)['id']
             conn.commit()
-            user_id = cur.fetchone()[0]
     except Exception as e:
         print(e)
     return user_id, user_name, short_name
@@ -1,20 +1,33 @@
-import boto3
 import json
 import uuid
 import time
 import os
-from config import _load_dlhub_client
-from .utils import (_get_user, _start_flow, _resolve_namespace_model, _get_dlhub_file_from_github,
-                    create_presigned_post)
+from . import queries, task_store, capture
+from .ratelimit import admit
+from .responses import compress_response, json_response
+from .fingerprint import apply_fingerprint, record_fingerprint
+from .tokens import dependent_tokens, FUNCX_SCOPE
+from .utils import (_aws_client, _get_user, _start_flow, _start_flows, _resolve_namespace_model,
+                    _get_broker_client, _get_dlhub_file_from_github, create_presigned_post, create_presigned_url)
 from flask import Blueprint, request, abort, jsonify
+from dlhub_payload import CONTENT_TYPE
+from github_fetcher import is_valid_ref
 from werkzeug.utils import secure_filename
 
-from config import (_get_db_connection, PUBLISH_FLOW_ARN, PUBLISH_REPO_FLOW_ARN)
+from config import (_lazy_db_connection, PUBLISH_FLOW_ARN, PUBLISH_REPO_FLOW_ARN)
 
-conn, cur = _get_db_connection()
+# Connects on first use, in each worker process
+conn, cur = _lazy_db_connection()
+
+# Limits for bulk publication
+MAX_BULK_PUBLISH = 100
 
 # Flask
 api = Blueprint("api", __name__)
+# after_request functions run last-registered first, so captures see the compressed size
+api.before_request(capture.start)
+api.after_request(capture.record)
+api.after_request(compress_response)
 
 ########################
 # SERVABLE PUBLICATION #
@@ -32,6 +45,7 @@ def publish_servables():
     user_id, user_name, short_name = _get_user(cur, conn, request.headers)
     if not user_name:
         abort(400, description="Error: You must be logged in to perform this function.")
+    admit(user_name, 'publish')
 
     # Get the servable data
     input_data = None
@@ -51,19 +65,125 @@ def publish_servables():
     if not input_data:
         abort(400, description="Failed to load app.json input data")
 
-    # Get a dependent token for funcX
-    if 'Authorization' in request.headers:
-        token = request.headers.get('Authorization')
+    shorthand_name = _stamp_servable(input_data, user_id, short_name)
 
-        token = token.split(" ")[1]
-        try:
-            client = _load_dlhub_client()
-            auth_detail = client.oauth2_get_dependent_tokens(token)
-            fx_auth = auth_detail.by_scopes['https://auth.globus.org/scopes/facd7ccc-c5f4-42aa-916b-a0e270e2c2a9/all']
-            input_data['dlhub']['funcx_token'] = fx_auth['access_token']
-        except Exception as e:
-            print(e)
-    # Insert owner name and time-stamp into metadata
+    # Reuse the container and function of an identical earlier publication
+    reused = _reuse_identical_build(input_data)
+
+    # Get a dependent token for funcX, which the flow uses to register the servable
+    if not reused and 'Authorization' in request.headers:
+        token = request.headers.get('Authorization').split(" ")[1]
+        fx_token = dependent_tokens.get(user_id, FUNCX_SCOPE, token)
+        if fx_token:
+            input_data['dlhub']['funcx_token'] = fx_token
+
+    # Start publication flow
+    flow_arn = PUBLISH_FLOW_ARN
+    res = _start_flow(cur, conn, flow_arn, input_data)
+    res['servable'] = shorthand_name
+
+    return json_response(res)
+
+
+@api.route("/publish/bulk", methods=['post'])
+def publish_servables_bulk():
+    """Publish many servables with one POST request
+
+    The body is ``{"servables": [...]}`` with one servable description per
+    item. Every item is validated before any flow is started. Files must
+    already be staged, e.g. with /publish/signed_url.
+
+    Returns:
+        (str): JSON-encoded list of status information, in the order submitted
+    """
+
+    # Check the user credentials
+    user_id, user_name, short_name = _get_user(cur, conn, request.headers)
+    if not user_name:
+        abort(400, description="Error: You must be logged in to perform this function.")
+
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get('servables'), list):
+        abort(400, description="Error: Requires JSON input with a list of servables.")
+    servables = body['servables']
+    if len(servables) > MAX_BULK_PUBLISH:
+        abort(400, description="Error: At most {} servables can be published at once.".format(MAX_BULK_PUBLISH))
+    admit(user_name, 'publish', cost=len(servables))
+
+    # Validate every submission before starting anything
+    errors = {}
+    for i, input_data in enumerate(servables):
+        error = _validate_servable(input_data)
+        if error:
+            errors[i] = error
+    if errors:
+        return json_response({'status': 'FAILED', 'errors': errors}, 400)
+
+    shorthand_names = [_stamp_servable(input_data, user_id, short_name) for input_data in servables]
+    builds = [input_data for input_data in servables if not _reuse_identical_build(input_data)]
+
+    # One dependent token covers every publication that needs a build
+    if builds:
+        token = request.headers.get('Authorization').split(" ")[1]
+        fx_token = dependent_tokens.get(user_id, FUNCX_SCOPE, token)
+        if fx_token:
+            for input_data in builds:
+                input_data['dlhub']['funcx_token'] = fx_token
+
+    # Start publication flows
+    res = _start_flows(cur, conn, PUBLISH_FLOW_ARN, servables)
+    for item, shorthand_name in zip(res, shorthand_names):
+        item['servable'] = shorthand_name
+    return json_response(res)
+
+
+def _validate_servable(input_data):
+    """Check a servable description has what the publication flow needs
+
+    Args:
+        input_data (dict): Servable description
+    Returns:
+        (str): Description of the problem, or None if it is valid
+    """
+    if not isinstance(input_data, dict) or not isinstance(input_data.get('dlhub'), dict):
+        return "Missing 'dlhub' metadata"
+    if not isinstance(input_data['dlhub'].get('name'), str) or not input_data['dlhub']['name']:
+        return "Missing 'dlhub.name'"
+    if not isinstance(input_data['dlhub'].get('transfer_method'), dict):
+        return "Missing 'dlhub.transfer_method'"
+    return None
+
+
+def _reuse_identical_build(input_data):
+    """Fingerprint a publication and, if an identical one was built before, reuse that build
+
+    Args:
+        input_data (dict): Servable description, modified in place
+    Returns:
+        (bool): Whether the earlier build will be reused
+    """
+    if not apply_fingerprint(cur, conn, input_data):
+        return False
+    print('Reusing build of {} for {}'.format(input_data['dlhub']['reuse']['servable_uuid'],
+                                              input_data['dlhub'].get('shorthand_name')))
+
+    # The uploaded files are not needed when nothing is built
+    path = input_data['dlhub'].get('transfer_method', {}).get('path', '')
+    if path.startswith('/mnt/tmp/') and os.path.exists(path):
+        os.remove(path)
+    return True
+
+
+def _stamp_servable(input_data, user_id, short_name):
+    """Insert owner name, time-stamp and model shortname into the metadata
+
+    Args:
+        input_data (dict): Servable description, modified in place
+        user_id (int): Id of the publishing user
+        short_name (str): Namespace of the publishing user
+    Returns:
+        (str): Shorthand name of the servable
+    """
     input_data['dlhub']['owner'] = short_name
     input_data['dlhub']['publication_date'] = int(round(time.time() * 1000))
     input_data['dlhub']['user_id'] = user_id
@@ -72,13 +192,7 @@ def publish_servables():
     model_name = input_data['dlhub']['name']
     shorthand_name = "{name}/{model}".format(name=short_name, model=model_name.replace(" ", "_"))
     input_data['dlhub']['shorthand_name'] = shorthand_name
-
-    # Start publication flow
-    flow_arn = PUBLISH_FLOW_ARN
-    res = _start_flow(cur, conn, flow_arn, input_data)
-    res['servable'] = shorthand_name
-
-    return json.dumps(res)
+    return shorthand_name
 
 
 @api.route("/publish/signed_url", methods=['GET'])
@@ -111,6 +225,92 @@ def get_signed_url():
     return jsonify(response), final_http_status
 
 
+@api.route("/run/signed_url", methods=['GET'])
+def get_run_signed_url():
+    """Get a signed URL for S3 to stage a large servable input out-of-band
+    of the run request.
+
+    The returned reference is passed in place of the data in the run inputs,
+    and workers download the object themselves. The returned result upload
+    is passed as ``result_upload`` in the run request, and workers upload
+    results too large to return inline to it.
+
+    Returns:
+        str: JSON-encoded signed url, the reference to the uploaded object and the result upload
+    """
+    user_id, user_name, short_name = _get_user(cur, conn, request.headers)
+    if not user_name:
+        abort(400, description="Error: You must be logged in to perform this function.")
+    admit(user_name, 'signed_url')
+
+    objname = "run_inputs/" + str(uuid.uuid4())
+    signed_url = create_presigned_post('dlhub-anl', object_name=objname)
+    get_url = create_presigned_url('dlhub-anl', objname, expiration=86400)
+    result_name = "run_results/" + str(uuid.uuid4())
+    result_put_url = create_presigned_url('dlhub-anl', result_name, client_method='put_object', expiration=86400)
+    result_get_url = create_presigned_url('dlhub-anl', result_name, expiration=86400)
+
+    response = {'status': 'COMPLETED'}
+    final_http_status = 200
+    try:
+        response['url'] = signed_url['url']
+        response['fields'] = signed_url['fields']
+        response['reference'] = {'__dlhub_ref__': get_url}
+        if not (get_url and result_put_url and result_get_url):
+            raise ValueError('Could not sign the staging URLs')
+        response['result_upload'] = {'put_url': result_put_url, 'get_url': result_get_url}
+    except Exception as e:
+        # Failed to create a signed URL
+        print(e)
+        response = {'status': 'FAILED'}
+        final_http_status = 500
+
+    return jsonify(response), final_http_status
+
+
+@api.route("/servables/<servable_namespace>/<servable_name>/run", methods=['POST'])
+def run_servable(servable_namespace, servable_name):
+    """
+    Run a servable on a compute worker through the host's broker.
+
+    The request is handed to the broker without waiting for the worker, and
+    the reply is stored as the task's result. Poll /<task_uuid>/status for it.
+
+    :param servable_namespace: namespace of the servable
+    :param servable_name: name of the servable
+    :return: the task id
+    """
+    user_id, user_name, short_name = _get_user(cur, conn, request.headers)
+    if not user_name:
+        abort(400, description="Error: You must be logged in to perform this function.")
+    admit(user_name, 'run')
+
+    # Binary payloads are passed through to the worker as they are
+    if request.mimetype == CONTENT_TYPE:
+        input_data, payload = None, request.get_data()
+    else:
+        input_data = request.get_json(silent=True)
+        if not isinstance(input_data, dict):
+            abort(400, description="Error: Requires JSON input with the servable inputs.")
+        payload = json.dumps(input_data).encode()
+
+    servable = queries.fetchone(cur, 'latest_servable_by_name', "{}/{}".format(servable_namespace, servable_name))
+    if not servable:
+        abort(404, description="Error: No servable named {}/{}.".format(servable_namespace, servable_name))
+    if servable['protected'] and not queries.fetchone(cur, 'servable_whitelisted', user_name, servable['uuid']):
+        abort(403, description="Error: You are not allowed to run this servable.")
+
+    task_uuid = str(uuid.uuid4())
+    res = task_store.create_task(cur, conn, input_data, None, task_uuid, task_type='run')
+    try:
+        _get_broker_client().submit(servable['uuid'], [payload], request_id=task_uuid.encode())
+    except Exception as e:
+        print(e)
+        task_store.set_result(cur, conn, task_uuid, 'Broker is not accepting requests', 'FAILED')
+        return json_response({'status': 'FAILED', 'task_id': task_uuid}, status=503)
+    return json_response(res, status=202)
+
+
 @api.route("/publish_repo", methods=['post'])
 def publish_repo_servables():
     """Publish a servable via repo2docker
@@ -123,10 +323,13 @@ def publish_repo_servables():
     user_id, user_name, short_name = _get_user(cur, conn, request.headers)
     if not user_name:
         abort(400, description="Error: You must be logged in to perform this function.")
+    admit(user_name, 'publish')
 
     # Verify format of request
     if not request.json:
         abort(400, description="Error: Requires JSON input.")
+    if request.json.get('ref') is not None and not is_valid_ref(request.json['ref']):
+        abort(400, description="Error: 'ref' must be a branch, tag or commit name.")
 
     # Generate the owner
     input_data = request.json
@@ -137,15 +340,16 @@ def publish_repo_servables():
     input_data['user_id'] = user_id
 
     # Make name from repository ID
-    model_name = _get_dlhub_file_from_github(input_data['repository'])['dlhub']['name']
+    model_name = _get_dlhub_file_from_github(input_data['repository'], input_data.get('ref'))['dlhub']['name']
     shorthand_name = "{name}/{model}".format(name=short_name, model=model_name.replace(" ", "_"))
     input_data['shorthand_name'] = shorthand_name
+    _reuse_identical_build(input_data)
 
     # Start publication flow
     flow_arn = PUBLISH_REPO_FLOW_ARN
     res = _start_flow(cur, conn, flow_arn, input_data)
     res['servable'] = shorthand_name
-    return json.dumps(res)
+    return json_response(res)
 
 
 ###################
@@ -168,49 +372,52 @@ def status(task_uuid):
     user_id, user_name, short_name = _get_user(cur, conn, request.headers)
     if not user_name:
         abort(400, description="Error: You must be logged in to perform this function.")
+    admit(user_name, 'status')
 
     # Run the check
     try:
         exec_arn = None
         status = None
+        previous = None
         result = ''
         invocation_time = None
 
-        # Find the status ID from the database
-        cur.execute("SELECT * from tasks, invocation_logs where tasks.uuid = '%s' and tasks.uuid = invocation_logs.task_uuid" % task_uuid)
-        rows = cur.fetchall()
-
-        # Get the most-recent status message
-        for r in rows:
-            exec_arn = r['arn']
-            status = r['status']
-            result = r['result']
-            invocation_time = r['invocation']
+        # Find the task and its most recent invocation
+        task = task_store.get_latest(cur, task_uuid)
+        if task:
+            exec_arn = task['arn']
+            status = previous = task['status']
+            result = task['result']
+            invocation_time = task['invocation']
         res = {'status': status, 'invocation_time': invocation_time}
 
         # If the task is using AWS step functions, check the status there
         # TODO (lw): I'm not sure what this does
         if exec_arn:
             # Check sfn for status
-            sfn_client = boto3.client('stepfunctions')
+            sfn_client = _aws_client('stepfunctions')
             response = sfn_client.describe_execution(executionArn=exec_arn)
             status = response['status']
             res['status'] = status
-            if 'output' in response:
-                output = response['output']
+            output = response.get('output')
+            if output is not None:
                 res['output'] = output
 
-            # Update thes tatus in the database
-            query = "UPDATE tasks set status = '%s' where uuid = '%s'" % (status, task_uuid)
-            cur.execute(query)
-            conn.commit()
+            # Store the outcome once, when the flow is first seen to finish
+            if status != previous:
+                if status == 'RUNNING':
+                    task_store.set_status(cur, conn, task_uuid, status)
+                else:
+                    task_store.set_result(cur, conn, task_uuid, output or '', status)
+                if status == 'SUCCEEDED':
+                    record_fingerprint(cur, conn, output)
         # Otherwise, this is an async request
         else:
             res = {'status': status, 'result': result, 'invocation_time': invocation_time}
-        return json.dumps(res, default=str)
+        return json_response(res)
     except Exception as e:
         print(e)
-        return json.dumps({'InternalError': e})
+        return json_response({'InternalError': e})
 
 
 @api.route("/servables", methods=['GET'])
@@ -225,29 +432,23 @@ def api_servables():
     if not user_name:
         print('Aborting.')
         abort(400, description="Error: You must be logged in to perform this function.")
+    admit(user_name, 'servables')
 
     try:
-        query = "SELECT distinct on (dlhub_name) * from servables where status = 'READY' order by dlhub_name, id desc"
-        cur.execute(query)
-        rows = cur.fetchall()
+        rows = queries.fetchall(cur, 'ready_servables')
         res = []
         for r in rows:
             if r['protected']:
                 if not user_name:
                     continue
-                query = "SELECT * from servables, users, servable_whitelist where users.globus_name = '%s' and " \
-                        "users.id = servable_whitelist.user_id and servables.uuid = '%s' and servables.id = " \
-                        "servable_whitelist.servable_id" % (user_name, r['uuid'])
-                cur.execute(query)
-                prot_rows = cur.fetchall()
-                if len(prot_rows) > 0:
+                if queries.fetchone(cur, 'servable_whitelisted', user_name, r['uuid']):
                     res.append(r)
                 continue
             res.append(r)
-        return json.dumps(res, default=str)
+        return json_response(res)
     except Exception as e:
         print(e)
-        return json.dumps({"InternalError": e})
+        return json_response({"InternalError": e})
 
 
 # TODO (LW): Should we change this to the namespace format?
@@ -268,19 +469,18 @@ def api_servable_status(servable_uuid):
     # Get the status of the servable from the database
     status = {}
     try:
-        cur.execute("SELECT * from servables where uuid = '%s'" % servable_uuid)
-        rows = cur.fetchall()
+        rows = queries.fetchall(cur, 'servable_by_uuid', servable_uuid)
 
         # Get the most recent status
         for r in rows:
             status = {'status': r['status']}
     except Exception as e:
         print(e)
-        return json.dumps({"InternalError": e})
+        return json_response({"InternalError": e})
 
     print(status)
 
-    return json.dumps(status)
+    return json_response(status)
 
 
 @api.route("/namespaces", methods=['GET'])
@@ -295,7 +495,7 @@ def get_namespaces():
     if not user_name:
         abort(400, description="Error: You must be logged in to perform this function.")
     res = {'namespace': short_name}
-    return json.dumps(res)
+    return json_response(res)
 
 
 @api.route("/servables/<servable_namespace>/<servable_name>", methods=['DELETE'])
@@ -313,18 +513,19 @@ def api_delete_servable(servable_namespace, servable_name):
 
     servable_uuid = _resolve_namespace_model(cur, conn, servable_namespace, servable_name)
 
-    query = "select * from servables here uuid = '{0}' and author = '{1}'".format(servable_uuid, user_id)
-    cur.execute(query)
-    rows = cur.fetchall()
+    try:
+        rows = queries.fetchall(cur, 'servable_by_author', servable_uuid, user_id)
+    except Exception as e:
+        print(e)
+        return json_response({"InternalError": e})
     if len(rows) == 0:
-        return json.dumps({'status':'Failed to delete: permission denied or no servable found.'})
+        return json_response({'status':'Failed to delete: permission denied or no servable found.'})
 
-    query = "update servables set status = 'DELETED' where uuid = '{0}'".format(servable_uuid)
     try:
-        cur.execute(query)
+        queries.execute(cur, 'delete_servable', servable_uuid)
         conn.commit()
     except Exception as e:
         print(e)
-        return json.dumps({"InternalError": e})
+        return json_response({"InternalError": e})
 
-    return json.dumps({'status': 'done'})
+    return json_response({'status': 'done'})
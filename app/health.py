@@ -0,0 +1,116 @@
+"""
+Cached dependency probes for the health and readiness endpoints.
+
+Each dependency is checked at most once per ``ttl`` seconds, in a background
+thread, so a load balancer polling every second costs no more than reading
+the last result. A slow dependency can never hold up a health check. Until a
+dependency's first check finishes it is reported as pending.
+"""
+import time
+import threading
+
+from config import (_get_db_connection, _load_db_connection, _load_dlhub_client, _client_session,
+                    PUBLISH_FLOW_ARN)
+
+PROBE_TIMEOUT = 2
+S3_BUCKET = 'dlhub-anl'
+
+
+class Probe:
+    """
+    A periodically refreshed check of one dependency.
+
+    :param name: name of the dependency
+    :param check: function that raises if the dependency is unavailable
+    :param ttl: seconds a result is reused before it is refreshed
+    :param critical: whether the service cannot take traffic without it
+    """
+
+    def __init__(self, name, check, ttl=5, critical=True):
+        self.name = name
+        self.check = check
+        self.ttl = ttl
+        self.critical = critical
+        self._result = {'ok': None, 'status': 'pending'}
+        self._checked = 0
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def result(self):
+        """Get the last result, starting a refresh in the background if it is stale"""
+        with self._lock:
+            if not self._refreshing and time.time() - self._checked >= self.ttl:
+                self._refreshing = True
+                threading.Thread(target=self._refresh, name='probe_{}'.format(self.name), daemon=True).start()
+            return self._result
+
+    def _refresh(self):
+        start = time.perf_counter()
+        try:
+            self.check()
+            result = {'ok': True, 'status': 'up'}
+        except Exception as e:
+            result = {'ok': False, 'status': 'down', 'error': str(e)}
+        result['latency_ms'] = round((time.perf_counter() - start) * 1000, 1)
+        result['checked_at'] = time.time()
+        with self._lock:
+            self._result = result
+            self._checked = time.time()
+            self._refreshing = False
+
+
+_probe_db = None
+
+
+def _check_database():
+    """Round trip on a connection of the probe's own, and check the worker's connection is usable
+
+    The probe does not run queries on the worker's connection, which a request
+    may be using at the same time. Getting that connection reopens it if it
+    was closed.
+    """
+    global _probe_db
+    import psycopg2.extensions
+    if _probe_db is None or _probe_db[0].closed:
+        _probe_db = _get_db_connection()
+        _probe_db[0].autocommit = True
+    _probe_db[1].execute("SELECT 1")
+    _probe_db[1].fetchone()
+    conn = _load_db_connection()[0]
+    if conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+        raise RuntimeError("Worker database connection is in a failed transaction")
+
+
+def _check_globus_auth():
+    client = _load_dlhub_client()
+    _client_session(client).head(client.base_url, timeout=PROBE_TIMEOUT).raise_for_status()
+
+
+def _check_step_functions():
+    from app.api.utils import _aws_client
+    _aws_client('stepfunctions').describe_state_machine(stateMachineArn=PUBLISH_FLOW_ARN)
+
+
+def _check_s3():
+    from app.api.utils import _aws_client
+    _aws_client('s3').head_bucket(Bucket=S3_BUCKET)
+
+
+PROBES = (
+    Probe('database', _check_database, ttl=2),
+    Probe('globus_auth', _check_globus_auth, ttl=10),
+    Probe('step_functions', _check_step_functions, ttl=10, critical=False),
+    Probe('s3', _check_s3, ttl=10, critical=False),
+)
+
+
+def dependencies():
+    """
+    Get the latest status of every dependency.
+
+    :return: (dict of name to result, whether every critical dependency is up, whether any dependency is down)
+    """
+    results = {probe.name: probe.result() for probe in PROBES}
+    available = all(results[p.name]['ok'] for p in PROBES if p.critical)
+    degraded = any(r['ok'] is False for r in results.values())
+    return results, available, degraded
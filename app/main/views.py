@@ -1,6 +1,10 @@
-from flask import request, flash, redirect, session, url_for, Blueprint
+import os
+from concurrent.futures import ThreadPoolExecutor
 
-from config import _load_dlhub_client, GLOBUS_CLIENT
+from flask import request, flash, redirect, session, url_for, Blueprint, jsonify
+
+from app import warmup, health
+from config import _load_dlhub_client, _load_dlhub_flow_client, GLOBUS_CLIENT, GLOBUS_POOL_SIZE
 
 main = Blueprint("main", __name__)
 
@@ -15,10 +19,43 @@ def home():
     return "DLHub.org"
 
 
+@main.route("/healthz")
+def healthz():
+    """Report that this worker is alive, with the latest latency of each dependency.
+
+    Always 200 while the worker can answer, so a slow backend does not get
+    healthy workers restarted. Dependencies are probed in the background at
+    most once every few seconds; this only reads the cached results.
+    """
+    deps, available, degraded = health.dependencies()
+    res = {'status': 'degraded' if degraded else 'ok', 'worker': os.getpid(), 'dependencies': deps}
+    return jsonify(res), 200
+
+
+@main.route("/readyz")
+def readyz():
+    """Report whether this worker has prewarmed and can take traffic.
+
+    A worker is ready once it has prewarmed and the database and Globus Auth
+    are up. The response names the worker and its gunicorn master, so a
+    graceful reload can wait for the new generation of workers to be warm.
+    """
+    deps, available, degraded = health.dependencies()
+    if not warmup.ready:
+        status = 'starting'
+    elif not available:
+        status = 'unavailable'
+    else:
+        status = 'ready'
+    res = {'status': status, 'warm': warmup.ready, 'master': os.getppid(), 'worker': os.getpid(),
+           'warmup': warmup.report, 'dependencies': deps}
+    return jsonify(res), 200 if status == 'ready' else 503
+
+
 @main.route('/login', methods=['GET'])
 def login():
     """Send the user to Globus Auth."""
-    return redirect(url_for('callback'))
+    return redirect(url_for('.callback'))
 
 
 @main.route('/callback', methods=['GET'])
@@ -29,12 +66,12 @@ def callback():
     if 'error' in request.args:
         flash("You could not be logged into the portal: " +
               request.args.get('error_description', request.args['error']))
-        return redirect(url_for('home'))
+        return redirect(url_for('.home'))
 
     # Set up our Globus Auth/OAuth2 state
-    redirect_uri = url_for('callback', _external=True)
+    redirect_uri = url_for('.callback', _external=True)
 
-    client = _load_dlhub_client()
+    client = _load_dlhub_flow_client()
     client.oauth2_start_flow(redirect_uri, refresh_tokens=False)
 
     # If there's no "code" query string parameter, we're in this route
@@ -52,12 +89,36 @@ def callback():
         code = request.args.get('code')
         tokens = client.oauth2_exchange_code_for_tokens(code)
         # id_token = tokens.decode_id_token(client)
+        # Start a fresh session so an id set before the login cannot be used to act as the user
+        session.regenerate()
         session.update(
             tokens=tokens.by_resource_server,
             is_authenticated=True
         )
 
-        return redirect(url_for('home'))
+        return redirect(url_for('.home'))
+
+
+def _revoke_tokens(tokens):
+    """
+    Revoke tokens with Globus Auth concurrently.
+
+    A token that cannot be revoked is reported and does not stop the logout.
+
+    :param tokens: list of (token, token type) pairs
+    """
+    if not tokens:
+        return
+    client = _load_dlhub_client()
+
+    def revoke(token, token_type):
+        try:
+            client.oauth2_revoke_token(token, additional_params={'token_type_hint': token_type})
+        except Exception as e:
+            print('Could not revoke {}: {}'.format(token_type, e))
+
+    with ThreadPoolExecutor(max_workers=min(len(tokens), GLOBUS_POOL_SIZE)) as pool:
+        list(pool.map(lambda t: revoke(*t), tokens))
 
 
 @main.route('/logout', methods=['GET'])
@@ -67,24 +128,20 @@ def logout():
     - Destroy the session state.
     - Redirect the user to the Globus Auth logout page.
     """
-    client = _load_dlhub_client()
-
     # Revoke the tokens with Globus Auth
-    for token, token_type in (
-            (token_info[ty], ty)
-            # get all of the token info dicts
-            for token_info in session['tokens'].values()
-            # cross product with the set of token types
-            for ty in ('access_token', 'refresh_token')
-            # only where the relevant token is actually present
-            if token_info[ty] is not None):
-        client.oauth2_revoke_token(
-            token, additional_params={'token_type_hint': token_type})
+    tokens = [(token_info[ty], ty)
+              # get all of the token info dicts
+              for token_info in session.get('tokens', {}).values()
+              # cross product with the set of token types
+              for ty in ('access_token', 'refresh_token')
+              # only where the relevant token is actually present
+              if token_info.get(ty) is not None]
+    _revoke_tokens(tokens)
 
     # Destroy the session state
     session.clear()
 
-    redirect_uri = url_for('home', _external=True)
+    redirect_uri = url_for('.home', _external=True)
 
     ga_logout_url = []
     ga_logout_url.append('https://auth.globus.org/v2/web/logout')
@@ -0,0 +1,192 @@
+"""
+Server-side sessions for the web pages.
+
+The session data (the user's OAuth tokens) is kept in a store, and the
+cookie only carries a signed, random session id of about 100 bytes. Two
+stores are available, chosen with the SESSION_TYPE setting:
+
+- ``filesystem``: one file per session under SESSION_DIR, spread over 256
+  shard directories. Put SESSION_DIR on shared storage to serve it from
+  more than one host.
+- ``postgres``: the ``web_sessions`` table of the service's database, shared
+  by every web host behind the load balancer.
+
+Sessions expire after the app's ``permanent_session_lifetime``. Expired
+sessions are ignored when read, and removed a few at a time as new sessions
+are saved.
+"""
+import os
+import time
+import random
+import secrets
+import datetime
+import tempfile
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from itsdangerous import Signer, BadSignature
+from werkzeug.datastructures import CallbackDict
+
+from config import SESSION_DIR, _lazy_db_connection
+
+# Expired sessions are removed on one in this many saves
+SWEEP_EVERY = 100
+
+
+class FileStore:
+    """Sessions kept in files, sharded on the first two characters of the session id"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, sid):
+        return os.path.join(self.root, sid[:2], sid)
+
+    def load(self, sid):
+        try:
+            with open(self._path(sid)) as f:
+                expires, data = f.read().split('\n', 1)
+        except (OSError, ValueError):
+            return None
+        return data if float(expires) > time.time() else None
+
+    def save(self, sid, data, ttl):
+        path = self._path(sid)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename, so a concurrent load never sees a partial file
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.')
+        with os.fdopen(fd, 'w') as f:
+            f.write('{}\n{}'.format(time.time() + ttl, data))
+        os.replace(tmp, path)
+
+    def delete(self, sid):
+        try:
+            os.remove(self._path(sid))
+        except FileNotFoundError:
+            pass
+
+    def sweep(self):
+        """Remove the expired sessions of one shard, chosen at random"""
+        shard = os.path.join(self.root, '{:02x}'.format(random.randrange(256)))
+        for sid in os.listdir(shard) if os.path.isdir(shard) else []:
+            if not sid.startswith('.') and self.load(sid) is None:
+                self.delete(sid)
+
+
+class PostgresStore:
+    """Sessions kept in the web_sessions table, see migrations/003_web_sessions.sql"""
+
+    def __init__(self):
+        self.conn, self.cur = _lazy_db_connection()
+
+    def load(self, sid):
+        from app.api import queries
+        row = queries.fetchone(self.cur, 'load_session', sid)
+        return row['data'] if row else None
+
+    def save(self, sid, data, ttl):
+        from app.api import queries
+        expires = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=ttl)
+        queries.execute(self.cur, 'save_session', sid, data, expires)
+        self.conn.commit()
+
+    def delete(self, sid):
+        from app.api import queries
+        queries.execute(self.cur, 'delete_session', sid)
+        self.conn.commit()
+
+    def sweep(self):
+        from app.api import queries
+        queries.execute(self.cur, 'expire_sessions')
+        self.conn.commit()
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    """Session data, with the id it is stored under"""
+
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid or secrets.token_hex(32)
+        self.new = new
+        self.modified = False
+        # Stored id this session moved away from, deleted when it is saved
+        self.replaced = None
+
+    def regenerate(self):
+        """Empty the session and move it to a new id, so an id known before a login is useless after it"""
+        self.clear()
+        if not self.new and self.replaced is None:
+            self.replaced = self.sid
+        self.sid = secrets.token_hex(32)
+        self.modified = True
+
+
+class ServerSessionInterface(SessionInterface):
+    """Keeps sessions in a store, with only their signed id in the cookie"""
+
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, store):
+        self.store = store
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt='dlhub-session')
+
+    def open_session(self, app, request):
+        if not app.secret_key:
+            return None
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if cookie:
+            try:
+                sid = self._signer(app).unsign(cookie).decode()
+                data = self.store.load(sid)
+                if data is not None:
+                    return ServerSession(self.serializer.loads(data), sid)
+            except BadSignature:
+                pass
+            except Exception as e:
+                print('Could not load session:', e)
+        return ServerSession(new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if session.replaced is not None:
+            self.store.delete(session.replaced)
+            session.replaced = None
+        if not session:
+            if session.modified and not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        if not session.modified:
+            return
+
+        ttl = app.permanent_session_lifetime.total_seconds()
+        self.store.save(session.sid, self.serializer.dumps(dict(session)), ttl)
+        if random.randrange(SWEEP_EVERY) == 0:
+            try:
+                self.store.sweep()
+            except Exception as e:
+                print('Could not remove expired sessions:', e)
+
+        response.vary.add('Cookie')
+        response.set_cookie(name, self._signer(app).sign(session.sid).decode(),
+                            expires=self.get_expiration_time(app, session), httponly=self.get_cookie_httponly(app),
+                            domain=domain, path=path, secure=self.get_cookie_secure(app),
+                            samesite=self.get_cookie_samesite(app))
+
+
+STORES = {
+    'filesystem': lambda: FileStore(SESSION_DIR),
+    'postgres': PostgresStore,
+}
+
+
+def init_app(app):
+    """Keep the app's sessions in the store named by its SESSION_TYPE setting"""
+    app.session_interface = ServerSessionInterface(STORES[app.config['SESSION_TYPE']]())
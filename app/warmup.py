@@ -0,0 +1,63 @@
+"""
+Prepare a web worker before it takes traffic.
+
+gunicorn calls ``prewarm`` from its ``post_worker_init`` hook, before the
+worker accepts connections. It opens the database connection and runs the
+servable catalogue query, creates the shared GlobusAuth client and connects
+it, and creates the AWS clients, so the first requests after a reload do not
+pay for any of that. ``/readyz`` reports the worker warm once this is done.
+"""
+import os
+import time
+
+from config import _load_dlhub_client, _client_session
+
+ready = False
+report = {}
+
+
+def _database():
+    from app.api import queries
+    from app.api.views import cur
+    queries.fetchall(cur, 'ready_servables')
+
+
+def _globus_auth():
+    client = _load_dlhub_client()
+    _client_session(client).head(client.base_url, timeout=5)
+
+
+def _aws():
+    from app.api.utils import _aws_client
+    for service in ('stepfunctions', 's3'):
+        _aws_client(service)
+
+
+def _token_cache():
+    from app.api.tokens import dependent_tokens
+    dependent_tokens._fernet
+
+
+STEPS = (('database', _database), ('globus_auth', _globus_auth), ('aws', _aws), ('token_cache', _token_cache))
+
+
+def prewarm():
+    """
+    Warm this worker's connections and clients.
+
+    A failing step is recorded in ``report`` and does not stop the others,
+    and the worker is marked ready either way. A dependency that is down
+    should not keep new code from being deployed.
+    """
+    global ready
+    for name, step in STEPS:
+        start = time.perf_counter()
+        try:
+            step()
+            report[name] = {'ok': True}
+        except Exception as e:
+            print('Prewarm of {} failed: {}'.format(name, e))
+            report[name] = {'ok': False, 'error': str(e)}
+        report[name]['ms'] = round((time.perf_counter() - start) * 1000, 1)
+    ready = True
+    print('Worker {} prewarmed: {}'.format(os.getpid(), report))
@@ -0,0 +1,82 @@
+"""
+Compare a new GlobusAuth client per call with the shared, pooled client.
+
+Starts a local fake auth server and times token introspection through
+``config._create_dlhub_client`` (a new client and connection each call)
+and ``config._load_dlhub_client`` (one client reusing its connections).
+Use ``--tls`` with a certificate to include handshake costs, as production
+requests to auth.globus.org do. Run from the repository root:
+
+    python benchmarks/auth_client_bench.py --calls 500
+"""
+import os
+import ssl
+import sys
+import json
+import time
+import argparse
+import threading
+import urllib3
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import config  # noqa: E402
+
+
+class FakeAuthHandler(BaseHTTPRequestHandler):
+    """Answers token introspection like GlobusAuth, keeping connections alive"""
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    connections = set()
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        FakeAuthHandler.connections.add(self.client_address)
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        body = json.dumps({'active': True, 'username': 'user@example.org', 'sub': 'abc'}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def _run(make_client, calls):
+    FakeAuthHandler.connections.clear()
+    start = time.perf_counter()
+    for _ in range(calls):
+        make_client().oauth2_token_introspect('token')
+    return time.perf_counter() - start, len(FakeAuthHandler.connections)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calls', type=int, default=500)
+    parser.add_argument('--tls', nargs=2, metavar=('CERT', 'KEY'), help='Serve HTTPS with this certificate')
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeAuthHandler)
+    scheme = 'http'
+    if args.tls:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(*args.tls)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+        scheme = 'https'
+        os.environ['GLOBUS_SDK_VERIFY_SSL'] = 'false'
+        urllib3.disable_warnings()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = '{}://127.0.0.1:{}/'.format(scheme, server.server_port)
+
+    shared = config._create_dlhub_client(base_url=base_url)
+    for name, make_client in (('new client per call', lambda: config._create_dlhub_client(base_url=base_url)),
+                              ('shared pooled client', lambda: shared)):
+        elapsed, connections = _run(make_client, args.calls)
+        print("%-22s %8.1f calls/s %8.2f ms/call %6d connections"
+              % (name, args.calls / elapsed, elapsed / args.calls * 1000, connections))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
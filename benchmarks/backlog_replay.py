@@ -0,0 +1,212 @@
+"""
+Replay historical publications through a simulated ingestion pipeline.
+
+Publications arrive when the historical task rows say they did, optionally
+scaled to a higher rate. Repository publications go through repo2docker,
+others through setup, and then both go through dockerize. Each stage has a
+number of workers and a mean service time, and service times are drawn from
+a lognormal distribution. The simulation samples the backlog metrics the
+exporter in ingestion/backlog.py would report, so scaling thresholds can be
+tried against real arrival patterns before they are used. It reports the
+queueing delay of each stage, how often the oldest waiting task was over
+the target wait, and end-to-end latency.
+
+Arrivals come from the database (--since), from a JSONL file of
+{"submitted": <epoch or ISO time>, "repository": <bool>} rows (--rows), or
+are generated (--synthetic). Run from the repository root:
+
+    python benchmarks/backlog_replay.py --synthetic 2000 --workers setup=2,repo2docker=2,dockerize=3
+"""
+import os
+import sys
+import json
+import heapq
+import random
+import argparse
+import datetime
+import statistics
+from collections import deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ingestion'))
+from backlog import summarize  # noqa: E402
+
+ROUTES = {True: ('repo2docker', 'dockerize'), False: ('setup', 'dockerize')}
+
+
+def _parse_stages(text, cast):
+    return {k: cast(v) for k, v in (item.split('=') for item in text.split(','))}
+
+
+def _epoch(value):
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        value = datetime.datetime.fromisoformat(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.timezone.utc)
+    return value.timestamp()
+
+
+def load_db(since):
+    """Arrivals of the publications submitted since an ISO date"""
+    from config import _get_db_connection
+    from app.api import queries
+    conn, cur = _get_db_connection()
+    try:
+        rows = queries.fetchall(cur, 'task_arrivals', datetime.datetime.fromisoformat(since))
+    finally:
+        conn.close()
+    arrivals = []
+    for row in rows:
+        task_input = json.loads(row['input']) if isinstance(row['input'], str) else row['input']
+        arrivals.append((_epoch(row['submitted']), isinstance(task_input, dict) and 'repository' in task_input))
+    return arrivals
+
+
+def load_rows(path):
+    """Arrivals from a JSONL file"""
+    with open(path) as fp:
+        rows = [json.loads(line) for line in fp if line.strip()]
+    return sorted((_epoch(row['submitted']), bool(row.get('repository'))) for row in rows)
+
+
+def synthetic(n, seed):
+    """Arrivals over a working week: Poisson during the day, with a few bulk uploads"""
+    rng = random.Random(seed)
+    arrivals, t = [], 0.0
+    while len(arrivals) < n:
+        hour = (t / 3600) % 24
+        t += rng.expovariate(1 / (120 if 8 <= hour < 18 else 900))
+        if rng.random() < 0.01:
+            # A bulk upload, submitted a few seconds apart
+            arrivals += [(t + i * 2, False) for i in range(rng.randint(20, 100))]
+        else:
+            arrivals.append((t, rng.random() < 0.3))
+    return arrivals[:n]
+
+
+def simulate(arrivals, workers, service, interval, seed):
+    """
+    Run the publications through the pipeline.
+
+    :param arrivals: sorted (submitted epoch, is repository) tuples
+    :param workers: workers per stage
+    :param service: mean service seconds per stage
+    :param interval: seconds between metric samples
+    :return: (per stage queueing delays, end-to-end latencies, samples of summarize() output, busy seconds per stage)
+    """
+    rng = random.Random(seed)
+    start = arrivals[0][0]
+    events = []
+    for i, (submitted, repository) in enumerate(arrivals):
+        heapq.heappush(events, (submitted - start, i, 'arrive', (i, 0)))
+    routes = [ROUTES[repository] for _, repository in arrivals]
+    submitted = [t - start for t, _ in arrivals]
+
+    queues = {stage: deque() for stage in workers}
+    free = dict(workers)
+    running = {stage: {} for stage in workers}
+    waits = {stage: [] for stage in workers}
+    busy = {stage: 0.0 for stage in workers}
+    latencies, samples = [], []
+    seq = len(arrivals)
+    next_sample = 0.0
+
+    def dispatch(stage, now):
+        nonlocal seq
+        while free[stage] and queues[stage]:
+            task, hop, enqueued = queues[stage].popleft()
+            free[stage] -= 1
+            waits[stage].append(now - enqueued)
+            mean = service[stage]
+            duration = rng.lognormvariate(0, 0.5) * mean / 1.133  # so the mean is `mean`
+            busy[stage] += duration
+            running[stage][task] = now
+            seq += 1
+            heapq.heappush(events, (now + duration, seq, 'done', (task, hop)))
+
+    while events:
+        now, _, kind, (task, hop) = heapq.heappop(events)
+        while next_sample <= now:
+            positions = [(stage, 'waiting', enqueued) for stage in queues for _, _, enqueued in queues[stage]]
+            positions += [(stage, 'running', started) for stage in running for started in running[stage].values()]
+            samples.append((next_sample, summarize(positions, next_sample)))
+            next_sample += interval
+
+        stage = routes[task][hop]
+        if kind == 'done':
+            free[stage] += 1
+            del running[stage][task]
+            dispatch(stage, now)
+            hop += 1
+            if hop == len(routes[task]):
+                latencies.append(now - submitted[task])
+                continue
+            stage = routes[task][hop]
+        queues[stage].append((task, hop, now))
+        dispatch(stage, now)
+    return waits, latencies, samples, busy
+
+
+def _percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--since', help='replay the publications submitted since this ISO date, from the database')
+    source.add_argument('--rows', help='replay the publications in a JSONL file')
+    source.add_argument('--synthetic', type=int, help='replay this many generated publications')
+    parser.add_argument('--workers', default='setup=1,repo2docker=1,dockerize=1', help='workers per stage')
+    parser.add_argument('--service', default='setup=120,repo2docker=600,dockerize=300',
+                        help='mean service seconds per stage')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiply the arrival rate')
+    parser.add_argument('--interval', type=float, default=60, help='seconds between metric samples')
+    parser.add_argument('--target-wait', type=float, default=900, help='oldest acceptable wait, in seconds')
+    parser.add_argument('--series', help='write the sampled metrics to this JSONL file')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.since:
+        arrivals = load_db(args.since)
+    elif args.rows:
+        arrivals = load_rows(args.rows)
+    else:
+        arrivals = synthetic(args.synthetic, args.seed)
+    if not arrivals:
+        print("No publications to replay")
+        return
+    arrivals = [(arrivals[0][0] + (t - arrivals[0][0]) / args.scale, repository) for t, repository in arrivals]
+    workers = _parse_stages(args.workers, int)
+    service = _parse_stages(args.service, float)
+
+    waits, latencies, samples, busy = simulate(arrivals, workers, service, args.interval, args.seed)
+    span = max(samples[-1][0], 1)
+    print("{} publications over {:.1f} hours (rate x{})".format(len(arrivals), span / 3600, args.scale))
+    print("\n{:<12} {:>7} {:>10} {:>10} {:>10} {:>11} {:>10} {:>12}".format(
+        'stage', 'workers', 'util', 'p50 wait', 'p95 wait', 'max waiting', 'max oldest', 'over target'))
+    for stage in workers:
+        waiting = [s.get((stage, 'waiting'), {'tasks': 0, 'oldest_seconds': 0}) for _, s in samples]
+        over = sum(1 for w in waiting if w['oldest_seconds'] > args.target_wait) / len(samples)
+        print("{:<12} {:>7} {:>9.0%} {:>9.0f}s {:>9.0f}s {:>11} {:>9.0f}s {:>11.1%}".format(
+            stage, workers[stage], busy[stage] / (span * workers[stage]), _percentile(waits[stage], 0.5),
+            _percentile(waits[stage], 0.95), max(w['tasks'] for w in waiting),
+            max(w['oldest_seconds'] for w in waiting), over))
+    print("\nend to end: p50 {:.0f}s  p95 {:.0f}s  max {:.0f}s  mean {:.0f}s".format(
+        _percentile(latencies, 0.5), _percentile(latencies, 0.95), max(latencies), statistics.mean(latencies)))
+
+    if args.series:
+        with open(args.series, 'w') as fp:
+            for t, summary in samples:
+                fp.write(json.dumps({'t': t, 'backlog': {'{}/{}'.format(*k): {'tasks': v['tasks'],
+                                                                              'oldest_seconds': v['oldest_seconds']}
+                                                         for k, v in summary.items()}}) + '\n')
+
+
+if __name__ == '__main__':
+    main()
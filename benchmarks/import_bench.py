@@ -0,0 +1,72 @@
+"""
+Measure the cold-start cost of importing the web service.
+
+Imports a module (``run`` by default, which is what gunicorn loads) in fresh
+interpreters with ``python -X importtime``. Reports the median wall time and
+cumulative import time, the packages that cost the most, and whether any
+heavy SDK was imported eagerly. No database or AWS access is needed. Run from
+the repository root:
+
+    python benchmarks/import_bench.py --repeat 5
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# SDKs that should only be imported when a request needs them
+LAZY = ('boto3', 'botocore', 'globus_sdk', 'zmq', 'cryptography', 'psycopg2')
+
+
+def _import_once(module):
+    """Import a module in a fresh interpreter, returning wall seconds and {module: (self us, cumulative us)}"""
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)], cwd=ROOT,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    wall = time.perf_counter() - start
+    if proc.returncode != 0:
+        raise RuntimeError("Importing {} failed:\n{}".format(module, proc.stderr[-2000:]))
+
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+    return wall, times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--module', default='run', help='module to import')
+    parser.add_argument('--repeat', type=int, default=5, help='number of fresh interpreters')
+    parser.add_argument('--top', type=int, default=10, help='number of packages to list')
+    args = parser.parse_args()
+
+    walls, cumulative, packages = [], [], {}
+    for _ in range(args.repeat):
+        wall, times = _import_once(args.module)
+        walls.append(wall)
+        cumulative.append(times[args.module][1] / 1000)
+        for name, (self_us, _) in times.items():
+            top = name.split('.')[0]
+            packages.setdefault(top, []).append(self_us)
+
+    print("import {}: {:.0f} ms wall (with interpreter start-up), {:.0f} ms cumulative import time".format(
+        args.module, statistics.median(walls) * 1000, statistics.median(cumulative)))
+
+    print("\nMost expensive packages (self time, median of runs):")
+    costs = sorted(((sum(v) / args.repeat / 1000, k) for k, v in packages.items()), reverse=True)
+    for ms, name in costs[:args.top]:
+        print("  {:<24} {:8.1f} ms".format(name, ms))
+
+    eager = [name for name in LAZY if name in packages]
+    print("\nHeavy SDKs imported eagerly: {}".format(', '.join(eager) if eager else 'none'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Compare the binary payload format with JSON for large arrays.
+
+For each array size this reports encode and decode time and bytes on the
+wire for plain JSON (nested lists), base64 inside JSON, and the DLHub binary
+body. Run from the repository root:
+
+    python benchmarks/payload_bench.py --sizes 1 10 100
+"""
+import os
+import sys
+import json
+import time
+import base64
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from dlhub_payload import encode_body, decode_body  # noqa: E402
+
+
+def _json_list(array):
+    body = json.dumps({'data': array.tolist()}).encode()
+    return body, lambda b: np.array(json.loads(b)['data'], dtype=array.dtype)
+
+
+def _json_base64(array):
+    body = json.dumps({'data': base64.b64encode(array.tobytes()).decode(), 'dtype': array.dtype.str,
+                       'shape': array.shape}).encode()
+
+    def decode(b):
+        doc = json.loads(b)
+        return np.frombuffer(base64.b64decode(doc['data']), dtype=doc['dtype']).reshape(doc['shape'])
+    return body, decode
+
+
+def _binary(array):
+    # Joining the chunks stands in for writing them to the socket
+    body = b''.join(encode_body({'data': array}))
+    return body, lambda b: decode_body(b)['data']
+
+
+def _time(fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=float, nargs='+', default=[1, 10, 100], help='Array sizes in MB')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--skip-list', action='store_true', help='Skip the nested-list JSON encoding')
+    args = parser.parse_args()
+
+    formats = [('json-base64', _json_base64), ('binary', _binary)]
+    if not args.skip_list:
+        formats.insert(0, ('json-list', _json_list))
+
+    print("%8s  %-12s %12s %12s %14s" % ('size', 'format', 'encode ms', 'decode ms', 'wire MB'))
+    for size in args.sizes:
+        array = np.random.rand(int(size * 2 ** 20 / 8))
+        for name, fmt in formats:
+            encode_time, (body, decode) = _time(lambda: fmt(array), args.repeat)
+            decode_time, result = _time(lambda: decode(body), args.repeat)
+            assert np.array_equal(result, array)
+            print("%6gMB  %-12s %12.1f %12.1f %14.2f"
+                  % (size, name, encode_time * 1000, decode_time * 1000, len(body) / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main()
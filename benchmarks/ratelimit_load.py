@@ -0,0 +1,124 @@
+"""
+Load test of per-user rate limiting with a noisy neighbour.
+
+Serves a stand-in for an expensive endpoint: a handler that holds one of
+``--workers`` slots, like the gunicorn workers, for ``--service-ms``. A noisy
+user hammers it from many threads and ignores Retry-After. A few well-behaved
+users make requests at a steady rate. The test reports the latency the
+well-behaved users see with admission control off and on. It also reports
+the overhead of a bucket check for the in-process and SQLite stores. Run
+from the repository root:
+
+    python benchmarks/ratelimit_load.py --duration 10
+"""
+import os
+import sys
+import time
+import logging
+import tempfile
+import argparse
+import threading
+import statistics
+
+import requests
+from flask import Flask, request
+from werkzeug.serving import make_server
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from app.api import ratelimit  # noqa: E402
+from app.api.ratelimit import RateLimiter, LocalStore, SQLiteStore, admit  # noqa: E402
+
+
+def _serve(workers, service_ms):
+    app = Flask(__name__)
+    slots = threading.Semaphore(workers)
+
+    @app.route('/work')
+    def work():
+        admit(request.headers['X-User'], 'work')
+        with slots:
+            time.sleep(service_ms / 1000)
+        return 'ok'
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _noisy(url, stop, counts):
+    session = requests.Session()
+    while not stop.is_set():
+        r = session.get(url, headers={'X-User': 'noisy'})
+        counts[r.status_code] = counts.get(r.status_code, 0) + 1
+
+
+def _fair(url, user, interval, stop, latencies):
+    session = requests.Session()
+    while not stop.is_set():
+        start = time.perf_counter()
+        r = session.get(url, headers={'X-User': user})
+        if r.status_code == 200:
+            latencies.append((time.perf_counter() - start) * 1000)
+        time.sleep(max(0, interval - (time.perf_counter() - start)))
+
+
+def _run(args, url):
+    stop = threading.Event()
+    latencies, counts = [], {}
+    threads = [threading.Thread(target=_noisy, args=(url, stop, counts)) for _ in range(args.noisy_threads)]
+    threads += [threading.Thread(target=_fair, args=(url, 'user{}'.format(i), args.fair_interval, stop, latencies))
+                for i in range(args.fair_users)]
+    for t in threads:
+        t.start()
+    time.sleep(args.duration)
+    stop.set()
+    for t in threads:
+        t.join()
+    latencies.sort()
+    return latencies, counts
+
+
+def _check_overhead(store, n=20000):
+    limiter = RateLimiter({'work': (1e9, 1e9)}, store)
+    start = time.perf_counter()
+    for i in range(n):
+        limiter.check('user{}'.format(i % 100), 'work')
+    return (time.perf_counter() - start) / n * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--duration', type=float, default=10, help='seconds per phase')
+    parser.add_argument('--workers', type=int, default=3, help='concurrent requests the server handles')
+    parser.add_argument('--service-ms', type=float, default=50, help='time each admitted request takes')
+    parser.add_argument('--noisy-threads', type=int, default=16, help='threads of the noisy user')
+    parser.add_argument('--fair-users', type=int, default=4, help='number of well-behaved users')
+    parser.add_argument('--fair-interval', type=float, default=0.25, help='seconds between their requests')
+    parser.add_argument('--rate', type=float, default=5, help='tokens per second per user')
+    parser.add_argument('--burst', type=float, default=10, help='bucket size per user')
+    args = parser.parse_args()
+
+    server = _serve(args.workers, args.service_ms)
+    url = 'http://127.0.0.1:{}/work'.format(server.server_port)
+    ratelimit.limiter = RateLimiter({'work': (args.rate, args.burst)})
+
+    print("{:<10} {:>10} {:>10} {:>10} {:>12} {:>12}".format(
+        'limiting', 'fair reqs', 'p50 ms', 'p99 ms', 'noisy 200s', 'noisy 429s'))
+    for enabled in (False, True):
+        ratelimit.RATE_LIMIT_ENABLED = enabled
+        latencies, counts = _run(args, url)
+        p99 = latencies[max(0, int(len(latencies) * 0.99) - 1)] if latencies else float('nan')
+        print("{:<10} {:>10} {:>10.1f} {:>10.1f} {:>12} {:>12}".format(
+            'on' if enabled else 'off', len(latencies),
+            statistics.median(latencies) if latencies else float('nan'), p99,
+            counts.get(200, 0), counts.get(429, 0)))
+    server.shutdown()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        print("Bucket check: {:.1f} us in process, {:.1f} us shared SQLite".format(
+            _check_overhead(LocalStore()), _check_overhead(SQLiteStore(os.path.join(tmp, 'buckets.db')))))
+
+
+if __name__ == '__main__':
+    main()
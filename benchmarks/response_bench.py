@@ -0,0 +1,87 @@
+"""
+Compare JSON encoders and response compression for API payloads.
+
+Builds payloads shaped like the /servables listing (database rows with
+datetimes, UUIDs and servable metadata) and a task status response (the
+publication flow's output). For each, it reports the encode time of the
+standard library with ``default=str`` and of app.api.responses.dumps, then
+the compressed size and compression time of every encoding the server can
+offer. Run from the repository root:
+
+    python benchmarks/response_bench.py --servables 2000
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import argparse
+import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from app.api import responses  # noqa: E402
+
+
+def _servable(i):
+    name = 'model_{}'.format(i)
+    return {
+        'datacite': {'creators': [{'givenName': 'Jane', 'familyName': 'Doe', 'affiliations': ['Argonne']}],
+                     'titles': [{'title': 'Servable {}'.format(i)}], 'publisher': 'DLHub',
+                     'resourceType': {'resourceTypeGeneral': 'InteractiveResource'}},
+        'dlhub': {'version': '0.8.4', 'domains': ['materials science'], 'visible_to': ['public'],
+                  'name': name, 'owner': 'user{}'.format(i % 50), 'shorthand_name': 'user/{}'.format(name),
+                  'files': {'model': 'model.pkl', 'other': ['featurizer.py', 'requirements.txt']},
+                  'dependencies': {'python': {'scikit-learn': '0.22.1', 'numpy': '1.18.1', 'pandas': '1.0.1'}}},
+        'servable': {'type': 'Scikit-learn estimator', 'methods': {'run': {
+            'input': {'type': 'ndarray', 'shape': [None, 4], 'description': 'Features'},
+            'output': {'type': 'ndarray', 'shape': [None], 'description': 'Predictions'},
+            'parameters': {}, 'method_details': {'method_name': 'predict'}}}},
+    }
+
+
+def _servables_payload(n):
+    now = datetime.datetime(2020, 1, 1)
+    return [{'id': i, 'uuid': uuid.uuid4(), 'dlhub_name': 'user{}/model_{}'.format(i % 50, i), 'status': 'READY',
+             'protected': False, 'author': i % 50, 'created': now + datetime.timedelta(minutes=i),
+             'metadata': json.dumps(_servable(i))} for i in range(n)]
+
+
+def _status_payload():
+    output = _servable(0)
+    output['dlhub'].update({'id': str(uuid.uuid4()), 'ecr_uri': 'xxx.dkr.ecr.us-east-1.amazonaws.com/model',
+                            'funcx_id': str(uuid.uuid4()), 'build_location': '/mnt/dlhub_ingest/model'})
+    output['dlhub']['files']['other'] = ['data/file_{}.csv'.format(i) for i in range(2000)]
+    return {'status': 'SUCCEEDED', 'invocation_time': datetime.datetime.now(), 'output': json.dumps(output)}
+
+
+def _time(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return (time.perf_counter() - start) / repeat * 1000, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--servables', type=int, default=2000, help='rows in the /servables payload')
+    parser.add_argument('--repeat', type=int, default=10, help='repetitions per measurement')
+    args = parser.parse_args()
+    random.seed(0)
+
+    payloads = [('/servables', _servables_payload(args.servables)), ('status', _status_payload())]
+    print("orjson: {}, encodings: {}".format(responses.orjson is not None, ', '.join(sorted(responses._COMPRESSORS))))
+    for label, payload in payloads:
+        std_ms, std = _time(lambda: json.dumps(payload, default=str).encode(), args.repeat)
+        fast_ms, body = _time(lambda: responses.dumps(payload), args.repeat)
+        print("\n{}: {} bytes".format(label, len(body)))
+        print("  encode   json.dumps {:8.2f} ms   responses.dumps {:8.2f} ms   ({:.1f}x)".format(
+            std_ms, fast_ms, std_ms / fast_ms))
+        for name, compress in sorted(responses._COMPRESSORS.items()):
+            ms, compressed = _time(lambda: compress(body), args.repeat)
+            print("  {:<8} {:10} bytes  {:6.1f}x smaller  {:8.2f} ms".format(
+                name, len(compressed), len(body) / len(compressed), ms))
+
+
+if __name__ == '__main__':
+    main()
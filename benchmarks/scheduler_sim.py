@@ -0,0 +1,106 @@
+"""
+Simulate the publication scheduler against first-come-first-served.
+
+One user submits a bulk upload, and shortly after, other users submit single
+publications, some of them tests. Flows are started with
+app.api.scheduler.FakeFlowStarter and builds take a random time around
+--build seconds. The ingestion hosts can run --capacity builds at once. The
+simulation reports how long the single publications waited to start, and
+when the bulk upload finished, under FIFO and under the scheduler's plan. No
+database or AWS access is needed. Run from the repository root:
+
+    python benchmarks/scheduler_sim.py --bulk 100 --capacity 8
+"""
+import os
+import sys
+import heapq
+import random
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from app.api import scheduler  # noqa: E402
+
+FLOW_ARN = 'arn:aws:states:us-east-1:000000000000:stateMachine:Publish'
+
+
+def _fifo(queued, running, max_per_user, max_running):
+    slots = max_running - sum(running.values())
+    return sorted(queued, key=lambda t: t['queued'])[:max(slots, 0)]
+
+
+def _workload(bulk, singles, seed):
+    rng = random.Random(seed)
+    tasks = [{'uuid': 'bulk-{}'.format(i), 'owner': 'bulk_user', 'priority': scheduler.PRIORITIES['production'],
+              'queued': i * 0.5} for i in range(bulk)]
+    for i in range(singles):
+        test = rng.random() < 0.3
+        tasks.append({'uuid': 'single-{}'.format(i), 'owner': 'user{}'.format(i),
+                      'priority': scheduler.PRIORITIES['test' if test else 'production'],
+                      'queued': 60 + rng.uniform(0, 3600)})
+    return tasks
+
+
+def simulate(tasks, plan, capacity, max_per_user, build, seed):
+    """
+    Run the workload with a planning function.
+
+    :return: dict of task uuid to (queued, started, finished)
+    """
+    rng = random.Random(seed)
+    starter = scheduler.FakeFlowStarter()
+    events = [(task['queued'], 0, 'submit', task) for task in tasks]
+    heapq.heapify(events)
+    queued, owners, times, seq = [], {}, {}, 0
+
+    while events:
+        now, _, kind, task = heapq.heappop(events)
+        if kind == 'submit':
+            queued.append(task)
+        else:
+            starter.finish(task['arn'])
+            times[task['uuid']] += (now,)
+
+        running = {}
+        for arn, status in starter.statuses.items():
+            if status == 'RUNNING':
+                running[owners[arn]] = running.get(owners[arn], 0) + 1
+        for picked in plan(queued, running, max_per_user, capacity):
+            queued.remove(picked)
+            arn = starter.start(FLOW_ARN, {}, picked['uuid'])['executionArn']
+            owners[arn] = picked['owner']
+            times[picked['uuid']] = (picked['queued'], now)
+            seq += 1
+            heapq.heappush(events, (now + rng.lognormvariate(0, 0.4) * build, seq, 'finish',
+                                    dict(picked, arn=arn)))
+    return times
+
+
+def _report(label, times):
+    singles = [s - q for uuid, (q, s, f) in times.items() if uuid.startswith('single')]
+    bulk_done = max(f for uuid, (q, s, f) in times.items() if uuid.startswith('bulk'))
+    print("{:<12} single wait p50 {:7.0f}s  p95 {:7.0f}s  max {:7.0f}s   bulk upload done after {:7.0f}s".format(
+        label, statistics.median(singles), sorted(singles)[int(0.95 * (len(singles) - 1))], max(singles),
+        bulk_done))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--bulk', type=int, default=100, help='publications in the bulk upload')
+    parser.add_argument('--singles', type=int, default=20, help='single publications by other users')
+    parser.add_argument('--capacity', type=int, default=8, help='builds the ingestion hosts run at once')
+    parser.add_argument('--max-per-user', type=int, default=scheduler.PUBLISH_MAX_PER_USER,
+                        help='builds a user may have running')
+    parser.add_argument('--build', type=float, default=600, help='typical build seconds')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    tasks = _workload(args.bulk, args.singles, args.seed)
+    print("{} bulk + {} single publications, capacity {}, at most {} per user".format(
+        args.bulk, args.singles, args.capacity, args.max_per_user))
+    _report('FIFO', simulate(tasks, _fifo, args.capacity, args.max_per_user, args.build, args.seed))
+    _report('fair share', simulate(tasks, scheduler.plan, args.capacity, args.max_per_user, args.build, args.seed))
+
+
+if __name__ == '__main__':
+    main()
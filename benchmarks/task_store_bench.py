@@ -0,0 +1,100 @@
+"""
+Compare the old task status lookup with the task store on a large log table.
+
+Fills a scratch schema with tasks and millions of invocation log rows, then
+times looking up random tasks with the old query (every joined row fetched
+and the last kept in Python) and with task_store.get_latest, before and
+after the indexes from migrations/002_task_store.sql. Needs a PostgreSQL
+database the user can create schemas in. Run from the repository root:
+
+    python benchmarks/task_store_bench.py --dsn "dbname=dlhub_bench" --tasks 100000 --logs 5000000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import statistics
+
+import psycopg2
+import psycopg2.extras
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from app.api import task_store  # noqa: E402
+
+SCHEMA = 'dlhub_task_store_bench'
+
+
+def _setup(cur, n_tasks, n_logs):
+    cur.execute("DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0}; SET search_path TO {0}".format(SCHEMA))
+    cur.execute("CREATE TABLE tasks (id serial, uuid text, type text, input text, arn text, status text, "
+                "result text)")
+    cur.execute("CREATE TABLE invocation_logs (id serial, task_uuid text, invocation timestamp)")
+    cur.execute("CREATE TABLE task_results (task_uuid text PRIMARY KEY, encoding text NOT NULL, "
+                "data bytea NOT NULL)")
+    cur.execute("INSERT INTO tasks (uuid, type, input, arn, status, result) "
+                "SELECT 'task-' || i, 'run', '[]', '', 'COMPLETED', repeat('x', 200) "
+                "FROM generate_series(1, %s) i", (n_tasks,))
+    cur.execute("INSERT INTO invocation_logs (task_uuid, invocation) "
+                "SELECT 'task-' || (1 + (random() * (%s - 1))::int), now() - random() * interval '365 days' "
+                "FROM generate_series(1, %s)", (n_tasks, n_logs))
+    cur.execute("ANALYZE")
+
+
+def _old_lookup(cur, task_uuid):
+    cur.execute("SELECT * from tasks, invocation_logs where tasks.uuid = '%s' and "
+                "tasks.uuid = invocation_logs.task_uuid" % task_uuid)
+    last = None
+    for r in cur.fetchall():
+        last = r
+    return last
+
+
+def _time(lookup, cur, uuids):
+    times = []
+    for u in uuids:
+        start = time.perf_counter()
+        lookup(cur, u)
+        times.append((time.perf_counter() - start) * 1000)
+    times.sort()
+    return statistics.median(times), times[int(len(times) * 0.99) - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dsn', default='dbname=dlhub_bench', help='libpq connection string')
+    parser.add_argument('--tasks', type=int, default=100000, help='number of tasks')
+    parser.add_argument('--logs', type=int, default=5000000, help='number of invocation log rows')
+    parser.add_argument('--lookups', type=int, default=200, help='lookups timed per variant')
+    parser.add_argument('--keep', action='store_true', help='keep the scratch schema')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(args.dsn)
+    conn.autocommit = True
+    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+
+    start = time.perf_counter()
+    _setup(cur, args.tasks, args.logs)
+    print("Loaded {} tasks and {} log rows in {:.1f}s".format(args.tasks, args.logs, time.perf_counter() - start))
+
+    uuids = ['task-{}'.format(random.randint(1, args.tasks)) for _ in range(args.lookups)]
+    variants = [('old query', _old_lookup), ('get_latest', task_store.get_latest)]
+    try:
+        print("{:<12} {:<12} {:>10} {:>10}".format('indexes', 'lookup', 'p50 ms', 'p99 ms'))
+        for label, lookup in variants:
+            print("{:<12} {:<12} {:>10.2f} {:>10.2f}".format('none', label, *_time(lookup, cur, uuids)))
+
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'migrations',
+                               '002_task_store.sql')) as fp:
+            cur.execute(fp.read())
+        cur.execute("ANALYZE")
+        for label, lookup in variants:
+            print("{:<12} {:<12} {:>10.2f} {:>10.2f}".format('002', label, *_time(lookup, cur, uuids)))
+    finally:
+        if not args.keep:
+            cur.execute("DROP SCHEMA {} CASCADE".format(SCHEMA))
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,348 @@
+"""
+Replay captured API traffic and report latency and errors.
+
+Reads a trace written by app/api/capture.py (set ``traffic_capture`` on a
+production worker) and sends the same requests at the original rate, or
+faster with --speed. Each request goes to the endpoint it was captured on,
+with the same method, from the same client, and with a body of about the
+same size. Requests are sent when the trace says, whether or not earlier
+ones have returned. Latency is measured from that scheduled time, so a
+server that falls behind is not flattered by the replay.
+
+By default the replay runs against a local instance of the app with stubbed
+upstreams. The stubs are:
+
+- the database, with canned rows per named statement;
+- Globus Auth, with one user per captured client;
+- Step Functions and S3;
+- GitHub, through github_fetcher.FakeGitHub.
+
+Each stub adds the latency given with --upstream-ms. Use --target to replay
+against a running instance instead. The report has latency percentiles,
+errors and rate-limited requests per endpoint, next to the latency recorded
+in the capture. Run from the repository root:
+
+    python benchmarks/traffic_replay.py traffic.jsonl --speed 4
+"""
+import io
+import os
+import sys
+import json
+import time
+import uuid
+import logging
+import argparse
+import datetime
+import threading
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# Canned database rows by statement name
+_SERVABLE = {'id': 1, 'uuid': str(uuid.uuid4()), 'dlhub_name': 'replay_user/replay', 'status': 'READY',
+             'protected': False, 'author': 1, 'created': datetime.datetime(2020, 1, 1),
+             'metadata': json.dumps({'dlhub': {'name': 'replay', 'owner': 'replay_user', 'version': '0.8.4'},
+                                     'servable': {'type': 'Python function', 'methods': {'run': {}}}})}
+
+
+def _rows(name, servables):
+    if name == 'user_by_name':
+        return [{'id': 1, 'namespace': 'replay_user'}]
+    if name == 'ready_servables':
+        return [dict(_SERVABLE, id=i, dlhub_name='replay_user/replay_{}'.format(i)) for i in range(servables)]
+    if name in ('servable_by_uuid', 'servable_by_author', 'latest_servable_by_name'):
+        return [_SERVABLE]
+    if name == 'latest_task':
+        return [{'arn': 'arn:aws:states:us-east-1:000000000000:execution:replay:1', 'status': 'RUNNING',
+                 'result': '', 'encoding': None, 'data': None, 'invocation': datetime.datetime.now()}]
+    if name == 'try_lock':
+        return [{'locked': True}]
+    return []
+
+
+class _FakeConnection:
+    closed = False
+    encoding = 'UTF8'
+    autocommit = False
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def get_backend_pid(self):
+        return 1
+
+    def get_transaction_status(self):
+        # psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        return 0
+
+
+class _FakeCursor:
+    """Answers the named statements of app.api.queries with canned rows"""
+
+    def __init__(self, latency, servables):
+        self.connection = _FakeConnection()
+        self.latency = latency
+        self.servables = servables
+        self._local = threading.local()
+
+    @property
+    def rowcount(self):
+        return len(getattr(self._local, 'rows', []))
+
+    def execute(self, sql, params=None):
+        if isinstance(sql, bytes):
+            sql = sql.decode()
+        if sql.startswith('PREPARE'):
+            return
+        time.sleep(self.latency)
+        self._local.rows = _rows(sql.split()[1], self.servables) if sql.startswith('EXECUTE') else []
+
+    def mogrify(self, template, args):
+        return template.encode()
+
+    def fetchone(self):
+        rows = getattr(self._local, 'rows', [])
+        return rows[0] if rows else None
+
+    def fetchall(self):
+        return getattr(self._local, 'rows', [])
+
+
+class _FakeAWS:
+    """Step Functions and S3 calls made by the API"""
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def start_execution(self, stateMachineArn, name, input):
+        time.sleep(self.latency)
+        return {'executionArn': '{}:{}'.format(stateMachineArn.replace(':stateMachine:', ':execution:'), name)}
+
+    def describe_execution(self, executionArn):
+        time.sleep(self.latency)
+        return {'status': 'RUNNING'}
+
+    def generate_presigned_post(self, bucket, key, **kwargs):
+        return {'url': 'https://{}.s3.amazonaws.com/'.format(bucket), 'fields': {'key': key}}
+
+    def generate_presigned_url(self, method, Params, ExpiresIn):
+        return 'https://{}.s3.amazonaws.com/{}'.format(Params['Bucket'], Params['Key'])
+
+    def get_paginator(self, name):
+        aws = self
+
+        class Paginator:
+            def paginate(self, **kwargs):
+                time.sleep(aws.latency)
+                return [{'Contents': []}]
+        return Paginator()
+
+
+class _FakeAuth:
+    """Globus Auth, with a user per token"""
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def oauth2_token_introspect(self, token):
+        time.sleep(self.latency)
+        return {'username': '{}@replay.org'.format(token), 'sub': token}
+
+    def get(self, user_id, scope, auth_token):
+        time.sleep(self.latency)
+        return 'dependent-token'
+
+
+def serve_local(upstream_ms, servables, rate_limit):
+    """
+    Serve the app on a local port with stubbed upstreams.
+
+    :return: (base URL, server)
+    """
+    from werkzeug.serving import make_server
+    from github_fetcher import FakeGitHub, GitHubFetcher
+    import run
+    from app.api import views, utils, fingerprint, ratelimit, capture
+
+    latency = {k: v / 1000 for k, v in upstream_ms.items()}
+    cur = _FakeCursor(latency.get('db', 0), servables)
+    views.cur, views.conn = cur, cur.connection
+    aws = _FakeAWS(latency.get('aws', 0))
+    for module in (views, utils, fingerprint):
+        module._aws_client = lambda service: aws
+    auth = _FakeAuth(latency.get('globus', 0))
+    utils._load_dlhub_client = lambda: auth
+    views.dependent_tokens = auth
+
+    github = FakeGitHub()
+    github.add_repo('replay/servable', {'dlhub.json': json.dumps({'dlhub': {'name': 'replay'}})})
+    utils.github = fingerprint.github = GitHubFetcher(base_url=github.url, max_retries=0)
+    if latency.get('github'):
+        get = utils.github.get
+        utils.github.get = lambda *a, **kw: time.sleep(latency['github']) or get(*a, **kw)
+
+    ratelimit.RATE_LIMIT_ENABLED = rate_limit
+    capture.TRAFFIC_CAPTURE = None
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, run.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return 'http://127.0.0.1:{}'.format(server.server_port), server
+
+
+def load(path, limit=None):
+    """Captured requests, oldest first"""
+    records = []
+    with open(path) as fp:
+        for line in fp:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get('endpoint') and 'ts' in record:
+                records.append(record)
+    records.sort(key=lambda r: r['ts'])
+    return records[:limit] if limit else records
+
+
+def _path(rule):
+    values = {'task_uuid': str(uuid.uuid4()), 'servable_uuid': _SERVABLE['uuid'],
+              'servable_namespace': 'replay_user', 'servable_name': 'replay'}
+    parts = []
+    for part in rule.split('/'):
+        if part.startswith('<') and part.endswith('>'):
+            part = values.get(part[1:-1].split(':')[-1], 'replay')
+        parts.append(part)
+    return '/'.join(parts)
+
+
+def _servable(size):
+    servable = {'dlhub': {'name': 'replay', 'transfer_method': {'S3': 's3://dlhub-anl/replay/'}},
+                'servable': {'type': 'Python function', 'methods': {'run': {}}}, 'datacite': {'description': ''}}
+    servable['datacite']['description'] = 'x' * max(0, size - len(json.dumps(servable)))
+    return servable
+
+
+def _body(record):
+    """A request body shaped like the captured one"""
+    size = record.get('request_bytes') or 0
+    endpoint = record['endpoint']
+    if endpoint.endswith('/publish/bulk'):
+        items = max(1, record.get('items') or 1)
+        return {'servables': [_servable(size // items) for _ in range(items)]}
+    if endpoint.endswith('/publish_repo'):
+        return {'dlhub': {}, 'repository': 'https://github.com/replay/servable', 'padding': 'x' * size}
+    if endpoint.endswith('/publish'):
+        return _servable(size)
+    if record['method'] in ('POST', 'PUT') and size:
+        return {'padding': 'x' * size}
+    return None
+
+
+_sessions = threading.local()
+
+
+def _send(base_url, record, due, results):
+    session = getattr(_sessions, 'session', None)
+    if session is None:
+        session = _sessions.session = requests.Session()
+    headers = {'Authorization': 'Bearer {}'.format(record.get('client') or 'anonymous')}
+    sent = time.perf_counter()
+    try:
+        r = session.request(record['method'], base_url + _path(record['endpoint']), json=_body(record),
+                            headers=headers, timeout=60)
+        status = r.status_code
+    except requests.RequestException as e:
+        status = type(e).__name__
+    done = time.perf_counter()
+    results.append({'endpoint': '{} {}'.format(record['method'], record['endpoint']), 'status': status,
+                    'latency_ms': (done - due) * 1000, 'service_ms': (done - sent) * 1000,
+                    'captured_ms': record.get('ms')})
+
+
+def replay(base_url, records, speed, concurrency):
+    """
+    Send the captured requests on the captured schedule.
+
+    :return: (list of result dicts, seconds the replay took)
+    """
+    results = []
+    start = time.perf_counter()
+    first = records[0]['ts']
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for record in records:
+            due = start + (record['ts'] - first) / speed
+            time.sleep(max(0, due - time.perf_counter()))
+            pool.submit(_send, base_url, record, due, results)
+    return results, time.perf_counter() - start
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0
+
+
+def report(results, elapsed):
+    by_endpoint = {}
+    for result in results:
+        by_endpoint.setdefault(result['endpoint'], []).append(result)
+    print("{} requests in {:.1f}s ({:.1f}/s)\n".format(len(results), elapsed, len(results) / elapsed))
+    print("{:<52} {:>6} {:>7} {:>7} {:>7} {:>8} {:>6} {:>5} {:>9}".format(
+        'endpoint', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms', 'errors', '429', 'captured'))
+    for endpoint, rows in sorted(by_endpoint.items()) + [('all', results)]:
+        latencies = [r['latency_ms'] for r in rows]
+        errors = sum(1 for r in rows if not isinstance(r['status'], int) or r['status'] >= 500)
+        limited = sum(1 for r in rows if r['status'] == 429)
+        captured = [r['captured_ms'] for r in rows if r['captured_ms'] is not None]
+        print("{:<52} {:>6} {:>7.1f} {:>7.1f} {:>7.1f} {:>8.1f} {:>6} {:>5} {:>9}".format(
+            endpoint[:52], len(rows), _percentile(latencies, 0.5), _percentile(latencies, 0.95),
+            _percentile(latencies, 0.99), max(latencies), errors, limited,
+            '{:.1f}'.format(statistics.median(captured)) if captured else '-'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('trace', help='JSONL trace written by app/api/capture.py')
+    parser.add_argument('--speed', type=float, default=1.0, help='replay this many times faster than captured')
+    parser.add_argument('--limit', type=int, help='replay only the first requests')
+    parser.add_argument('--concurrency', type=int, default=64, help='requests in flight at most')
+    parser.add_argument('--target', help='base URL of a running instance, instead of a local one')
+    parser.add_argument('--upstream-ms', default='db=2,globus=30,aws=20,github=50',
+                        help='latency of each stubbed upstream')
+    parser.add_argument('--servables', type=int, default=500, help='servables in the stubbed catalogue')
+    parser.add_argument('--no-rate-limit', action='store_true', help='disable rate limiting in the local instance')
+    parser.add_argument('--output', help='write every result to this JSONL file')
+    args = parser.parse_args()
+
+    records = load(args.trace, args.limit)
+    if not records:
+        print("No requests in {}".format(args.trace))
+        return
+
+    stdout = sys.stdout
+    if args.target:
+        base_url = args.target.rstrip('/')
+    else:
+        upstream_ms = {k: float(v) for k, v in (item.split('=') for item in args.upstream_ms.split(','))}
+        base_url, _ = serve_local(upstream_ms, args.servables, not args.no_rate_limit)
+        # The views print as they go
+        sys.stdout = io.StringIO()
+    try:
+        results, elapsed = replay(base_url, records, args.speed, args.concurrency)
+    finally:
+        sys.stdout = stdout
+
+    report(results, elapsed)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            for result in results:
+                fp.write(json.dumps(result) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+Benchmark the ZMQ broker with local dummy workers.
+
+Measures messages/sec through the broker and the latency it adds over a
+direct REQ/REP round trip. Run from the repository root:
+
+    python benchmarks/zmq_broker_bench.py --workers 4 --clients 8 --messages 2000
+"""
+import os
+import sys
+import time
+import argparse
+import threading
+
+import zmq
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from zmq_broker import ZMQBroker, ZMQWorker  # noqa: E402
+
+
+def _echo(servable, frames):
+    return frames
+
+
+def _direct_latency(messages, payload):
+    """Mean round-trip time of a REQ/REP pair with no broker in between"""
+    context = zmq.Context.instance()
+    rep = context.socket(zmq.REP)
+    port = rep.bind_to_random_port("tcp://127.0.0.1")
+
+    def serve():
+        for _ in range(messages):
+            rep.send_multipart(rep.recv_multipart(copy=False), copy=False)
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    req = context.socket(zmq.REQ)
+    req.connect("tcp://127.0.0.1:%d" % port)
+    start = time.perf_counter()
+    for _ in range(messages):
+        req.send_multipart([payload], copy=False)
+        req.recv_multipart(copy=False)
+    elapsed = time.perf_counter() - start
+    thread.join()
+    req.close(linger=0)
+    rep.close(linger=0)
+    return elapsed / messages
+
+
+def _client(address, servable, messages, payload, latencies):
+    req = zmq.Context.instance().socket(zmq.REQ)
+    req.connect(address)
+    for _ in range(messages):
+        start = time.perf_counter()
+        req.send_multipart([servable, payload], copy=False)
+        req.recv_multipart(copy=False)
+        latencies.append(time.perf_counter() - start)
+    req.close(linger=0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--messages', type=int, default=2000, help='Messages per client')
+    parser.add_argument('--payload', type=int, default=1024, help='Payload size in bytes')
+    parser.add_argument('--servables', type=int, default=2, help='Distinct servables to spread requests over')
+    args = parser.parse_args()
+
+    frontend, backend = "tcp://127.0.0.1:55000", "tcp://127.0.0.1:55001"
+    payload = os.urandom(args.payload)
+
+    broker = ZMQBroker()
+    threading.Thread(target=broker.start, kwargs={'frontend_addr': frontend, 'backend_addr': backend},
+                     daemon=True).start()
+    workers = []
+    for i in range(args.workers):
+        worker = ZMQWorker(_echo, address=backend, servables=['servable-%d' % (i % args.servables)])
+        threading.Thread(target=worker.start, daemon=True).start()
+        workers.append(worker)
+    while len(broker.workers) < args.workers:
+        time.sleep(0.01)
+
+    latencies = []
+    threads = [threading.Thread(target=_client,
+                                args=(frontend, b'servable-%d' % (i % args.servables), args.messages, payload,
+                                      latencies))
+               for i in range(args.clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    direct = _direct_latency(args.messages, payload)
+    latencies.sort()
+    total = len(latencies)
+    print("messages:        %d in %.2fs" % (total, elapsed))
+    print("throughput:      %.0f msg/s" % (total / elapsed))
+    print("latency p50:     %.1f us" % (latencies[total // 2] * 1e6))
+    print("latency p99:     %.1f us" % (latencies[int(total * 0.99)] * 1e6))
+    print("direct REQ/REP:  %.1f us" % (direct * 1e6))
+    print("added (p50):     %.1f us" % ((latencies[total // 2] - direct) * 1e6))
+
+    for worker in workers:
+        worker.stop()
+    broker.stop()
+
+
+if __name__ == '__main__':
+    main()
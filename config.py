@@ -1,6 +1,4 @@
-import psycopg2.extras
-import globus_sdk
-import psycopg2
+import threading
 import os
 
 # GlobusAuth-related secrets
@@ -8,6 +6,11 @@ SECRET_KEY = os.environ.get('secret_key')
 GLOBUS_KEY = os.environ.get('globus_key')
 GLOBUS_CLIENT = os.environ.get('globus_client')
 
+# Connection settings for the shared GlobusAuth client
+GLOBUS_HTTP_TIMEOUT = float(os.environ.get('globus_http_timeout', 30))
+GLOBUS_HTTP_RETRIES = int(os.environ.get('globus_http_retries', 3))
+GLOBUS_POOL_SIZE = int(os.environ.get('globus_pool_size', 10))
+
 # GitHub-related secrets
 GIT_TOKEN = os.environ.get('git_token')
 
@@ -21,6 +24,27 @@ DB_PASSWORD = os.environ.get('db_password')
 PUBLISH_FLOW_ARN = 'arn:aws:states:us-east-1:039706667969:stateMachine:DLHubIngestModel-3'
 PUBLISH_REPO_FLOW_ARN = 'arn:aws:states:us-east-1:039706667969:stateMachine:DLHubIngestModel-4'
 
+# ZMQ broker sidecar. Web workers on this host use IPC, compute workers connect over TCP
+BROKER_FRONTEND = os.environ.get('broker_frontend', 'ipc:///tmp/dlhub_broker.ipc')
+BROKER_BACKEND = os.environ.get('broker_backend', 'tcp://*:50001')
+BROKER_HEALTH = os.environ.get('broker_health', 'ipc:///tmp/dlhub_broker_health.ipc')
+
+# Per-user rate limiting. Set a path (e.g. under /dev/shm) to share buckets between the workers on a host
+RATE_LIMIT_STORE = os.environ.get('rate_limit_store')
+RATE_LIMIT_ENABLED = os.environ.get('rate_limit_enabled', 'true').lower() != 'false'
+
+# Server-side web sessions: 'filesystem' (files under SESSION_DIR) or 'postgres' (shared by all web hosts)
+SESSION_TYPE = os.environ.get('session_type', 'filesystem')
+SESSION_DIR = os.environ.get('session_dir', '/tmp/dlhub_sessions')
+
+# Publication scheduling: builds running at once per user, and in total (0 for no limit)
+PUBLISH_MAX_PER_USER = int(os.environ.get('publish_max_per_user', 4))
+PUBLISH_MAX_RUNNING = int(os.environ.get('publish_max_running', 0))
+
+# Sanitized API traffic traces for benchmarks/traffic_replay.py: a JSONL file, and the fraction of requests to record
+TRAFFIC_CAPTURE = os.environ.get('traffic_capture')
+TRAFFIC_CAPTURE_SAMPLE = float(os.environ.get('traffic_capture_sample', 1.0))
+
 # Whether this server is the production DLHub server
 _prod = True
 
@@ -32,6 +56,9 @@ def _get_db_connection():
         conn: Connection to database
         cur: Active cursor for querying the databases
     """
+    import psycopg2
+    import psycopg2.extras
+
     con_str = "dbname={dbname} user={dbuser} " \
               "password={dbpass} host={dbhost}".format(dbname=DB_NAME, dbuser=DB_USER,
                                                        dbpass=DB_PASSWORD, dbhost=DB_HOST)
@@ -43,17 +70,155 @@ def _get_db_connection():
     return conn, cur
 
 
-def _load_dlhub_client():
+_db = None
+_db_pid = None
+_db_lock = threading.Lock()
+
+
+def _load_db_connection():
+    """Get this process's database connection
+
+    The connection is opened on first use in each process, so it is never
+    shared across a fork, and reopened if it was closed.
+
+    Returns:
+        conn: Connection to database
+        cur: Active cursor for querying the databases
+    """
+    global _db, _db_pid
+    with _db_lock:
+        if _db is None or _db_pid != os.getpid() or _db[0].closed:
+            _db = _get_db_connection()
+            _db_pid = os.getpid()
+        return _db
+
+
+def _end_db_transaction(exc=None):
+    """Roll back whatever a request left uncommitted on this process's connection
+
+    Statements that fail inside a transaction leave it for the caller to roll
+    back, so this keeps one failed request from breaking the next.
+    """
+    db = _db if _db_pid == os.getpid() else None
+    if db is not None and not db[0].closed:
+        import psycopg2.extensions
+        if db[0].get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            db[0].rollback()
+
+
+class _LazyDBHandle:
+    """Stands in for the process's connection or cursor until it is first used"""
+
+    def __init__(self, index):
+        self._index = index
+
+    def __getattr__(self, name):
+        return getattr(_load_db_connection()[self._index], name)
+
+
+def _lazy_db_connection():
+    """Get a connection and cursor that connect to the database on first use
+
+    Lets modules hold a connection at import time without connecting until
+    a request needs it, after the server has forked its workers.
+
+    Returns:
+        conn: Connection to database
+        cur: Active cursor for querying the databases
+    """
+    return _LazyDBHandle(0), _LazyDBHandle(1)
+
+
+def _client_session(client):
+    """Get the requests session an AuthClient sends its requests with"""
+    transport = getattr(client, 'transport', None)
+    return transport.session if transport is not None else client._session
+
+
+def _set_client_session(client, session):
+    transport = getattr(client, 'transport', None)
+    if transport is not None:
+        transport.session = session
+    else:
+        client._session = session
+
+
+def _set_client_timeout(client, timeout):
+    """Set the seconds an AuthClient waits for GlobusAuth to answer"""
+    transport = getattr(client, 'transport', None)
+    if transport is not None:
+        transport.http_timeout = timeout
+    else:
+        client._http_timeout = timeout
+
+
+def _create_dlhub_client(session=None, **kwargs):
     """Create an AuthClient for the portal
 
-    No credentials are used if the server is not production
+    No credentials are used if the server is not production. The client's
+    session keeps a pool of keep-alive connections and retries failed
+    connection attempts. Requests time out after GLOBUS_HTTP_TIMEOUT seconds.
 
+    Args:
+        session (requests.Session): Session to share with another client, or None to create a pooled one
+        kwargs: Passed to the ConfidentialAppAuthClient, e.g. ``base_url``
     Returns:
         (globus_sdk.ConfidentialAppAuthClient): Client used to perform GlobusAuth actions
     """
+    import globus_sdk
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
     if _prod:
         app = globus_sdk.ConfidentialAppAuthClient(GLOBUS_CLIENT,
-                                                   GLOBUS_KEY)
+                                                   GLOBUS_KEY, **kwargs)
     else:
-        app = globus_sdk.ConfidentialAppAuthClient('', '')
+        app = globus_sdk.ConfidentialAppAuthClient('', '', **kwargs)
+
+    if session is None:
+        session = _client_session(app) or requests.Session()
+        # Only retry failures to connect, which are safe for the POSTs GlobusAuth uses
+        retries = Retry(total=GLOBUS_HTTP_RETRIES, connect=GLOBUS_HTTP_RETRIES, read=0, status=0,
+                        backoff_factor=0.2)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=GLOBUS_POOL_SIZE, max_retries=retries)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+    _set_client_session(app, session)
+    _set_client_timeout(app, GLOBUS_HTTP_TIMEOUT)
     return app
+
+
+_dlhub_client = None
+_dlhub_client_pid = None
+_dlhub_client_lock = threading.Lock()
+
+
+def _load_dlhub_client():
+    """Get the shared AuthClient for the portal
+
+    The client is created once per process, after any fork, and reused so
+    every request shares its pool of connections to GlobusAuth instead of
+    repeating the TLS handshake.
+
+    Returns:
+        (globus_sdk.ConfidentialAppAuthClient): Client used to perform GlobusAuth actions
+    """
+    global _dlhub_client, _dlhub_client_pid
+    with _dlhub_client_lock:
+        if _dlhub_client is None or _dlhub_client_pid != os.getpid():
+            _dlhub_client = _create_dlhub_client()
+            _dlhub_client_pid = os.getpid()
+        return _dlhub_client
+
+
+def _load_dlhub_flow_client():
+    """Create an AuthClient for an OAuth2 login flow
+
+    Login flows keep their state on the client, so each request gets its own
+    client. It still uses the shared client's connection pool.
+
+    Returns:
+        (globus_sdk.ConfidentialAppAuthClient): Client used to perform GlobusAuth actions
+    """
+    return _create_dlhub_client(session=_client_session(_load_dlhub_client()))
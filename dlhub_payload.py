@@ -0,0 +1,120 @@
+"""
+Binary payload format for servable inputs and outputs.
+
+A payload is a JSON header followed by raw buffers. Arrays and bytes in the
+object are swapped for references to a buffer, so large arrays are never
+base64- or JSON-encoded. Over ZMQ each buffer is its own frame and is sent
+and received without copying. Over HTTP the frames are packed into one body
+with ``MAGIC``, a 4-byte header length, the header, and then each buffer
+prefixed by its 8-byte length and padded to a 64-byte boundary. Decoding
+wraps the received memory with ``numpy.frombuffer`` instead of copying it.
+
+This module is shipped into servable containers beside the shim, so it only
+depends on the standard library and, for arrays, numpy.
+"""
+import json
+import struct
+
+CONTENT_TYPE = 'application/vnd.dlhub.frames'
+MAGIC = b'DLHB\x01'
+_ALIGN = 64
+
+
+def _encode(obj, buffers):
+    """Replace arrays and bytes in obj with buffer references, collecting the buffers"""
+    if isinstance(obj, dict):
+        return {k: _encode(v, buffers) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_encode(v, buffers) for v in obj]
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        buffers.append(memoryview(obj))
+        return {'__bytes__': len(buffers) - 1}
+    if hasattr(obj, '__array_interface__') and hasattr(obj, 'dtype'):
+        import numpy as np
+        if isinstance(obj, np.generic):
+            return obj.item()
+        if obj.dtype.hasobject:
+            return _encode(obj.tolist(), buffers)
+        array = np.ascontiguousarray(obj)
+        buffers.append(memoryview(array.reshape(-1).view(np.uint8)))
+        return {'__ndarray__': len(buffers) - 1, 'dtype': array.dtype.str, 'shape': list(obj.shape)}
+    return obj
+
+
+def _decode(obj, buffers):
+    if isinstance(obj, dict):
+        if '__ndarray__' in obj:
+            import numpy as np
+            array = np.frombuffer(buffers[obj['__ndarray__']], dtype=np.dtype(obj['dtype']))
+            return array.reshape(tuple(obj['shape']))
+        if '__bytes__' in obj:
+            return buffers[obj['__bytes__']]
+        return {k: _decode(v, buffers) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_decode(v, buffers) for v in obj]
+    return obj
+
+
+def encode_frames(obj):
+    """
+    Encode an object as a list of frames.
+
+    :param obj: JSON-compatible object that may contain numpy arrays and bytes
+    :return: list of frames; the first is the header, the rest are views of the original buffers
+    """
+    buffers = []
+    header = json.dumps(_encode(obj, buffers)).encode()
+    return [header] + buffers
+
+
+def decode_frames(frames):
+    """
+    Decode a list of frames made by encode_frames.
+
+    :param frames: list of bytes-like objects or zmq.Frame
+    :return: the object, with arrays backed by the frame memory
+    """
+    frames = [f.buffer if hasattr(f, 'buffer') else f for f in frames]
+    return _decode(json.loads(bytes(frames[0])), [memoryview(f) for f in frames[1:]])
+
+
+def encode_body(obj):
+    """
+    Encode an object as a single HTTP body.
+
+    :param obj: JSON-compatible object that may contain numpy arrays and bytes
+    :return: list of chunks to write in order, e.g. as a streamed response
+    """
+    frames = encode_frames(obj)
+    chunks = [MAGIC, struct.pack('<I', len(frames[0])), frames[0]]
+    offset = sum(len(c) for c in chunks)
+    for buf in frames[1:]:
+        pad = -(offset + 8) % _ALIGN
+        chunks.append(struct.pack('<Q', buf.nbytes) + b'\0' * pad)
+        chunks.append(buf)
+        offset += 8 + pad + buf.nbytes
+    return chunks
+
+
+def decode_body(body):
+    """
+    Decode an HTTP body made by encode_body.
+
+    :param body: bytes-like body
+    :return: the object, with arrays backed by the body's memory
+    """
+    view = memoryview(body)
+    if bytes(view[:len(MAGIC)]) != MAGIC:
+        raise ValueError("Not a DLHub binary payload")
+    offset = len(MAGIC)
+    (header_len,) = struct.unpack_from('<I', view, offset)
+    offset += 4
+    frames = [view[offset:offset + header_len]]
+    offset += header_len
+    while offset < len(view):
+        (size,) = struct.unpack_from('<Q', view, offset)
+        offset += 8
+        offset += -offset % _ALIGN
+        frames.append(view[offset:offset + size])
+        offset += size
+    return decode_frames(frames)
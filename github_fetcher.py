@@ -0,0 +1,253 @@
+"""
+Shared, cached access to the GitHub REST API.
+
+Used by the web service and the ingestion workers to read ``dlhub.json`` and
+the head commit of servable repositories. Responses are cached per
+repository and ref with their ETag. Repeat requests are sent as conditional
+requests, and a ``304 Not Modified`` answer does not count against the rate
+limit. All requests share one keep-alive session. When the rate limit is
+exhausted the fetcher waits for the reset if it is a few seconds away, and
+otherwise serves the cached copy or fails straight away rather than holding
+up the caller.
+"""
+import re
+import json
+import time
+import base64
+import threading
+from collections import OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+GITHUB_API = 'https://api.github.com'
+
+# Branch, tag or commit names accepted from users, a safe subset of what git check-ref-format allows
+_REF = re.compile(r'[A-Za-z0-9_][A-Za-z0-9._/+@-]*')
+
+
+def parse_repository(repository):
+    """
+    Get the ``owner/name`` of a GitHub repository URL.
+
+    :param repository: URL of the repository
+    :return: owner/name, or None if it is not a GitHub URL
+    """
+    if 'github.com' not in repository:
+        return None
+    repo = repository.split("github.com", 1)[1].lstrip("/:")
+    if repo.endswith(".git"):
+        repo = repo[:-4]
+    return repo.strip("/")
+
+
+def is_valid_ref(ref):
+    """
+    Check a user-supplied branch, tag or commit is a plain git ref name.
+
+    Refuses names that git or another command could read as an option or a
+    revision expression, and names with whitespace or control characters.
+
+    :param ref: the ref
+    :return: whether it is safe to pass on
+    """
+    return (isinstance(ref, str) and len(ref) <= 255 and bool(_REF.fullmatch(ref)) and '..' not in ref
+            and '//' not in ref and '@{' not in ref and not ref.endswith(('/', '.', '.lock')))
+
+
+class GitHubFetcher:
+    """
+    GitHub REST client with an ETag cache and rate-limit-aware retries.
+    """
+
+    def __init__(self, token=None, base_url=GITHUB_API, max_entries=1024, max_retries=3, max_wait=5,
+                 timeout=10):
+        self.base_url = base_url.rstrip('/')
+        self.max_entries = max_entries
+        self.max_retries = max_retries
+        self.max_wait = max_wait
+        self.timeout = timeout
+        self.stats = {'requests': 0, 'not_modified': 0, 'rate_limited': 0}
+
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_maxsize=10))
+        self.session.mount('http://', HTTPAdapter(pool_maxsize=10))
+        self.session.headers['Accept'] = 'application/vnd.github.v3+json'
+        if token:
+            self.session.headers['Authorization'] = 'token {}'.format(token)
+
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path, params=None):
+        """
+        GET an API path, using the cached copy if GitHub reports it unchanged.
+
+        :param path: API path, e.g. /repos/owner/name
+        :param params: query parameters
+        :return: decoded JSON, or None if it does not exist
+        """
+        url = self.base_url + path
+        key = (url, tuple(sorted((params or {}).items())))
+        with self._lock:
+            cached = self._cache.get(key)
+
+        headers = {'If-None-Match': cached[0]} if cached else {}
+        for attempt in range(self.max_retries + 1):
+            self.stats['requests'] += 1
+            resp = self.session.get(url, params=params, headers=headers, timeout=self.timeout)
+
+            if resp.status_code == 304 and cached:
+                self.stats['not_modified'] += 1
+                with self._lock:
+                    if key in self._cache:
+                        self._cache.move_to_end(key)
+                return cached[1]
+            if resp.status_code == 200:
+                data = resp.json()
+                if resp.headers.get('ETag'):
+                    self._store(key, resp.headers['ETag'], data)
+                return data
+            if resp.status_code == 404:
+                return None
+
+            wait = self._retry_after(resp, attempt)
+            if wait is None:
+                resp.raise_for_status()
+                raise requests.HTTPError("Unexpected {} response from {}".format(resp.status_code, url),
+                                         response=resp)
+            if wait > self.max_wait or attempt == self.max_retries:
+                if cached:
+                    return cached[1]
+                resp.raise_for_status()
+            time.sleep(wait)
+        return None
+
+    def _retry_after(self, resp, attempt):
+        """Seconds to wait before retrying a failed request, or None if it should not be retried"""
+        limited = resp.headers.get('X-RateLimit-Remaining') == '0' or 'Retry-After' in resp.headers
+        if resp.status_code in (403, 429) and limited:
+            self.stats['rate_limited'] += 1
+            if 'Retry-After' in resp.headers:
+                return float(resp.headers['Retry-After'])
+            return max(float(resp.headers.get('X-RateLimit-Reset', 0)) - time.time(), 0) + 1
+        if resp.status_code >= 500:
+            return 2 ** attempt
+        return None
+
+    def _store(self, key, etag, data):
+        with self._lock:
+            self._cache[key] = (etag, data)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+
+    def get_file(self, repo, path, ref=None):
+        """
+        Get the contents of a file in a repository.
+
+        :param repo: owner/name of the repository
+        :param path: path of the file
+        :param ref: branch, tag or commit, defaults to the default branch
+        :return: file contents as bytes, or None if it does not exist
+        """
+        contents = self.get('/repos/{}/contents/{}'.format(repo, path), {'ref': ref} if ref else None)
+        if not contents or 'content' not in contents:
+            return None
+        return base64.b64decode(contents['content'])
+
+    def get_json(self, repo, path='dlhub.json', ref=None):
+        """
+        Get and decode a JSON file in a repository.
+
+        :return: decoded JSON, or None if it does not exist
+        """
+        contents = self.get_file(repo, path, ref)
+        return json.loads(contents) if contents is not None else None
+
+    def get_head(self, repo, ref=None):
+        """
+        Get the commit sha a ref points to.
+
+        :param repo: owner/name of the repository
+        :param ref: branch, tag or commit, defaults to the default branch
+        :return: commit sha, or None if the repository does not exist
+        """
+        commit = self.get('/repos/{}/commits/{}'.format(repo, ref or 'HEAD'))
+        return commit['sha'] if commit else None
+
+
+class FakeGitHub:
+    """
+    A local stand-in for the GitHub REST API.
+
+    Serves files and head commits of in-memory repositories with ETags,
+    answers conditional requests with 304, and enforces a request budget
+    like GitHub's rate limit. Point a GitHubFetcher at ``url``.
+    """
+
+    def __init__(self, rate_limit=5000):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        self.repos = {}
+        self.rate_limit = rate_limit
+        self.requests = 0
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                fake._handle(self)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def add_repo(self, repo, files, sha='0' * 40):
+        """Create or replace a repository from a dict of path to contents"""
+        self.repos[repo] = {'files': files, 'sha': sha}
+
+    def close(self):
+        self.server.shutdown()
+
+    def _handle(self, handler):
+        path, _, _ = handler.path.partition('?')
+        parts = path.strip('/').split('/')
+        body = None
+        if len(parts) >= 4 and parts[0] == 'repos' and '/'.join(parts[1:3]) in self.repos:
+            repo = self.repos['/'.join(parts[1:3])]
+            if parts[3] == 'contents' and '/'.join(parts[4:]) in repo['files']:
+                content = repo['files']['/'.join(parts[4:])]
+                if isinstance(content, str):
+                    content = content.encode()
+                body = {'content': base64.b64encode(content).decode(), 'encoding': 'base64'}
+            elif parts[3] == 'commits':
+                body = {'sha': repo['sha']}
+
+        etag = '"{}"'.format(hash(json.dumps(body, sort_keys=True)) & 0xffffffff) if body else None
+        if etag and handler.headers.get('If-None-Match') == etag:
+            return self._reply(handler, 304, None, {'ETag': etag})
+
+        self.requests += 1
+        if self.requests > self.rate_limit:
+            return self._reply(handler, 403, {'message': 'API rate limit exceeded'},
+                               {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': str(int(time.time()) + 3600)})
+        if body is None:
+            return self._reply(handler, 404, {'message': 'Not Found'}, {})
+        return self._reply(handler, 200, body, {'ETag': etag})
+
+    @staticmethod
+    def _reply(handler, status, body, headers):
+        data = json.dumps(body).encode() if body is not None else b''
+        handler.send_response(status)
+        for k, v in headers.items():
+            handler.send_header(k, v)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(data)))
+        handler.end_headers()
+        handler.wfile.write(data)
@@ -0,0 +1,12 @@
+"""
+gunicorn server hooks for the DLHub web service.
+
+Passed to gunicorn with ``-c`` by gunicorn.sh and gunicorn_log_to_file.sh.
+The other settings stay on their command lines.
+"""
+
+
+def post_worker_init(worker):
+    """Warm connections and clients before the worker accepts requests"""
+    from app.warmup import prewarm
+    prewarm()
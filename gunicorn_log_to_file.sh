@@ -37,18 +37,39 @@ fi
 RUNDIR=$(dirname $SOCKFILE)
 test -d $RUNDIR || mkdir -p $RUNDIR
 
-#record PID 
-echo "$$" > $PIDFILE
+# Start the broker sidecar once per host. It outlives gunicorn restarts
+BROKER_PIDFILE=/home/ubuntu/dlhub_service/dlhub_broker.pid
+BROKER_LOG=/home/ubuntu/dlhub_service/dlhub_broker_log
+if ! (test -f "$BROKER_PIDFILE" && test -d /proc/$(<$BROKER_PIDFILE)); then
+    python $FLASKDIR/zmq_broker.py >> $BROKER_LOG 2>&1 &
+    echo "$!" > $BROKER_PIDFILE
+fi
+
+# Start the publication scheduler once per host. Schedulers on other hosts take turns with it
+SCHEDULER_PIDFILE=/home/ubuntu/dlhub_service/dlhub_scheduler.pid
+SCHEDULER_LOG=/home/ubuntu/dlhub_service/dlhub_scheduler_log
+if ! (test -f "$SCHEDULER_PIDFILE" && test -d /proc/$(<$SCHEDULER_PIDFILE)); then
+    PYTHONPATH=$FLASKDIR python -m app.api.scheduler >> $SCHEDULER_LOG 2>&1 &
+    echo "$!" > $SCHEDULER_PIDFILE
+fi
+
 
 # Start your gunicorn
+# --preload imports the app once before forking. Database, AWS and broker
+# connections are opened by each worker, and warmed by gunicorn_conf.py before
+# it takes traffic. restart_dlhub_webservice.sh reloads it with USR2
 exec gunicorn run:app -b 0.0.0.0:8080 \
+  -c $FLASKDIR/gunicorn_conf.py \
   --name $NAME \
   --workers $NUM_WORKERS \
+  --preload \
   --certfile $CERT_FILE \
   --keyfile $KEY_FILE \
   --user=$USER --group=$GROUP \
   --bind=unix:$SOCKFILE \
   --timeout 900 \
+  --graceful-timeout 900 \
+  --pid $PIDFILE \
   --access-logfile $ACCESSLOG \
   --error-logfile $ERRORLOG \
   --capture-output
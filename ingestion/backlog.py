@@ -0,0 +1,345 @@
+"""
+Backlog metrics for scaling the ingestion hosts.
+
+Two sources feed them:
+
+- Each activity monitor (publish_setup, publish_repo2docker and
+  publish_dockerize) keeps an ``ActivityMetrics``. It records how long each
+  get_activity_task long poll waited and whether it returned work, how many
+  activities are in progress and how long they took. They are written after
+  every poll to a Prometheus textfile in DLHUB_METRICS_DIR, named after the
+  activity and DLHUB_METRICS_INSTANCE. A restarted monitor replaces its
+  predecessor's file rather than leaving it behind.
+- The ``BacklogExporter`` finds the tasks that are RUNNING in the tasks table
+  and reads the tail of each one's Step Functions execution history. From it
+  the exporter works out the stage the task is in, whether the task is
+  waiting for a worker or being worked on, and since when. It reports the
+  number of tasks per stage, the oldest of them, and a histogram of their
+  time in stage. Publications still QUEUED for the scheduler are reported
+  as waiting in the ``queued`` stage, since they were queued. Run it on a
+  host with access to the database:
+
+      python ingestion/backlog.py --textfile /var/lib/node_exporter/dlhub_backlog.prom --cloudwatch
+
+Tasks waiting for a worker are the signal to scale out. Polls that come back
+empty are the signal to scale in. With ``--cloudwatch`` the exporter also
+publishes the waiting count and the oldest wait per stage to CloudWatch, under
+the DLHub/Ingestion namespace, for an autoscaling policy to track.
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+import datetime
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+METRICS_DIR = os.environ.get('DLHUB_METRICS_DIR', '/mnt/dlhub_ingest/.metrics')
+INSTANCE = os.environ.get('DLHUB_METRICS_INSTANCE', '0')
+
+# Activities of the publication flows, by the name of their stage
+STAGES = {
+    'dlhub-publish-setup-model': 'setup',
+    'dlhub-publish-repo2docker': 'repo2docker',
+    'dlhub-publish-dockerize': 'dockerize',
+}
+
+POLL_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 70)
+STAGE_BUCKETS = (30, 60, 120, 300, 600, 1800, 3600, 7200, 21600, 86400)
+
+_FINAL_EVENTS = ('ExecutionSucceeded', 'ExecutionFailed', 'ExecutionTimedOut', 'ExecutionAborted')
+
+
+class Histogram:
+    """Counts of observations under each bucket bound, in the Prometheus layout"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def render(self, name, labels):
+        lines = ['{}_bucket{} {}'.format(name, _labels(labels, le=bound), count)
+                 for bound, count in zip(self.buckets, self.counts)]
+        lines.append('{}_bucket{} {}'.format(name, _labels(labels, le='+Inf'), self.count))
+        lines.append('{}_count{} {}'.format(name, _labels(labels), self.count))
+        lines.append('{}_sum{} {}'.format(name, _labels(labels), round(self.sum, 3)))
+        return lines
+
+
+def _labels(labels, **extra):
+    labels = dict(labels, **extra)
+    return '{' + ','.join('{}="{}"'.format(k, v) for k, v in sorted(labels.items())) + '}' if labels else ''
+
+
+def write_textfile(path, lines):
+    """Atomically replace a Prometheus textfile"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'w') as fp:
+        fp.write('\n'.join(lines) + '\n')
+    os.replace(tmp, path)
+
+
+class ActivityMetrics:
+    """
+    Poll and processing metrics of one activity monitor.
+
+    :param activity: name of the stage the monitor works on
+    :param metrics_dir: directory of the textfile, or None to keep the metrics in memory
+    :param instance: tells apart monitors of the same activity on one host
+    """
+
+    def __init__(self, activity, metrics_dir=METRICS_DIR, instance=INSTANCE):
+        self.activity = activity
+        self.instance = instance
+        self.path = os.path.join(metrics_dir, '{}-{}.prom'.format(activity, instance)) if metrics_dir else None
+        self.poll_wait = Histogram(POLL_BUCKETS)
+        self.polls = {'task': 0, 'empty': 0}
+        self.durations = {'success': Histogram(STAGE_BUCKETS), 'failure': Histogram(STAGE_BUCKETS)}
+        self.in_progress = 0
+        self._lock = threading.Lock()
+
+    def polled(self, seconds, got_task):
+        """
+        Record a get_activity_task call.
+
+        :param seconds: how long the call waited
+        :param got_task: whether it returned an activity
+        """
+        with self._lock:
+            self.poll_wait.observe(seconds)
+            self.polls['task' if got_task else 'empty'] += 1
+        self.write()
+
+    @contextlib.contextmanager
+    def working(self):
+        """Record the time spent on an activity, as a failure if it raises"""
+        with self._lock:
+            self.in_progress += 1
+        self.write()
+        start = time.time()
+        outcome = 'failure'
+        try:
+            yield
+            outcome = 'success'
+        finally:
+            with self._lock:
+                self.in_progress -= 1
+                self.durations[outcome].observe(time.time() - start)
+            self.write()
+
+    def render(self):
+        labels = {'activity': self.activity, 'instance': self.instance}
+        with self._lock:
+            lines = ['# TYPE dlhub_activity_poll_wait_seconds histogram']
+            lines += self.poll_wait.render('dlhub_activity_poll_wait_seconds', labels)
+            lines.append('# TYPE dlhub_activity_polls_total counter')
+            lines += ['dlhub_activity_polls_total{} {}'.format(_labels(labels, result=k), v)
+                      for k, v in sorted(self.polls.items())]
+            lines.append('# TYPE dlhub_activity_in_progress gauge')
+            lines.append('dlhub_activity_in_progress{} {}'.format(_labels(labels), self.in_progress))
+            lines.append('# TYPE dlhub_activity_duration_seconds histogram')
+            for outcome, histogram in sorted(self.durations.items()):
+                lines += histogram.render('dlhub_activity_duration_seconds', dict(labels, outcome=outcome))
+        return lines
+
+    def write(self):
+        if self.path is None:
+            return
+        try:
+            write_textfile(self.path, self.render())
+        except OSError as e:
+            logging.error("Failed to write metrics: {}".format(e))
+
+
+def stage_of(events):
+    """
+    Work out where an execution is from the tail of its history.
+
+    :param events: history events, newest first
+    :return: (stage, state, since) where state is 'waiting' for a worker,
+        'running' or 'finished', and since is when it entered that state
+    """
+    started = None
+    for event in events:
+        kind = event['type']
+        if kind in _FINAL_EVENTS:
+            return 'finished', 'finished', event['timestamp']
+        if kind == 'ActivityStarted':
+            started = event['timestamp']
+        elif kind == 'ActivityScheduled':
+            resource = event['activityScheduledEventDetails']['resource']
+            stage = STAGES.get(resource.split(':')[-1], resource.split(':')[-1])
+            return stage, 'running' if started else 'waiting', started or event['timestamp']
+        elif kind.endswith('StateEntered'):
+            return event['stateEnteredEventDetails']['name'], 'running', event['timestamp']
+    return 'unknown', 'running', None
+
+
+def summarize(positions, now):
+    """
+    Aggregate the positions of tasks in the pipeline.
+
+    :param positions: (stage, state, since) tuples, since in epoch seconds or None
+    :param now: current epoch seconds
+    :return: dict of (stage, state) to {'tasks', 'oldest_seconds', 'time_in_stage'}
+    """
+    summary = {}
+    for stage, state, since in positions:
+        entry = summary.setdefault((stage, state), {'tasks': 0, 'oldest_seconds': 0,
+                                                    'time_in_stage': Histogram(STAGE_BUCKETS)})
+        entry['tasks'] += 1
+        if since is not None:
+            age = max(0, now - since)
+            entry['oldest_seconds'] = max(entry['oldest_seconds'], age)
+            entry['time_in_stage'].observe(age)
+    return summary
+
+
+def render_backlog(summary, by_type):
+    """Prometheus lines for a backlog summary and the RUNNING task counts by task type"""
+    lines = ['# TYPE dlhub_tasks_running gauge']
+    lines += ['dlhub_tasks_running{} {}'.format(_labels({'type': k}), v) for k, v in sorted(by_type.items())]
+    lines.append('# TYPE dlhub_backlog_tasks gauge')
+    lines += ['dlhub_backlog_tasks{} {}'.format(_labels({'stage': stage, 'state': state}), entry['tasks'])
+              for (stage, state), entry in sorted(summary.items())]
+    lines.append('# TYPE dlhub_backlog_oldest_seconds gauge')
+    lines += ['dlhub_backlog_oldest_seconds{} {}'.format(_labels({'stage': stage, 'state': state}),
+                                                         round(entry['oldest_seconds'], 1))
+              for (stage, state), entry in sorted(summary.items())]
+    lines.append('# TYPE dlhub_backlog_time_in_stage_seconds histogram')
+    for (stage, state), entry in sorted(summary.items()):
+        lines += entry['time_in_stage'].render('dlhub_backlog_time_in_stage_seconds', {'stage': stage, 'state': state})
+    return lines
+
+
+def _epoch(timestamp):
+    if isinstance(timestamp, datetime.datetime):
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+        return timestamp.timestamp()
+    return timestamp
+
+
+class BacklogExporter:
+    """
+    Positions of the RUNNING tasks in the publication flows, and of the QUEUED ones before them.
+
+    :param sfn: Step Functions client
+    :param cache_ttl: seconds an execution's position is reused before its history is read again
+    :param max_workers: concurrent history requests
+    """
+
+    def __init__(self, sfn, cache_ttl=60, max_workers=4):
+        self.sfn = sfn
+        self.cache_ttl = cache_ttl
+        self.max_workers = max_workers
+        self._positions = {}
+        self._db = None
+
+    def _fetch(self, name):
+        from config import _get_db_connection
+        from app.api import queries
+        if self._db is None or self._db[0].closed:
+            self._db = _get_db_connection()
+            self._db[0].autocommit = True
+        return queries.fetchall(self._db[1], name)
+
+    def _position(self, arn, now):
+        cached = self._positions.get(arn)
+        # An execution that finished stays finished
+        if cached and (cached[1][1] == 'finished' or now - cached[0] < self.cache_ttl):
+            return cached[1]
+        try:
+            events = self.sfn.get_execution_history(executionArn=arn, reverseOrder=True, maxResults=20)['events']
+            stage, state, since = stage_of(events)
+            position = (stage, state, _epoch(since))
+        except Exception as e:
+            logging.error("Failed to read the history of {}: {}".format(arn, e))
+            position = cached[1] if cached else ('unknown', 'running', None)
+        self._positions[arn] = (now, position)
+        return position
+
+    def collect(self):
+        """
+        Find the RUNNING tasks and where they are, and the QUEUED publications.
+
+        :return: (summary from summarize, RUNNING task count by task type)
+        """
+        now = time.time()
+        tasks = self._fetch('running_tasks')
+        by_type = {}
+        for task in tasks:
+            by_type[task['type']] = by_type.get(task['type'], 0) + 1
+
+        arns = [task['arn'] for task in tasks if task['arn']]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            positions = list(pool.map(lambda arn: self._position(arn, now), arns))
+        # Tasks not run by a flow are placed by when they were submitted
+        positions += [('none', 'running', _epoch(task['submitted'])) for task in tasks if not task['arn']]
+        # Publications the scheduler has not started yet wait in their own stage
+        positions += [('queued', 'waiting', _epoch(task['queued'])) for task in self._fetch('queued_backlog')]
+
+        for arn in set(self._positions) - set(arns):
+            del self._positions[arn]
+        return summarize(positions, now), by_type
+
+
+def publish_cloudwatch(cloudwatch, summary, namespace='DLHub/Ingestion'):
+    """Publish the waiting tasks and the oldest wait of each stage to CloudWatch"""
+    stages = set(STAGES.values()) | {stage for stage, _ in summary if stage not in ('finished', 'none', 'unknown')}
+    data = []
+    for stage in sorted(stages):
+        entry = summary.get((stage, 'waiting'), {'tasks': 0, 'oldest_seconds': 0})
+        dimensions = [{'Name': 'Stage', 'Value': stage}]
+        data.append({'MetricName': 'WaitingTasks', 'Dimensions': dimensions, 'Value': entry['tasks'],
+                     'Unit': 'Count'})
+        data.append({'MetricName': 'OldestWaitSeconds', 'Dimensions': dimensions, 'Value': entry['oldest_seconds'],
+                     'Unit': 'Seconds'})
+    for i in range(0, len(data), 20):
+        cloudwatch.put_metric_data(Namespace=namespace, MetricData=data[i:i + 20])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--textfile', default=os.path.join(METRICS_DIR, 'backlog.prom'),
+                        help='Prometheus textfile to write')
+    parser.add_argument('--cloudwatch', action='store_true', help='also publish to CloudWatch')
+    parser.add_argument('--interval', type=float, default=30, help='seconds between collections')
+    parser.add_argument('--once', action='store_true', help='collect once and exit')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+    import boto3
+    exporter = BacklogExporter(boto3.client('stepfunctions'))
+    cloudwatch = boto3.client('cloudwatch') if args.cloudwatch else None
+
+    while True:
+        try:
+            summary, by_type = exporter.collect()
+            write_textfile(args.textfile, render_backlog(summary, by_type))
+            if cloudwatch is not None:
+                publish_cloudwatch(cloudwatch, summary)
+            logging.info("Backlog: {}".format({'{}/{}'.format(*k): v['tasks'] for k, v in sorted(summary.items())}))
+        except Exception as e:
+            logging.error("Backlog collection failed: {}".format(e))
+        if args.once:
+            break
+        time.sleep(args.interval)
+
+
+if __name__ == '__main__':
+    main()
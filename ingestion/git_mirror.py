@@ -0,0 +1,138 @@
+"""
+Local cache of git mirrors for container builds.
+
+Each repository is kept as a bare mirror under the cache directory. Later
+builds only fetch new objects, and the requested ref is checked out as a
+depth-1 clone of the local mirror, so builds no longer clone from GitHub.
+Mirrors are locked while they are in use. Once the cache is over its size
+budget, the least recently used mirrors are removed.
+"""
+import os
+import time
+import fcntl
+import shutil
+import hashlib
+import logging
+import subprocess
+from contextlib import contextmanager
+
+from github_fetcher import is_valid_ref
+
+logger = logging.getLogger(__name__)
+
+GIT_TIMEOUT = 1800
+
+
+def _git(*args, cwd=None):
+    """Run a git command and return its stripped stdout"""
+    result = subprocess.run(['git'] + list(args), cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            timeout=GIT_TIMEOUT, check=True)
+    return result.stdout.decode().strip()
+
+
+def _dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class GitMirrorCache:
+    """
+    Bare git mirrors of the repositories that have been built, evicted by last use and size.
+    """
+
+    def __init__(self, root, max_mb=20480):
+        self.root = root
+        self.max_bytes = max_mb * 2 ** 20
+
+    def _mirror_path(self, url):
+        url = url.rstrip('/')
+        if url.endswith('.git'):
+            url = url[:-4]
+        name = url.rsplit('/', 1)[-1]
+        return os.path.join(self.root, '{}-{}.git'.format(name, hashlib.sha1(url.encode()).hexdigest()[:16]))
+
+    @contextmanager
+    def _lock(self, path, blocking=True):
+        """Hold an exclusive lock on a mirror, yielding False if it is busy and blocking is off"""
+        with open(path + '.lock', 'w') as fp:
+            try:
+                fcntl.flock(fp, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+
+    def _update(self, url, path):
+        """Create the mirror of a repository, or fetch what changed since it was last used"""
+        if os.path.exists(os.path.join(path, 'HEAD')):
+            logger.debug("Fetching into mirror {}".format(path))
+            _git('remote', 'update', '--prune', cwd=path)
+        else:
+            logger.debug("Creating mirror {}".format(path))
+            shutil.rmtree(path, ignore_errors=True)
+            _git('clone', '--mirror', '--', url, path)
+            # Lets the shallow checkouts fetch any commit, not only branch and tag tips
+            _git('config', 'uploadpack.allowAnySHA1InWant', 'true', cwd=path)
+        os.utime(path)
+
+    def checkout(self, url, dest, ref=None):
+        """
+        Check out a repository at a ref, using and refreshing its local mirror.
+
+        :param url: URL of the repository
+        :param dest: directory to check it out into, must not exist yet
+        :param ref: branch, tag or commit, defaults to the default branch
+        :return: the sha of the checked out commit
+        :raises ValueError: if the ref is not a plain branch, tag or commit name
+        """
+        if ref is not None and not is_valid_ref(ref):
+            raise ValueError("Invalid ref {!r}".format(ref))
+        os.makedirs(self.root, exist_ok=True)
+        path = self._mirror_path(url)
+        with self._lock(path):
+            self._update(url, path)
+            # rev-parse reads anything after -- as a path, so --end-of-options keeps the ref from being an option
+            sha = _git('rev-parse', '--verify', '--end-of-options', '{}^{{commit}}'.format(ref or 'HEAD'), cwd=path)
+
+            os.makedirs(dest)
+            _git('init', '-q', cwd=dest)
+            _git('fetch', '-q', '--depth', '1', 'file://' + os.path.abspath(path), sha, cwd=dest)
+            _git('checkout', '-q', sha, cwd=dest)
+            _git('remote', 'add', 'origin', url, cwd=dest)
+        self.evict()
+        return sha
+
+    def evict(self):
+        """
+        Remove the least recently used mirrors until the cache fits its budget.
+
+        Mirrors in use by another build are skipped. Lock files are left in
+        place: removing one would let a build that already opened it lock a
+        file no other build can see.
+        """
+        mirrors = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name.endswith('.git') and os.path.isdir(path):
+                mirrors.append((os.stat(path).st_mtime, _dir_size(path), path))
+
+        total = sum(m[1] for m in mirrors)
+        for _, size, path in sorted(mirrors):
+            if total <= self.max_bytes:
+                break
+            with self._lock(path, blocking=False) as locked:
+                if not locked:
+                    continue
+                logger.info("Evicting mirror {} ({} MB, unused for {:.0f}s)".format(
+                    path, size // 2 ** 20, time.time() - os.stat(path).st_mtime))
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
@@ -2,7 +2,7 @@ import boto3
 import json
 import subprocess
 import os
-import mdf_toolbox
+import time
 import urllib
 import logging
 import globus_sdk
@@ -14,7 +14,13 @@ from funcx.sdk.client import FuncXClient
 from identifiers_client.identifiers_api import identifiers_client, IdentifierClient
 from identifiers_client.config import config
 
+from search_queue import SearchIngestQueue
+from reclaimer import reclaimer
+from backlog import ActivityMetrics
+
 client = boto3.client('stepfunctions')
+metrics = ActivityMetrics('dockerize')
+search_queue = SearchIngestQueue()
 
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.DEBUG, filename='publish_dockerize.log')
 
@@ -24,9 +30,20 @@ def dockerize(task, client):
     Use the singularity container to preprocess the data 
     """
 
+    # An identical servable was built before: point at its image and function
+    reuse = task['dlhub'].get('reuse')
+    if reuse:
+        logging.info("Reusing image and function of {}".format(reuse['servable_uuid']))
+        task['dlhub']['ecr_uri'] = reuse['ecr_uri']
+        task['dlhub']['ecr_arn'] = reuse['ecr_arn']
+        task['dlhub']['funcx_id'] = reuse['funcx_id']
+        task['dlhub'].pop('funcx_token', None)
+        return task
+
     location = task['dlhub']['build_location']
     uuid = task['dlhub']['id']
 
+    reclaimer.track(uuid, images=[uuid])
     os.chdir(location)
     # Start the process
     # 1. build the container
@@ -57,6 +74,7 @@ def dockerize(task, client):
         ecr_arn = response['repository']['repositoryArn']
         ecr_uri = response['repository']['repositoryUri']
     logging.info("Got ECR repo: %s" % ecr_uri)
+    reclaimer.track(uuid, images=['%s:latest' % ecr_uri])
 
     # # 3. Add a tag to the docker container
     logging.debug("Tagging container")
@@ -153,30 +171,52 @@ def mint_identifier(task):
 
 
 def dlhub_run(event):
-    """Invoke the DLHub servable"""
-    import json
-    import time
+    """Invoke the DLHub servable
+
+    Servables are kept warm between calls by the servable cache shipped in
+    the container. The timing part of the result is the total time, followed
+    by the time spent loading the servable, the time spent running it and,
+    for deterministic servables, the hit rate of the result cache.
+
+    If the event's ``encoding`` is the DLHub binary payload type, the inputs
+    are a body made by dlhub_payload.encode_body and the output is returned
+    in the same format. Inputs staged in S3 are passed as references and
+    fetched here. Large results are uploaded to the event's ``result_upload``
+    and returned as a reference.
+    """
+    import sys
     import os
 
     from os.path import expanduser
     path = expanduser("~")
     os.chdir(path)
-    
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
     # Check to see if event is from old client
     if 'data' in event:
         raise ValueError('Upgrade your DLHub SDK to a newer version: pip install -U dlhub_sdk')
 
-    start = time.time()
-    global shim
-    if "shim" not in globals():
-        from home_run import create_servable
-        with open("dlhub.json") as fp:
-            shim = create_servable(json.load(fp))
-    x = shim.run(event["inputs"], 
-                 debug=event.get("debug", False),
-                 parameters=event.get("parameters", None))
-    end = time.time()
-    return (x, (end-start) * 1000)
+    from servable_cache import run_servable
+    inputs = event["inputs"]
+    binary = event.get("encoding") == 'application/vnd.dlhub.frames'
+    if binary:
+        from dlhub_payload import decode_body
+        inputs = decode_body(inputs)
+
+    from staged_data import resolve_references, stage_result
+    inputs = resolve_references(inputs)
+
+    res = run_servable(inputs,
+                       servable_id=event.get("servable_id", None),
+                       debug=event.get("debug", False),
+                       parameters=event.get("parameters", None))
+    if event.get("result_upload"):
+        res = (stage_result(res[0], event["result_upload"]),) + res[1:]
+    if binary:
+        from dlhub_payload import encode_body
+        res = (b''.join(encode_body(res[0])),) + res[1:]
+    return res
 
 
 def register_funcx(task):
@@ -221,83 +261,55 @@ def register_funcx(task):
     return funcx_id
 
 
-def convert_dict(data, conversion_function=str):
-    if type(data) is dict:
-        string_dict = {}
-        for k,v in data.items():
-            if type(v) is dict:
-                string_dict[k] = convert_dict(v, conversion_function)
-            elif type(v) is list:
-                string_dict[k] = [convert_dict(item, conversion_function) for item in data[k]]
-            else:
-                string_dict[k] = conversion_function(v)
-        return string_dict
-    elif type(data) is list:
-        return [convert_dict(item, conversion_function) for item in data]
-    else:
-        return conversion_function(data)
-
 def search_ingest(task):
     """
-    Ingest the servable data into a Globus Search index.
+    Queue the servable data for ingestion into a Globus Search index.
+
+    Documents are batched by the search queue and ingested together once it
+    reaches its size or time limit. The document is spooled to disk before
+    this returns, so it survives a restart of the monitor.
 
     Args:
         task (dict): the task description.
     """
-    logging.debug("Ingesting servable into Search.")
-
-#    idx = "dlhub"
-    idx = '847c9105-18a0-4ffb-8a71-03dd76dfcc9d'
-    iden = "https://dlhub.org/servables/{}".format(task['dlhub']['id'])
-    index = mdf_toolbox.translate_index(idx)
-
-    ingestable = task
-    d = [convert_dict(ingestable, str)]
-
-    glist = []
-    visible_to = task['dlhub'].get('visible_to', ['public'])
-
-    # Add public so it isn't an empty list
-    if len(visible_to) == 0:
-        visible_to = ['public']
-
-    for document in d:
-        gmeta_entry = mdf_toolbox.format_gmeta(document, visible_to, iden)
-        glist.append(gmeta_entry)
-    gingest = mdf_toolbox.format_gmeta(glist)
-
-    ingest_client = mdf_toolbox.login(services=["search_ingest"],no_local_server=True,no_browser=True)["search_ingest"]
-    logging.info("ingesting to search")
-    logging.info(gingest)
-    ingest_client.ingest(idx, gingest)
-    logging.info("Ingestion of {} to DLHub servables complete".format(iden))
+    logging.debug("Queueing servable for Search ingestion.")
+    search_queue.add(task)
 
 
 def monitor():
     """
     Pull jobs from the step function as the preprocess activity
     """
+    search_queue.start()
+    reclaimer.start()
     while True:
         try:
+            reclaimer.wait_for_space()
+            start = time.time()
             response = client.get_activity_task(
                 activityArn='arn:aws:states:us-east-1:039706667969:activity:dlhub-publish-dockerize',
                 workerName='dockerize-activity'
             )
+            metrics.polled(time.time() - start, bool(response['taskToken']))
 
             if response['taskToken']:
                 data = response['input']
                 try:
                     data = json.loads(data)
-                    out = dockerize(data, client)
+                    with metrics.working():
+                        out = dockerize(data, client)
                     try:
                         ingest_output = search_ingest(out)
                     except Exception as e:
-                        logging.debug("Failed to ingest to search. {}".format(e))
+                        logging.error("Failed to queue for search ingestion. {}".format(e))
                     logging.debug("Reporting success")
                     logging.debug(out)
                     client.send_task_success(taskToken=response['taskToken'], output=json.dumps(out))
+                    reclaimer.finish(out['dlhub']['id'])
                 except Exception as e:
                     logging.error("Reporting failure")
+                    if isinstance(data, dict):
+                        reclaimer.finish(data.get('dlhub', {}).get('id'), success=False)
                     client.send_task_failure(taskToken=response['taskToken'], error='FAILED', cause=str(e))
             else:
                 logging.debug(".")
@@ -4,41 +4,45 @@ import json
 import uuid
 import time
 import boto3
-import base64
+import shutil
 import logging
 import subprocess
 
-from github import Github
 from string import Template
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config import GIT_TOKEN  # noqa: E402
+from github_fetcher import GitHubFetcher, is_valid_ref, parse_repository  # noqa: E402
+from git_mirror import GitMirrorCache  # noqa: E402
+from reclaimer import reclaimer  # noqa: E402
+from backlog import ActivityMetrics  # noqa: E402
+
 client = boto3.client('stepfunctions')
+metrics = ActivityMetrics('repo2docker')
 
 BASE_WORKING_DIR = '/mnt/dlhub_ingest/'
 IMAGE_HOME = '/home/ubuntu/'
+GIT_MIRROR_DIR = os.environ.get('DLHUB_GIT_MIRRORS', os.path.join(BASE_WORKING_DIR, 'mirrors'))
+GIT_MIRROR_MB = float(os.environ.get('DLHUB_GIT_MIRRORS_MB', 20480))
+
+mirrors = GitMirrorCache(GIT_MIRROR_DIR, GIT_MIRROR_MB)
+github = GitHubFetcher(GIT_TOKEN)
 
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.DEBUG, filename='publish_repo2docker.log')
 
 
-def _get_dlhub_file(repository):
+def _get_dlhub_file(repository, ref=None):
     """
     Use the github rest api to ensure the dlhub.json file exists.
 
     :param repository:
+    :param ref: branch, tag or commit to read it from, defaults to the default branch
     :return:
     """
 
-    token = '83a6cb9912fcd3f7e2b03997b9893fc22e1cd4bd'
-
-    repo = repository.replace("https://github.com/", "")
-    repo = repo.replace(".git", "")
-
     try:
-        g = Github(token)
-        r = g.get_repo(repo)
-        contents = r.get_contents("dlhub.json")
-        decoded = base64.b64decode(contents.content)
-        return json.loads(decoded)
-    except:
+        return github.get_json(parse_repository(repository), "dlhub.json", ref)
+    except Exception:
         return None
 
 
@@ -75,6 +79,10 @@ RUN pip install git+git://github.com/DLHub-Argonne/home_run.git
         with open("{}/apps.py".format(working_dir), 'w') as new_shim:
             new_shim.write(shim_content)
 
+    for helper in ('servable_cache.py', 'result_cache.py', 'staged_data.py'):
+        shutil.copy('../templates/' + helper, working_dir)
+    shutil.copy('../../dlhub_payload.py', working_dir)
+
 
 def ingest(task, client):
     """
@@ -107,6 +115,12 @@ def ingest(task, client):
     task['dlhub']['user_id'] = task['user_id']
     task['dlhub']['shorthand_name'] = task['shorthand_name']
 
+    # An identical servable was built before, so its container is reused
+    if task['dlhub'].get('reuse'):
+        logging.info("Reusing build of {}".format(task['dlhub']['reuse']['servable_uuid']))
+        task['dlhub']['build_location'] = None
+        return task
+
     working_name = "{0}-{1}".format(servable_uuid, str(time.time()).split(".")[0])
     working_dir = ("%s/%s" % (BASE_WORKING_DIR, working_name)).replace("//", "/")
     working_image = "{0}-img".format(working_name)
@@ -115,12 +129,29 @@ def ingest(task, client):
 
     _configure_build_env(servable_uuid, working_dir, working_image)
 
+    # Check the repository out of the local mirror rather than cloning it from GitHub
+    source = repo
+    source_dir = "{}-src".format(working_dir)
+    reclaimer.track(servable_uuid, paths=[working_dir, source_dir], images=[working_image])
+    try:
+        sha = mirrors.checkout(repo, source_dir, task.get('ref'))
+        logging.info("Checked out {} at {}".format(repo, sha))
+        source = source_dir
+    except Exception as e:
+        logging.error("Failed to check out {} from mirror: {}".format(repo, e))
+        shutil.rmtree(source_dir, ignore_errors=True)
+
     logging.debug('running repo2docker')
-    # Use repo2docker to build the container
-    cmd = "jupyter-repo2docker --no-run --image-name {0} {1}".format(working_image,
-                                                                     repo)
+    # Use repo2docker to build the container. Without the mirror it clones the requested ref itself
+    cmd = ['jupyter-repo2docker', '--no-run']
+    if source == repo and task.get('ref'):
+        if not is_valid_ref(task['ref']):
+            raise ValueError("Invalid ref {!r}".format(task['ref']))
+        cmd.append('--ref={}'.format(task['ref']))
+    cmd += ['--image-name', working_image, source]
     logging.info("Repo2docker: {}".format(cmd))
-    subprocess.call(cmd.split(" "))
+    subprocess.call(cmd)
+    shutil.rmtree(source_dir, ignore_errors=True)
 
     task['dlhub']['build_location'] = working_dir
 
@@ -134,24 +165,31 @@ def monitor():
     # ingest({'repository': 'https://github.com/ryanchard/test_repo2docker.git'}, '')
     # return
 
+    reclaimer.start()
     while True:
         try:
+            reclaimer.wait_for_space()
+            start = time.time()
             response = client.get_activity_task(
                 activityArn='arn:aws:states:us-east-1:039706667969:activity:dlhub-publish-repo2docker',
                 workerName='setup-activity'
             )
+            metrics.polled(time.time() - start, bool(response['taskToken']))
 
             if response['taskToken']:
                 data = response['input']
                 try:
                     data = json.loads(data)
                     logging.debug(data)
-                    out = ingest(data, client)
+                    with metrics.working():
+                        out = ingest(data, client)
                     logging.debug("Reporting success")
                     logging.debug(out)
                     client.send_task_success(taskToken=response['taskToken'], output=json.dumps(out))
                 except Exception as e:
                     logging.debug("Reporting failure")
+                    if isinstance(data, dict):
+                        reclaimer.finish(data.get('dlhub', {}).get('id'), success=False)
                     client.send_task_failure(taskToken=response['taskToken'], error='FAILED', cause=str(e))
             else:
                 logging.debug(".")
@@ -4,19 +4,27 @@ import json
 import uuid
 import time
 import boto3
-import base64
+import shutil
 import logging
 import zipfile
 import subprocess
 
-from github import Github
 from string import Template
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config import GIT_TOKEN  # noqa: E402
+from github_fetcher import GitHubFetcher, parse_repository  # noqa: E402
+from reclaimer import reclaimer  # noqa: E402
+from backlog import ActivityMetrics  # noqa: E402
+
 client = boto3.client('stepfunctions')
+metrics = ActivityMetrics('setup')
 
 BASE_WORKING_DIR = '/mnt/dlhub_ingest/'
 IMAGE_HOME = '/home/ubuntu/'
 
+github = GitHubFetcher(GIT_TOKEN)
+
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.DEBUG, filename='publish_setup.log')
 
 def _get_dlhub_file(repository):
@@ -27,18 +35,9 @@ def _get_dlhub_file(repository):
     :return:
     """
 
-    token = '83a6cb9912fcd3f7e2b03997b9893fc22e1cd4bd'
-
-    repo = repository.replace("https://github.com/", "")
-    repo = repo.replace(".git", "")
-
     try:
-        g = Github(token)
-        r = g.get_repo(repo)
-        contents = r.get_contents("dlhub.json")
-        decoded = base64.b64decode(contents.content)
-        return json.loads(decoded)
-    except:
+        return github.get_json(parse_repository(repository), "dlhub.json")
+    except Exception:
         return None
 
 
@@ -146,6 +145,10 @@ RUN pip install git+https://github.com/DLHub-Argonne/home_run.git
         with open("{}/apps.py".format(working_dir), 'w') as new_shim:
             new_shim.write(shim_content)
 
+    for helper in ('servable_cache.py', 'result_cache.py', 'staged_data.py'):
+        shutil.copy('templates/' + helper, working_dir)
+    shutil.copy('../dlhub_payload.py', working_dir)
+
     with open("%s/dlhub.json" % (working_dir), 'w') as dlhub_file:
         dlhub_file.write(json.dumps(dlhub_json_file))
 
@@ -185,9 +188,19 @@ def ingest(task, client):
         logging.debug('continuing')
     logging.debug(task)
 
+    # An identical servable was built before, so its container is reused
+    if task['dlhub'].get('reuse'):
+        logging.info("Reusing build of {}".format(task['dlhub']['reuse']['servable_uuid']))
+        task['dlhub']['build_location'] = None
+        return task
+
     working_name = "{0}-{1}".format(servable_uuid, str(time.time()).split(".")[0])
     working_dir = ("%s/%s" % (BASE_WORKING_DIR, working_name)).replace("//", "/")
     working_image = "{0}-img".format(working_name)
+    tmp_image = "{0}-tmp".format(working_image)
+
+    uploads = [model_location] if model_location and model_location.startswith('/mnt/tmp/') else []
+    reclaimer.track(servable_uuid, paths=[working_dir] + uploads, images=[working_image, tmp_image])
 
     try:
         stage_files(model_location, working_dir)
@@ -214,8 +227,6 @@ dependencies:
   - python=3.7""")
 
 
-    tmp_image = "{0}-tmp".format(working_image)
-
     logging.debug('running repo2docker')
     # Use repo2docker to build the container
     cmd = "jupyter-repo2docker --no-run --image-name {0} {1}".format(tmp_image,
@@ -268,24 +279,31 @@ def monitor():
     # ingest({'repository': 'https://github.com/ryanchard/test_repo2docker.git'}, '')
     # return
 
+    reclaimer.start()
     while True:
         try:
+            reclaimer.wait_for_space()
+            start = time.time()
             response = client.get_activity_task(
                 activityArn='arn:aws:states:us-east-1:039706667969:activity:dlhub-publish-setup-model',
                 workerName='setup-activity'
             )
+            metrics.polled(time.time() - start, bool(response['taskToken']))
 
             if response['taskToken']:
                 data = response['input']
                 try:
                     data = json.loads(data)
                     logging.debug(data)
-                    out = ingest(data, client)
+                    with metrics.working():
+                        out = ingest(data, client)
                     logging.info("Reporting success")
                     logging.info(out)
                     client.send_task_success(taskToken=response['taskToken'], output=json.dumps(out))
                 except Exception as e:
                     logging.error("Reporting failure")
+                    if isinstance(data, dict):
+                        reclaimer.finish(data.get('dlhub', {}).get('id'), success=False)
                     logging.error(e)
                     client.send_task_failure(taskToken=response['taskToken'], error='FAILED', cause=str(e))
             else:
@@ -0,0 +1,241 @@
+import os
+import json
+import time
+import fcntl
+import atexit
+import shutil
+import logging
+import threading
+import subprocess
+
+BASE_WORKING_DIR = '/mnt/dlhub_ingest/'
+UPLOAD_DIR = '/mnt/tmp/'
+LEDGER_DIR = os.path.join(BASE_WORKING_DIR, '.artifacts')
+
+
+def _remove_path(path):
+    try:
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        elif os.path.lexists(path):
+            os.remove(path)
+    except OSError as e:
+        logging.error("Failed to remove {}: {}".format(path, e))
+
+
+def _docker(*args):
+    try:
+        subprocess.run(['docker'] + list(args), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=600)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        logging.error("Failed to run docker {}: {}".format(' '.join(args), e))
+
+
+class Reclaimer:
+    """
+    Reclaim the disk used by publications on an ingestion host.
+
+    Each publication records its build directory, uploads and docker images
+    in a small ledger file shared by the ingestion workers on the host. The
+    artifacts are removed ``grace_period`` seconds after the publication
+    succeeds or fails. Publications that never finish are removed after
+    ``stale_after`` seconds, as are uploads no publication has recorded,
+    but never the paths of a publication still running. Dangling images are pruned on every sweep. Once
+    the disk holding the build directories is more than ``high_watermark``
+    full, finished publications are reclaimed without waiting out their grace
+    period, oldest first, until usage is back under ``low_watermark``.
+    Workers call ``wait_for_space`` before polling for new activities.
+    """
+
+    def __init__(self, ledger_dir=LEDGER_DIR, grace_period=3600, stale_after=86400,
+                 high_watermark=0.85, low_watermark=0.75, upload_dir=UPLOAD_DIR):
+        self.ledger_dir = ledger_dir
+        self.grace_period = grace_period
+        self.stale_after = stale_after
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.upload_dir = upload_dir
+
+        self._thread = None
+        self._stop = threading.Event()
+
+    def _entry_path(self, servable_uuid):
+        return os.path.join(self.ledger_dir, '{}.json'.format(servable_uuid))
+
+    def _read(self, path):
+        try:
+            with open(path) as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, servable_uuid, entry):
+        os.makedirs(self.ledger_dir, exist_ok=True)
+        path = self._entry_path(servable_uuid)
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'w') as fp:
+            json.dump(entry, fp)
+        os.replace(tmp, path)
+
+    def track(self, servable_uuid, paths=(), images=()):
+        """
+        Record artifacts created for a publication.
+
+        :param servable_uuid: id of the servable being published
+        :param paths: files and directories to remove once it is done
+        :param images: docker images to remove once it is done
+        """
+        if not servable_uuid:
+            return
+        entry = self._read(self._entry_path(servable_uuid)) or {'paths': [], 'images': [], 'finished': None}
+        entry['paths'] = sorted(set(entry['paths']) | set(paths))
+        entry['images'] = sorted(set(entry['images']) | set(images))
+        entry['updated'] = time.time()
+        self._write(servable_uuid, entry)
+
+    def finish(self, servable_uuid, success=True):
+        """
+        Mark a publication as done so its artifacts are removed after the grace period.
+
+        :param servable_uuid: id of the published servable
+        :param success: whether the publication succeeded
+        """
+        if not servable_uuid:
+            return
+        entry = self._read(self._entry_path(servable_uuid))
+        if entry is None:
+            return
+        entry['finished'] = time.time()
+        entry['success'] = success
+        self._write(servable_uuid, entry)
+
+    def disk_usage(self):
+        """Fraction of the disk holding the ledger that is in use"""
+        path = os.path.dirname(self.ledger_dir.rstrip('/'))
+        while not os.path.exists(path):
+            path = os.path.dirname(path)
+        usage = shutil.disk_usage(path)
+        return usage.used / usage.total
+
+    def sweep(self, force=False):
+        """
+        Remove the artifacts of publications that are due.
+
+        :param force: also reclaim finished publications still in their grace
+            period, oldest first, until the disk is under the low watermark
+        :return: number of publications reclaimed
+        """
+        if not os.path.isdir(self.ledger_dir):
+            return 0
+
+        # One worker on the host sweeps at a time
+        with open(os.path.join(self.ledger_dir, '.lock'), 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return 0
+
+            now = time.time()
+            due, finished = [], []
+            # Paths of publications still being built, which must outlive the upload pruning
+            active = set()
+            for name in os.listdir(self.ledger_dir):
+                if not name.endswith('.json'):
+                    continue
+                path = os.path.join(self.ledger_dir, name)
+                entry = self._read(path)
+                if entry is None:
+                    continue
+                if entry['finished'] is None:
+                    if now - entry['updated'] > self.stale_after:
+                        due.append((entry['updated'], path, entry))
+                    else:
+                        active.update(os.path.normpath(p) for p in entry['paths'])
+                elif now - entry['finished'] > self.grace_period:
+                    due.append((entry['finished'], path, entry))
+                else:
+                    finished.append((entry['finished'], path, entry))
+
+            for _, path, entry in sorted(due):
+                self._reclaim(path, entry)
+            reclaimed = len(due)
+
+            if force:
+                for _, path, entry in sorted(finished):
+                    if self.disk_usage() <= self.low_watermark:
+                        break
+                    self._reclaim(path, entry)
+                    reclaimed += 1
+
+            self._prune_uploads(now, active)
+            _docker('image', 'prune', '-f')
+        return reclaimed
+
+    def _reclaim(self, path, entry):
+        logging.info("Reclaiming {}".format(os.path.basename(path)[:-5]))
+        for artifact in entry['paths']:
+            _remove_path(artifact)
+        for image in entry['images']:
+            _docker('rmi', '-f', image)
+        _remove_path(path)
+
+    def _prune_uploads(self, now, active=()):
+        """
+        Remove uploads no publication picked up within stale_after.
+
+        :param now: time of the sweep
+        :param active: normalized paths recorded by publications that are still running, kept
+            along with anything inside them or holding them
+        """
+        if not os.path.isdir(self.upload_dir):
+            return
+        for name in os.listdir(self.upload_dir):
+            path = os.path.normpath(os.path.join(self.upload_dir, name))
+            if any(path == a or a.startswith(path + os.sep) or path.startswith(a + os.sep) for a in active):
+                continue
+            try:
+                if now - os.stat(path).st_mtime > self.stale_after:
+                    _remove_path(path)
+            except OSError:
+                pass
+
+    def wait_for_space(self, poll=30):
+        """Block while the disk is over the high watermark, reclaiming space meanwhile"""
+        while self.disk_usage() > self.high_watermark:
+            logging.warning("Disk is {:.0%} full, pausing until space is reclaimed".format(self.disk_usage()))
+            self.sweep(force=True)
+            if self.disk_usage() <= self.high_watermark:
+                break
+            time.sleep(poll)
+
+    def start(self, interval=300):
+        """
+        Start a background thread that sweeps periodically.
+
+        :param interval: seconds between sweeps
+        """
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(name='reclaimer_thread', target=self._run, args=(interval,), daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Stop the background thread."""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                self.sweep(force=self.disk_usage() > self.high_watermark)
+            except Exception as e:
+                logging.error("Reclaimer sweep failed: {}".format(e))
+
+
+reclaimer = Reclaimer(grace_period=float(os.environ.get('DLHUB_GC_GRACE', 3600)),
+                      stale_after=float(os.environ.get('DLHUB_GC_STALE', 86400)),
+                      high_watermark=float(os.environ.get('DLHUB_DISK_HIGH_WATERMARK', 0.85)),
+                      low_watermark=float(os.environ.get('DLHUB_DISK_LOW_WATERMARK', 0.75)))
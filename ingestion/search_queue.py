@@ -0,0 +1,316 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+import atexit
+import logging
+import threading
+
+import mdf_toolbox
+
+SEARCH_INDEX = '847c9105-18a0-4ffb-8a71-03dd76dfcc9d'
+SPOOL_DIR = os.environ.get('DLHUB_SEARCH_SPOOL', '/mnt/dlhub_ingest/.search_queue')
+
+# Build bookkeeping that is not part of the servable's public record
+_PRIVATE_DLHUB_FIELDS = ('fingerprint', 'reuse')
+
+
+def stringify_document(data):
+    """
+    Convert every leaf of a document to a string in a single, non-recursive pass.
+
+    Containers are rebuilt so the original task is not modified, but values
+    that are already strings are reused as-is rather than converted again.
+
+    :param data: dict, list or scalar to convert
+    :return: a copy of data with all leaves as strings
+    """
+    if not isinstance(data, (dict, list)):
+        return data if isinstance(data, str) else str(data)
+
+    root = {} if isinstance(data, dict) else []
+    stack = [(data, root)]
+    while stack:
+        source, target = stack.pop()
+        items = source.items() if isinstance(source, dict) else enumerate(source)
+        for k, v in items:
+            if isinstance(v, str):
+                new_v = v
+            elif isinstance(v, (dict, list)):
+                new_v = {} if isinstance(v, dict) else []
+                stack.append((v, new_v))
+            else:
+                new_v = str(v)
+            if isinstance(target, dict):
+                target[k] = new_v
+            else:
+                target.append(new_v)
+    return root
+
+
+def _login_search_client():
+    """
+    Log in to Globus Search with the ingest scope.
+
+    :return: an authenticated search client
+    """
+    return mdf_toolbox.login(services=["search_ingest"], no_local_server=True,
+                             no_browser=True)["search_ingest"]
+
+
+class SearchIngestQueue:
+    """
+    Batch servable documents into GMetaList ingests to Globus Search.
+
+    Documents from many publications are buffered and sent in ingests of at
+    most max_batch documents once either max_batch documents are waiting or
+    the oldest one has waited max_wait seconds. One authenticated client is
+    reused for every ingest.
+
+    Each queued document is also written to ``spool_dir`` before ``add``
+    returns, and removed once it is ingested. ``start`` takes a lock on the
+    spool and queues the documents a process that died left in it, so only
+    one flusher replays a shared spool. A failed ingest is retried after an
+    exponentially growing delay, up to ``max_backoff``. A document whose
+    ingest has failed ``max_attempts`` times is moved to the ``failed``
+    directory under the spool for manual ingestion. At most ``max_pending``
+    documents are queued; ``add`` raises when the queue is full.
+    """
+
+    def __init__(self, index=SEARCH_INDEX, max_batch=50, max_wait=30, client_factory=_login_search_client,
+                 spool_dir=SPOOL_DIR, max_pending=1000, max_attempts=8, backoff=5, max_backoff=600):
+        self.index = index
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.client_factory = client_factory
+        self.spool_dir = spool_dir
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self._client = None
+        # (spool file name, gmeta entry, failed attempts) tuples
+        self._pending = []
+        self._oldest = None
+        self._failures = 0
+        self._retry_at = 0
+        self._lock = threading.Lock()
+        self._spool_lock = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def client(self):
+        """The shared search client, created on first use."""
+        if self._client is None:
+            self._client = self.client_factory()
+        return self._client
+
+    def recover(self):
+        """
+        Queue the documents left in the spool by an earlier process.
+
+        Nothing is recovered if another process holds the spool lock.
+
+        :return: number of documents recovered
+        """
+        if not self.spool_dir:
+            return 0
+        if self._spool_lock is None:
+            os.makedirs(self.spool_dir, exist_ok=True)
+            fp = open(os.path.join(self.spool_dir, '.lock'), 'w')
+            try:
+                fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                fp.close()
+                logging.info("Search spool is replayed by another process")
+                return 0
+            self._spool_lock = fp
+
+        with self._lock:
+            known = {name for name, _, _ in self._pending}
+        recovered = []
+        for name in sorted(os.listdir(self.spool_dir)):
+            if not name.endswith('.json') or name in known:
+                continue
+            try:
+                with open(os.path.join(self.spool_dir, name)) as fp:
+                    recovered.append((name, json.load(fp), 0))
+            except (OSError, ValueError) as e:
+                logging.error("Failed to read spooled search document {}: {}".format(name, e))
+        if recovered:
+            with self._lock:
+                if not self._pending:
+                    self._oldest = time.time()
+                self._pending = recovered + self._pending
+            logging.info("Recovered {} spooled search documents".format(len(recovered)))
+        return len(recovered)
+
+    def _spool(self, entry):
+        if not self.spool_dir:
+            return None
+        os.makedirs(self.spool_dir, exist_ok=True)
+        name = '{}-{}.json'.format(time.time_ns(), uuid.uuid4().hex)
+        path = os.path.join(self.spool_dir, name)
+        with open(path + '.tmp', 'w') as fp:
+            json.dump(entry, fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(path + '.tmp', path)
+        return name
+
+    def _unspool(self, names, target=None):
+        for name in names:
+            if name is None:
+                continue
+            path = os.path.join(self.spool_dir, name)
+            try:
+                if target is None:
+                    os.remove(path)
+                else:
+                    os.makedirs(target, exist_ok=True)
+                    os.replace(path, os.path.join(target, name))
+            except OSError as e:
+                logging.error("Failed to clear spooled search document {}: {}".format(name, e))
+
+    def add(self, task):
+        """
+        Queue the servable described by a task for ingestion.
+
+        The document is on disk when this returns.
+
+        :param task: dict of the published task
+        :return: number of documents ingested if this triggered a flush, otherwise 0
+        """
+        iden = "https://dlhub.org/servables/{}".format(task['dlhub']['id'])
+        visible_to = task['dlhub'].get('visible_to', ['public'])
+
+        # Add public so it isn't an empty list
+        if len(visible_to) == 0:
+            visible_to = ['public']
+
+        document = dict(task, dlhub={k: v for k, v in task['dlhub'].items() if k not in _PRIVATE_DLHUB_FIELDS})
+        entry = mdf_toolbox.format_gmeta(stringify_document(document), visible_to, iden)
+        with self._lock:
+            if len(self._pending) >= self.max_pending:
+                raise RuntimeError("Search ingest queue is full ({} documents)".format(len(self._pending)))
+            name = self._spool(entry)
+            if not self._pending:
+                self._oldest = time.time()
+            self._pending.append((name, entry, 0))
+            full = len(self._pending) >= self.max_batch
+        logging.debug("Queued {} for search ingestion".format(iden))
+
+        if full and time.time() >= self._retry_at:
+            return self.flush()
+        return 0
+
+    def due(self):
+        """Whether the queue has reached its size or time limit, and is not backing off."""
+        with self._lock:
+            if not self._pending or time.time() < self._retry_at:
+                return False
+            return len(self._pending) >= self.max_batch or time.time() - self._oldest >= self.max_wait
+
+    def flush(self):
+        """
+        Ingest all queued documents, in GMetaLists of at most max_batch documents.
+
+        If an ingest fails, its documents and those not sent yet are returned
+        to the queue and the next attempt is delayed. Documents that have
+        failed max_attempts times are moved to the dead-letter directory.
+
+        :return: number of documents ingested
+        """
+        with self._lock:
+            batch, self._pending = self._pending, []
+            oldest, self._oldest = self._oldest, None
+        ingested = 0
+        for start in range(0, len(batch), self.max_batch):
+            chunk = batch[start:start + self.max_batch]
+            gingest = mdf_toolbox.format_gmeta([entry for _, entry, _ in chunk])
+            try:
+                logging.info("Ingesting {} documents to search".format(len(chunk)))
+                self.client.ingest(self.index, gingest)
+            except Exception as e:
+                self._failed(chunk, batch[start + self.max_batch:], oldest, e)
+                return ingested
+            if self.spool_dir:
+                self._unspool([name for name, _, _ in chunk])
+            ingested += len(chunk)
+            logging.info("Ingestion of {} documents to DLHub servables complete".format(len(chunk)))
+
+        with self._lock:
+            self._failures = 0
+            self._retry_at = 0
+        return ingested
+
+    def _failed(self, chunk, unsent, oldest, error):
+        """Requeue the documents of a failed ingest, dead-lettering those out of attempts"""
+        retry, dead = [], []
+        for name, entry, attempts in chunk:
+            (dead if attempts + 1 >= self.max_attempts else retry).append((name, entry, attempts + 1))
+        with self._lock:
+            self._failures += 1
+            delay = min(self.max_backoff, self.backoff * 2 ** (self._failures - 1))
+            self._retry_at = time.time() + delay
+            self._pending = retry + unsent + self._pending
+            if self._pending:
+                self._oldest = oldest if oldest is not None else time.time()
+        logging.error("Failed to ingest to search, retrying in {:.0f}s. {}".format(delay, error))
+        if dead:
+            logging.error("Giving up on {} search documents after {} attempts".format(len(dead), self.max_attempts))
+            if self.spool_dir:
+                self._unspool([name for name, _, _ in dead], os.path.join(self.spool_dir, 'failed'))
+
+    def start(self, interval=1):
+        """
+        Recover the spool, then start a background thread that flushes the queue when it is due.
+
+        :param interval: seconds between checks of the queue
+        """
+        if self._thread is not None:
+            return
+        self.recover()
+        self._stop.clear()
+        self._thread = threading.Thread(name='search_ingest_thread', target=self._run,
+                                        args=(interval,), daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Stop the background thread and flush anything left in the queue."""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        if self._spool_lock is not None:
+            self._spool_lock.close()
+            self._spool_lock = None
+
+    def _run(self, interval):
+        while not self._stop.wait(interval):
+            if self.due():
+                self.flush()
+
+
+class FakeSearchClient:
+    """
+    A local stand-in for the Globus Search ingest client.
+
+    Records each ingest so batching can be checked without network access.
+    Pass ``client_factory=FakeSearchClient`` to SearchIngestQueue.
+    """
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.ingests = []
+
+    def ingest(self, index, gmeta):
+        if self.fail:
+            raise RuntimeError("Fake search endpoint failure")
+        self.ingests.append((index, gmeta))
+        return {'success': True, 'num_documents_ingested': len(gmeta['ingest_data']['gmeta'])}
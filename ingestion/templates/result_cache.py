@@ -0,0 +1,241 @@
+"""
+Inference result cache for deterministic servables.
+
+Copied next to apps.py in every servable container. A servable only uses the
+cache if its dlhub.json sets ``dlhub.deterministic``. Inputs are keyed by a
+content hash. Arrays are hashed in chunks from their buffers, so they are
+never serialized. Results live in a bounded in-memory LRU tier and, when
+DLHUB_RESULT_CACHE_DIR is set, spill to disk once evicted from memory.
+Results larger than the whole memory tier go straight to disk. Entries
+expire after DLHUB_RESULT_CACHE_TTL seconds. Each process tracks the size of
+the disk tier from the files present when it started plus the ones it writes.
+"""
+import os
+import time
+import pickle
+import hashlib
+import threading
+from collections import OrderedDict
+
+MEMORY_MB = float(os.environ.get('DLHUB_RESULT_CACHE_MB', 256))
+DISK_MB = float(os.environ.get('DLHUB_RESULT_CACHE_DISK_MB', 4096))
+DISK_DIR = os.environ.get('DLHUB_RESULT_CACHE_DIR')
+TTL = float(os.environ.get('DLHUB_RESULT_CACHE_TTL', 3600))
+
+_CHUNK = 4 * 2 ** 20
+
+
+def _update(h, obj):
+    """Feed a description of obj into the hash h without recursion"""
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if obj is None or isinstance(obj, (bool, int, float, complex)):
+            h.update(b'%s:%r;' % (type(obj).__name__.encode(), obj))
+        elif isinstance(obj, str):
+            data = obj.encode()
+            h.update(b'str:%d:' % len(data))
+            h.update(data)
+        elif isinstance(obj, (bytes, bytearray, memoryview)):
+            _update_buffer(h, b'bytes', memoryview(obj))
+        elif isinstance(obj, dict):
+            h.update(b'dict:%d:' % len(obj))
+            for k in sorted(obj, key=repr):
+                stack.append(obj[k])
+                stack.append(k)
+        elif isinstance(obj, (list, tuple)):
+            h.update(b'%s:%d:' % (type(obj).__name__.encode(), len(obj)))
+            stack.extend(reversed(obj))
+        elif hasattr(obj, '__array_interface__') and hasattr(obj, 'dtype'):
+            import numpy as np
+            array = np.ascontiguousarray(obj)
+            h.update(b'ndarray:%s:%r:' % (array.dtype.str.encode(), array.shape))
+            if array.dtype.hasobject:
+                h.update(pickle.dumps(array, protocol=pickle.HIGHEST_PROTOCOL))
+            else:
+                _update_buffer(h, b'', memoryview(array.reshape(-1).view(np.uint8)))
+        else:
+            h.update(pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def _update_buffer(h, tag, view):
+    h.update(b'%s%d:' % (tag, view.nbytes))
+    view = view.cast('B') if view.format != 'B' or view.ndim != 1 else view
+    for start in range(0, view.nbytes, _CHUNK):
+        h.update(view[start:start + _CHUNK])
+
+
+def content_hash(*objs):
+    """
+    Hash the contents of objects, streaming array buffers in chunks.
+
+    :param objs: objects to hash
+    :return: hex digest
+    """
+    h = hashlib.blake2b(digest_size=20)
+    for obj in objs:
+        _update(h, obj)
+    return h.hexdigest()
+
+
+class ResultCache:
+    """
+    Two-tier (memory, then optional disk) LRU cache of inference results with a TTL.
+    """
+
+    def __init__(self, memory_mb=MEMORY_MB, disk_dir=DISK_DIR, disk_mb=DISK_MB, ttl=TTL):
+        self.memory_bytes = memory_mb * 2 ** 20
+        self.disk_dir = disk_dir
+        self.disk_bytes = disk_mb * 2 ** 20
+        self.ttl = ttl
+        self.stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'expired': 0, 'spilled': 0}
+        self._memory = OrderedDict()
+        self._memory_used = 0
+        self._lock = threading.Lock()
+        # Path to size of each file in the disk tier, least recently used first
+        self._disk = OrderedDict()
+        self._disk_used = 0
+        self._disk_lock = threading.Lock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            self._scan_disk()
+
+    @property
+    def hit_rate(self):
+        """Share of lookups answered from either tier"""
+        with self._lock:
+            lookups = self.stats['hits'] + self.stats['disk_hits'] + self.stats['misses']
+            return (self.stats['hits'] + self.stats['disk_hits']) / lookups if lookups else 0
+
+    def _count(self, stat):
+        with self._lock:
+            self.stats[stat] += 1
+
+    def get(self, key):
+        """
+        Look up a result.
+
+        :param key: content hash of the request
+        :return: (found, result)
+        """
+        now = time.time()
+        with self._lock:
+            if key in self._memory:
+                expires, size, data = self._memory[key]
+                if expires > now:
+                    self._memory.move_to_end(key)
+                    self.stats['hits'] += 1
+                    return True, pickle.loads(data)
+                del self._memory[key]
+                self._memory_used -= size
+                self.stats['expired'] += 1
+
+        path = self._disk_path(key)
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'rb') as fp:
+                    expires, data = pickle.load(fp)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                expires, data = 0, None
+            if expires > now:
+                self._count('disk_hits')
+                os.utime(path)
+                with self._disk_lock:
+                    if path in self._disk:
+                        self._disk.move_to_end(path)
+                if len(data) <= self.memory_bytes:
+                    self._put_memory(key, expires, data)
+                return True, pickle.loads(data)
+            self._count('expired')
+            self._remove(path)
+
+        self._count('misses')
+        return False, None
+
+    def put(self, key, result):
+        """
+        Store a result.
+
+        :param key: content hash of the request
+        :param result: result to store; results that cannot be pickled are skipped
+        """
+        try:
+            data = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            return
+        self._put_memory(key, time.time() + self.ttl, data)
+
+    def _put_memory(self, key, expires, data):
+        spill = []
+        with self._lock:
+            if key in self._memory:
+                self._memory_used -= self._memory.pop(key)[1]
+            if len(data) > self.memory_bytes:
+                # Would push everything else out of memory, keep it on disk only
+                spill.append((key, expires, data))
+            else:
+                self._memory[key] = (expires, len(data), data)
+                self._memory_used += len(data)
+            while self._memory_used > self.memory_bytes:
+                old_key, (old_expires, size, old_data) = self._memory.popitem(last=False)
+                self._memory_used -= size
+                spill.append((old_key, old_expires, old_data))
+        for item in spill:
+            self._spill(*item)
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key + '.pkl') if self.disk_dir else None
+
+    def _spill(self, key, expires, data):
+        """Write a result evicted from memory to disk, then trim the disk tier to its budget"""
+        if not self.disk_dir or expires <= time.time():
+            return
+        path = self._disk_path(key)
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'wb') as fp:
+            pickle.dump((expires, data), fp, protocol=pickle.HIGHEST_PROTOCOL)
+            size = fp.tell()
+        os.replace(tmp, path)
+        self._count('spilled')
+        with self._disk_lock:
+            self._disk_used += size - self._disk.pop(path, 0)
+            self._disk[path] = size
+        self._trim_disk()
+
+    def _scan_disk(self):
+        """Index the files already in the disk tier, oldest first"""
+        entries = []
+        for name in os.listdir(self.disk_dir):
+            if name.endswith('.pkl'):
+                path = os.path.join(self.disk_dir, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        for _, size, path in sorted(entries):
+            self._disk[path] = size
+            self._disk_used += size
+
+    def _trim_disk(self):
+        """Remove least recently used files until the disk tier fits its budget"""
+        with self._disk_lock:
+            while self._disk_used > self.disk_bytes and self._disk:
+                path, size = self._disk.popitem(last=False)
+                self._disk_used -= size
+                self._delete(path)
+
+    def _remove(self, path):
+        with self._disk_lock:
+            self._disk_used -= self._disk.pop(path, 0)
+        self._delete(path)
+
+    @staticmethod
+    def _delete(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+cache = ResultCache()
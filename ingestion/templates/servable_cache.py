@@ -0,0 +1,191 @@
+"""
+Cache of loaded servables for the DLHub shims.
+
+Copied next to apps.py in every servable container. A container can keep
+several servables warm at once. Each servable is keyed by its DLHub id and
+loaded from ~/dlhub.json, or from ~/servables/<id>/dlhub.json when the image
+holds more than one. Servables are evicted least-recently-used once the
+memory they took to load exceeds DLHUB_SHIM_MEMORY_MB. Importing this module
+with DLHUB_PRELOAD=1 set loads every servable straight away. A worker that
+imports it at start-up then pays the load cost before its first request.
+Servables that set ``dlhub.deterministic`` reuse results through result_cache.
+"""
+import os
+import gc
+import json
+import time
+import threading
+from collections import OrderedDict
+
+MEMORY_BUDGET_MB = float(os.environ.get('DLHUB_SHIM_MEMORY_MB', 4096))
+HOME = os.path.expanduser("~")
+
+
+def _rss_mb():
+    """Resident memory of this process in MB, or 0 if it cannot be read"""
+    try:
+        with open('/proc/self/statm') as fp:
+            pages = int(fp.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+class ServableCache:
+    """
+    LRU cache of servable shims with a memory budget.
+    """
+
+    def __init__(self, memory_budget_mb=MEMORY_BUDGET_MB, home=HOME):
+        self.memory_budget_mb = memory_budget_mb
+        self.home = home
+        self.stats = {'hits': 0, 'loads': 0, 'evictions': 0}
+        self._shims = OrderedDict()
+        self._sizes = {}
+        self._aliases = {}
+        self._metadata = {}
+        # Servables being loaded, to the event set when their load ends
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def _metadata_path(self, servable_id):
+        if servable_id is not None:
+            path = os.path.join(self.home, 'servables', servable_id, 'dlhub.json')
+            if os.path.exists(path):
+                return path
+        return os.path.join(self.home, 'dlhub.json')
+
+    def available(self):
+        """
+        List the ids of servables in this container.
+
+        :return: list of servable ids
+        """
+        ids = []
+        servables_dir = os.path.join(self.home, 'servables')
+        if os.path.isdir(servables_dir):
+            ids.extend(sorted(os.listdir(servables_dir)))
+        if os.path.exists(os.path.join(self.home, 'dlhub.json')):
+            ids.append(None)
+        return ids
+
+    def get(self, servable_id=None):
+        """
+        Get a loaded servable, loading it if needed.
+
+        Servables are loaded outside the cache lock, so a slow load does not
+        hold up requests for other servables. Concurrent requests for the same
+        servable wait for a single load.
+
+        :param servable_id: id of the servable, or None for the container's default
+        :return: (shim, metadata read from its dlhub.json, load time in ms), where the load time is 0 on a hit
+        """
+        while True:
+            with self._lock:
+                key = self._aliases.get(servable_id, servable_id)
+                if key in self._shims:
+                    return self._hit(key), self._metadata[key], 0
+
+            with open(self._metadata_path(servable_id)) as fp:
+                metadata = json.load(fp)
+
+            with self._lock:
+                # Remember which servable is used for ids that fall back to the default metadata
+                key = metadata.get('dlhub', {}).get('id', servable_id)
+                self._aliases[servable_id] = key
+                if key in self._shims:
+                    return self._hit(key), self._metadata[key], 0
+                loading = self._loading.get(key)
+                if loading is None:
+                    loading = self._loading[key] = threading.Event()
+                    break
+            # Another thread is loading it. Check again once it is done, and load it here if that failed
+            loading.wait()
+
+        try:
+            from home_run import create_servable
+            start = time.time()
+            rss = _rss_mb()
+            shim = create_servable(metadata)
+            load_ms = (time.time() - start) * 1000
+        except BaseException:
+            with self._lock:
+                del self._loading[key]
+            loading.set()
+            raise
+
+        with self._lock:
+            self._shims[key] = shim
+            self._metadata[key] = metadata
+            # Approximate when other servables load at the same time
+            self._sizes[key] = max(_rss_mb() - rss, 0)
+            self.stats['loads'] += 1
+            self._evict()
+            del self._loading[key]
+        loading.set()
+        return shim, metadata, load_ms
+
+    def _hit(self, key):
+        self._shims.move_to_end(key)
+        self.stats['hits'] += 1
+        return self._shims[key]
+
+    def _evict(self):
+        """Drop least-recently-used servables until the cache fits its budget, keeping the newest"""
+        evicted = False
+        while len(self._shims) > 1 and sum(self._sizes.values()) > self.memory_budget_mb:
+            key, _ = self._shims.popitem(last=False)
+            del self._sizes[key]
+            del self._metadata[key]
+            self.stats['evictions'] += 1
+            evicted = True
+        if evicted:
+            gc.collect()
+
+    def preload(self, servable_ids=None):
+        """
+        Load servables ahead of the first request.
+
+        :param servable_ids: ids to load, defaults to every servable in the container
+        """
+        for servable_id in servable_ids if servable_ids is not None else self.available():
+            self.get(servable_id)
+
+
+cache = ServableCache()
+
+
+def run_servable(inputs, servable_id=None, **kwargs):
+    """
+    Run a servable from the cache.
+
+    :param inputs: inputs to the servable
+    :param servable_id: id of the servable, or None for the container's default
+    :param kwargs: options passed to the servable's run method
+    :return: (result, total ms, load ms, inference ms, result cache hit rate), where the hit rate is None
+        for servables that do not use the result cache
+    """
+    start = time.time()
+    shim, metadata, load_ms = cache.get(servable_id)
+
+    # Deterministic servables can reuse earlier results for identical inputs
+    key = None
+    if metadata.get('dlhub', {}).get('deterministic', False):
+        from result_cache import cache as results, content_hash
+        key = content_hash(metadata['dlhub'].get('id'), inputs, kwargs)
+        found, x = results.get(key)
+        if found:
+            return (x, (time.time() - start) * 1000, load_ms, 0, results.hit_rate)
+
+    run_start = time.time()
+    x = shim.run(inputs, **kwargs)
+    end = time.time()
+    hit_rate = None
+    if key is not None:
+        results.put(key, x)
+        hit_rate = results.hit_rate
+    return (x, (end - start) * 1000, load_ms, (end - run_start) * 1000, hit_rate)
+
+
+if os.environ.get('DLHUB_PRELOAD'):
+    cache.preload()
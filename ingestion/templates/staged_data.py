@@ -0,0 +1,266 @@
+"""
+Fetch servable inputs staged in S3 and stage large results back.
+
+Copied next to apps.py in every servable container. Clients upload large
+inputs once and pass a reference, ``{"__dlhub_ref__": <presigned GET url>}``,
+in place of the data. References are resolved with parallel ranged reads
+into a local cache. Only https URLs for the DLHub staging bucket are opened,
+and expired signatures are refused before the cache is consulted. The cache
+is keyed by the whole signed URL, so a request presenting a different
+signature never reuses another request's download. Binary DLHub payloads are
+memory-mapped from the cache rather than read into memory. When the event
+includes a ``result_upload`` and the result is larger than
+DLHUB_INLINE_RESULT_BYTES, the result is streamed to S3 with a PUT and a
+reference to it is returned instead.
+"""
+import os
+import re
+import mmap
+import time
+import hashlib
+import calendar
+import threading
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+REF_KEY = '__dlhub_ref__'
+BUCKET = os.environ.get('DLHUB_STAGING_BUCKET', 'dlhub-anl')
+CACHE_DIR = os.environ.get('DLHUB_STAGING_CACHE', os.path.join(os.path.expanduser("~"), '.dlhub_staging'))
+CACHE_MB = float(os.environ.get('DLHUB_STAGING_CACHE_MB', 8192))
+INLINE_RESULT_BYTES = int(os.environ.get('DLHUB_INLINE_RESULT_BYTES', 10 * 2 ** 20))
+CHUNK_BYTES = 8 * 2 ** 20
+MAX_PARALLEL = 8
+TIMEOUT = 60
+
+
+# Bytes in the cache as this process knows it, None until the cache is first scanned
+_cache_used = None
+_cache_lock = threading.Lock()
+
+_S3_HOST = re.compile(r'^s3([.-][a-z0-9-]+)?\.amazonaws\.com$')
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    """Fail on redirects instead of following them off the bucket"""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+_opener = urllib.request.build_opener(_NoRedirect)
+
+
+def _check_url(url):
+    """
+    Make sure a URL is a presigned https URL for an object in the staging bucket.
+
+    :param url: URL from a reference or a result upload
+    :raises ValueError: if the URL points anywhere else or its signature has expired
+    """
+    parts = urllib.parse.urlsplit(url)
+    host = parts.hostname or ''
+    if parts.scheme != 'https' or parts.netloc.lower() != host:
+        raise ValueError("Staged data must be an https URL with no port or credentials")
+    if host.startswith(BUCKET + '.'):
+        in_bucket = bool(_S3_HOST.match(host[len(BUCKET) + 1:]))
+    else:
+        in_bucket = bool(_S3_HOST.match(host)) and parts.path.startswith('/{}/'.format(BUCKET))
+    if not in_bucket:
+        raise ValueError("Staged data must be in the {} bucket".format(BUCKET))
+
+    query = urllib.parse.parse_qs(parts.query)
+    if 'X-Amz-Date' in query and 'X-Amz-Expires' in query:
+        signed = calendar.timegm(time.strptime(query['X-Amz-Date'][0], '%Y%m%dT%H%M%SZ'))
+        expires = signed + int(query['X-Amz-Expires'][0])
+    elif 'Expires' in query:
+        expires = int(query['Expires'][0])
+    else:
+        raise ValueError("Staged data URLs must be presigned")
+    if expires <= time.time():
+        raise ValueError("The presigned URL for the staged data has expired")
+
+
+def _cache_path(url):
+    """Cache file for a presigned URL, keyed by the whole URL including its signature"""
+    digest = hashlib.sha1(url.encode()).hexdigest()
+    return os.path.join(CACHE_DIR, digest)
+
+
+def _get_range(url, start, end):
+    _check_url(url)
+    req = urllib.request.Request(url, headers={'Range': 'bytes={}-{}'.format(start, end)})
+    with _opener.open(req, timeout=TIMEOUT) as resp:
+        return resp.read(), resp.headers.get('Content-Range')
+
+
+def _download(url, path):
+    """Download an object with parallel ranged GETs into path"""
+    first, content_range = _get_range(url, 0, CHUNK_BYTES - 1)
+    size = int(content_range.split('/')[-1]) if content_range else len(first)
+
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as fp:
+        fp.truncate(size)
+        fp.write(first)
+
+        def fetch(start):
+            data, _ = _get_range(url, start, min(start + CHUNK_BYTES, size) - 1)
+            os.pwrite(fp.fileno(), data, start)
+
+        with ThreadPoolExecutor(MAX_PARALLEL) as pool:
+            list(pool.map(fetch, range(len(first), size, CHUNK_BYTES)))
+    os.replace(tmp, path)
+    _trim_cache(size)
+
+
+def _trim_cache(added):
+    """
+    Account for a new cache file, and trim the cache once it is over budget.
+
+    The cache directory is only listed when this process first uses it and
+    when its running total passes the budget. Trimming then frees a tenth of
+    the budget, so a full cache is not listed again on every download. Files
+    other processes add are counted at the next listing.
+
+    :param added: size of the file just added
+    """
+    global _cache_used
+    with _cache_lock:
+        if _cache_used is None:
+            _cache_used = _scan_cache()[1]
+        else:
+            _cache_used += added
+        if _cache_used > CACHE_MB * 2 ** 20:
+            _cache_used = _evict_cache(0.9 * CACHE_MB * 2 ** 20)
+
+
+def _scan_cache():
+    """
+    List the cache files.
+
+    :return: (list of (atime, size, path), total size)
+    """
+    entries = []
+    for name in os.listdir(CACHE_DIR):
+        path = os.path.join(CACHE_DIR, name)
+        if name.endswith('.tmp'):
+            continue
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        entries.append((st.st_atime, st.st_size, path))
+    return entries, sum(e[1] for e in entries)
+
+
+def _evict_cache(target):
+    """
+    Remove the least recently used cache files until the cache fits in target bytes.
+
+    :return: size of the files left
+    """
+    entries, total = _scan_cache()
+    for _, size, path in sorted(entries):
+        if total <= target:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+    return total
+
+
+def fetch(url):
+    """
+    Get the contents of a staged object, downloading it if it is not cached.
+
+    :param url: presigned GET url of the object
+    :return: the decoded object for DLHub binary payloads, otherwise a read-only buffer of the bytes
+    :raises ValueError: if the URL is not a valid presigned URL for the staging bucket
+    """
+    _check_url(url)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    path = _cache_path(url)
+    if not os.path.exists(path):
+        _download(url, path)
+    else:
+        os.utime(path)
+
+    with open(path, 'rb') as fp:
+        if os.fstat(fp.fileno()).st_size == 0:
+            return b''
+        data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    from dlhub_payload import MAGIC, decode_body
+    if data[:len(MAGIC)] == MAGIC:
+        return decode_body(data)
+    return memoryview(data)
+
+
+def resolve_references(obj):
+    """
+    Replace staged-object references in servable inputs with their contents.
+
+    :param obj: inputs, possibly containing references
+    :return: inputs with every reference resolved
+    """
+    if isinstance(obj, dict):
+        if REF_KEY in obj:
+            return fetch(obj[REF_KEY])
+        return {k: resolve_references(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [resolve_references(v) for v in obj]
+    return obj
+
+
+def _estimate_size(obj, limit):
+    """
+    Estimate the encoded size of a result, stopping once it passes limit.
+
+    Buffers and strings count their length, other values a few bytes.
+    """
+    total = 0
+    stack = [obj]
+    while stack and total <= limit:
+        obj = stack.pop()
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple)):
+            stack.extend(obj)
+        elif isinstance(obj, (bytes, bytearray, memoryview)):
+            total += memoryview(obj).nbytes
+        elif isinstance(obj, str):
+            total += len(obj)
+        elif hasattr(obj, '__array_interface__') and hasattr(obj, 'nbytes'):
+            total += obj.nbytes
+        else:
+            total += 8
+    return total
+
+
+def stage_result(result, upload):
+    """
+    Upload a large result to S3 and return a reference to it.
+
+    :param result: output of the servable
+    :param upload: dict with a presigned ``put_url`` and the matching ``get_url``
+    :return: the result if it is small enough to return inline, otherwise a reference
+    :raises ValueError: if either URL is not a valid presigned URL for the staging bucket
+    """
+    if _estimate_size(result, INLINE_RESULT_BYTES) <= INLINE_RESULT_BYTES:
+        return result
+    _check_url(upload['put_url'])
+    _check_url(upload['get_url'])
+
+    # The chunks are views of the result's buffers, and are sent one after another without joining them
+    from dlhub_payload import encode_body
+    chunks = [memoryview(c) for c in encode_body(result)]
+    size = sum(c.nbytes for c in chunks)
+    req = urllib.request.Request(upload['put_url'], data=iter(chunks), method='PUT',
+                                 headers={'Content-Length': str(size)})
+    with _opener.open(req, timeout=TIMEOUT) as resp:
+        resp.read()
+    return {REF_KEY: upload['get_url'], 'size': size}
@@ -0,0 +1,9 @@
+-- Index of finished builds by publication fingerprint, used to skip rebuilding identical servables
+CREATE TABLE IF NOT EXISTS servable_fingerprints (
+    fingerprint text PRIMARY KEY,
+    servable_uuid text NOT NULL,
+    ecr_uri text,
+    ecr_arn text,
+    funcx_id text,
+    created timestamp NOT NULL DEFAULT now()
+);
@@ -0,0 +1,17 @@
+-- Index the task lookups made by the status endpoint
+CREATE INDEX IF NOT EXISTS tasks_uuid_idx ON tasks (uuid);
+CREATE INDEX IF NOT EXISTS invocation_logs_task_uuid_invocation_idx ON invocation_logs (task_uuid, invocation DESC);
+
+-- Large task results, kept out of the tasks table
+CREATE TABLE IF NOT EXISTS task_results (
+    task_uuid text PRIMARY KEY,
+    encoding text NOT NULL,
+    data bytea NOT NULL
+);
+
+-- Move existing large results out of the tasks table. They are stored uncompressed,
+-- new results are compressed by the application.
+INSERT INTO task_results (task_uuid, encoding, data)
+    SELECT uuid, 'identity', convert_to(result, 'UTF8') FROM tasks WHERE octet_length(result) > 65536
+    ON CONFLICT (task_uuid) DO NOTHING;
+UPDATE tasks SET result = '' WHERE octet_length(result) > 65536;
@@ -0,0 +1,8 @@
+-- Server-side sessions of the web pages, shared by every web host
+CREATE TABLE IF NOT EXISTS web_sessions (
+    sid text PRIMARY KEY,
+    data text NOT NULL,
+    expires timestamptz NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS web_sessions_expires_idx ON web_sessions (expires);
@@ -0,0 +1,2 @@
+-- The backlog exporter lists the RUNNING tasks every scrape
+CREATE INDEX IF NOT EXISTS tasks_running_idx ON tasks (uuid) WHERE status = 'RUNNING';
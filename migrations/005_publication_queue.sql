@@ -0,0 +1,8 @@
+-- Publications waiting for the scheduler, see app/api/scheduler.py
+ALTER TABLE tasks ADD COLUMN IF NOT EXISTS owner text;
+ALTER TABLE tasks ADD COLUMN IF NOT EXISTS priority smallint;
+ALTER TABLE tasks ADD COLUMN IF NOT EXISTS flow_arn text;
+ALTER TABLE tasks ADD COLUMN IF NOT EXISTS queued timestamptz;
+
+CREATE INDEX IF NOT EXISTS tasks_queued_idx ON tasks (owner, priority, queued) WHERE status = 'QUEUED';
+CREATE INDEX IF NOT EXISTS tasks_scheduled_idx ON tasks (owner) WHERE status = 'RUNNING' AND owner IS NOT NULL;
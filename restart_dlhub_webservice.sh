@@ -4,18 +4,71 @@ source /home/ubuntu/dlhub.sh
 
 PIDFILE=/home/ubuntu/dlhub_service/dlhub_web_service.pid
 FLASKDIR=/home/ubuntu/dlhub_service
+SOCKFILE=/home/ubuntu/dlhub_service/dlhub.sock
+NUM_WORKERS=3
+READY_TIMEOUT=${READY_TIMEOUT:-180}
 
 cd $FLASKDIR
 
-if test -f "$PIDFILE"; then
-    PID=$(<$PIDFILE)
-    if test -d /proc/$PID; then
-        kill $PID
-        sleep 10
-        /home/ubuntu/dlhub_service/gunicorn_log_to_file.sh >& /dev/null &
+# Wait until NUM_WORKERS workers of the gunicorn master $1 report through /readyz that they are warm.
+# A backend that is down does not hold up a deploy.
+# Old and new workers share the socket, so answers from the old master are skipped
+wait_ready() {
+    local master=$1 seen="" deadline=$((SECONDS + READY_TIMEOUT))
+    while [ $SECONDS -lt $deadline ]; do
+        worker=$(curl -sk --max-time 2 --unix-socket $SOCKFILE https://localhost/readyz | python -c "
+import sys, json
+r = json.load(sys.stdin)
+print(r['worker'] if r.get('warm') and r.get('master') == $master else '')" 2>/dev/null)
+        if [ -n "$worker" ] && [[ " $seen " != *" $worker "* ]]; then
+            seen="$seen $worker"
+            if [ $(echo $seen | wc -w) -ge $NUM_WORKERS ]; then
+                return 0
+            fi
+        fi
+        sleep 0.2
+    done
+    return 1
+}
+
+# Wait for gunicorn to write a pid other than $1 to the pid file
+wait_pid() {
+    local old=$1 pid
+    for i in $(seq 1 300); do
+        pid=$(cat $PIDFILE 2>/dev/null)
+        if [ -n "$pid" ] && [ "$pid" != "$old" ] && test -d /proc/$pid; then
+            echo $pid
+            return 0
+        fi
+        sleep 0.1
+    done
+    return 1
+}
+
+if test -f "$PIDFILE" && test -d /proc/$(<$PIDFILE); then
+    OLD=$(<$PIDFILE)
+
+    # Start a new master with the new code next to the running one. Its workers
+    # prewarm before they accept connections on the shared socket
+    kill -USR2 $OLD
+    NEW=$(wait_pid $OLD)
+    if [ -n "$NEW" ] && wait_ready $NEW; then
+        # The old master stops accepting and lets in-flight requests finish
+        kill -TERM $OLD
+        echo "Reloaded: $OLD -> $NEW"
     else
-        /home/ubuntu/dlhub_service/gunicorn_log_to_file.sh >& /dev/null &
+        echo "New workers did not become ready, keeping $OLD"
+        if [ -n "$NEW" ]; then
+            kill -TERM $NEW
+        fi
+        exit 1
     fi
+else
+    /home/ubuntu/dlhub_service/gunicorn_log_to_file.sh >& /dev/null &
+    NEW=$(wait_pid "")
+    if [ -z "$NEW" ] || ! wait_ready $NEW; then
+        echo "Web service did not become ready"
+        exit 1
+    fi
+    echo "Started: $NEW"
 fi
-
-
@@ -0,0 +1,36 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The API imports from the repository root, the ingestion workers and container helpers from their own directories
+for path in (ROOT, os.path.join(ROOT, 'ingestion'), os.path.join(ROOT, 'ingestion', 'templates')):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+
+@pytest.fixture
+def api(monkeypatch):
+    """A test client for the app, with the database, AWS and Globus Auth replaced by the traffic replay stubs"""
+    sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+    try:
+        from traffic_replay import _FakeCursor, _FakeAWS, _FakeAuth
+    finally:
+        sys.path.remove(os.path.join(ROOT, 'benchmarks'))
+    import run
+    from app.api import views, utils, fingerprint, ratelimit, capture
+
+    cur = _FakeCursor(0, 1)
+    monkeypatch.setattr(views, 'cur', cur)
+    monkeypatch.setattr(views, 'conn', cur.connection)
+    aws = _FakeAWS(0)
+    for module in (views, utils, fingerprint):
+        monkeypatch.setattr(module, '_aws_client', lambda service: aws)
+    auth = _FakeAuth(0)
+    monkeypatch.setattr(utils, '_load_dlhub_client', lambda: auth)
+    monkeypatch.setattr(views, 'dependent_tokens', auth)
+    monkeypatch.setattr(ratelimit, 'RATE_LIMIT_ENABLED', False)
+    monkeypatch.setattr(capture, 'TRAFFIC_CAPTURE', None)
+    return run.app.test_client()
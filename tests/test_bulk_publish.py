@@ -0,0 +1,76 @@
+import json
+
+import pytest
+
+from app.api import views, capture
+
+AUTH = {'Authorization': 'Bearer user'}
+
+
+def _servable(name='model'):
+    return {'dlhub': {'name': name, 'transfer_method': {'S3': 's3://dlhub-anl/{}/'.format(name)}},
+            'servable': {'type': 'Python function', 'methods': {'run': {}}}}
+
+
+@pytest.mark.parametrize('body', [
+    [_servable()],
+    {'servable': [_servable()]},
+    {'servables': _servable()},
+])
+def test_requires_a_list_of_servables(api, body):
+    res = api.post('/api/v1/publish/bulk', json=body, headers=AUTH)
+    assert res.status_code == 400
+
+
+def test_requires_a_json_body(api):
+    res = api.post('/api/v1/publish/bulk', data='not json', content_type='application/json', headers=AUTH)
+    assert res.status_code == 400
+
+
+def test_limits_the_number_of_servables(api, monkeypatch):
+    monkeypatch.setattr(views, 'MAX_BULK_PUBLISH', 2)
+    res = api.post('/api/v1/publish/bulk', json={'servables': [_servable()] * 3}, headers=AUTH)
+    assert res.status_code == 400
+
+
+def test_reports_every_invalid_servable_before_starting(api, monkeypatch):
+    started = []
+    monkeypatch.setattr(views, '_start_flows', lambda *args: started.append(args) or [])
+    no_name = _servable()
+    del no_name['dlhub']['name']
+    no_transfer = _servable()
+    del no_transfer['dlhub']['transfer_method']
+
+    res = api.post('/api/v1/publish/bulk', json={'servables': [_servable(), no_name, 'x', no_transfer]},
+                   headers=AUTH)
+
+    assert res.status_code == 400
+    body = res.get_json()
+    assert body['status'] == 'FAILED'
+    assert body['errors'] == {'1': "Missing 'dlhub.name'", '2': "Missing 'dlhub' metadata",
+                              '3': "Missing 'dlhub.transfer_method'"}
+    assert started == []
+
+
+def test_queues_valid_servables_in_order(api):
+    res = api.post('/api/v1/publish/bulk', json={'servables': [_servable('a'), _servable('b')]}, headers=AUTH)
+    assert res.status_code == 200
+    body = res.get_json()
+    assert [item['status'] for item in body] == ['QUEUED', 'QUEUED']
+    assert [item['servable'].split('/')[-1] for item in body] == ['a', 'b']
+
+
+def test_capture_does_not_change_a_rejected_request(api, monkeypatch, tmp_path):
+    path = tmp_path / 'traffic.jsonl'
+    monkeypatch.setattr(capture, 'TRAFFIC_CAPTURE', str(path))
+    monkeypatch.setattr(capture, 'TRAFFIC_CAPTURE_SAMPLE', 1)
+    monkeypatch.setattr(capture, '_file', None)
+
+    res = api.post('/api/v1/publish/bulk', json=[_servable()], headers=AUTH)
+
+    assert res.status_code == 400
+    capture._file.close()
+    entry = json.loads(path.read_text())
+    assert entry['endpoint'] == '/api/v1/publish/bulk'
+    assert entry['status'] == 400
+    assert entry['items'] == 0
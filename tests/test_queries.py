@@ -0,0 +1,121 @@
+import pytest
+
+from app.api import queries
+
+
+class DatabaseError(Exception):
+    def __init__(self, pgcode=None):
+        super().__init__(pgcode)
+        self.pgcode = pgcode
+
+
+class FakeConnection:
+    def __init__(self, status=0):
+        self.status = status
+        self.rollbacks = 0
+
+    def get_transaction_status(self):
+        return self.status
+
+    def get_backend_pid(self):
+        return 1234
+
+    def rollback(self):
+        self.rollbacks += 1
+        self.status = 0
+
+
+class FakeCursor:
+    """Records the SQL it runs and raises the queued errors from EXECUTE"""
+
+    def __init__(self, connection, errors=()):
+        self.connection = connection
+        self.errors = list(errors)
+        self.sql = []
+        self.rowcount = 0
+
+    def execute(self, sql, params=None):
+        self.sql.append(sql.split(' AS ')[0])
+        self.rowcount = -1
+        if sql.startswith('EXECUTE'):
+            if self.errors:
+                raise self.errors.pop(0)
+            self.rowcount = 1
+
+
+@pytest.fixture(autouse=True)
+def fresh_state(monkeypatch):
+    monkeypatch.setattr(queries, '_prepared', {})
+    monkeypatch.setattr(queries, 'stats', {})
+
+
+def test_prepares_each_statement_once_per_session():
+    cur = FakeCursor(FakeConnection())
+    queries.execute(cur, 'latest_task', 'abc')
+    queries.execute(cur, 'latest_task', 'abc')
+    assert cur.sql == ['PREPARE latest_task', 'EXECUTE latest_task (%s)', 'EXECUTE latest_task (%s)']
+
+
+def test_deallocated_statement_is_prepared_again_in_its_own_transaction():
+    conn = FakeConnection()
+    cur = FakeCursor(conn, [DatabaseError(queries._INVALID_SQL_STATEMENT_NAME)])
+    queries._prepared[1234] = {'latest_task', 'user_by_name'}
+
+    queries.execute(cur, 'latest_task', 'abc')
+
+    assert cur.sql == ['EXECUTE latest_task (%s)', 'PREPARE latest_task', 'EXECUTE latest_task (%s)']
+    assert conn.rollbacks == 1
+    assert queries._prepared[1234] == {'latest_task', 'user_by_name'}
+
+
+def test_deallocated_statement_in_the_callers_transaction_is_left_to_the_caller():
+    conn = FakeConnection(status=2)
+    cur = FakeCursor(conn, [DatabaseError(queries._INVALID_SQL_STATEMENT_NAME)])
+    queries._prepared[1234] = {'latest_task', 'user_by_name'}
+
+    with pytest.raises(DatabaseError):
+        queries.execute(cur, 'latest_task', 'abc')
+
+    assert cur.sql == ['EXECUTE latest_task (%s)']
+    assert conn.rollbacks == 0
+    # Only the missing statement is forgotten, so the caller's retry prepares it again
+    assert queries._prepared[1234] == {'user_by_name'}
+
+
+@pytest.mark.parametrize('status, rollbacks', [(0, 1), (2, 0)])
+def test_other_errors_roll_back_only_an_own_transaction(status, rollbacks):
+    conn = FakeConnection(status=status)
+    cur = FakeCursor(conn, [DatabaseError('23505')])
+
+    with pytest.raises(DatabaseError):
+        queries.execute(cur, 'latest_task', 'abc')
+
+    assert conn.rollbacks == rollbacks
+    assert queries._prepared[1234] == {'latest_task'}
+
+
+def test_failed_retry_rolls_back_and_raises():
+    conn = FakeConnection()
+    cur = FakeCursor(conn, [DatabaseError(queries._INVALID_SQL_STATEMENT_NAME), DatabaseError('57014')])
+
+    with pytest.raises(DatabaseError) as e:
+        queries.execute(cur, 'latest_task', 'abc')
+
+    assert e.value.pgcode == '57014'
+    assert conn.rollbacks == 2
+
+
+def test_counts_queries_and_calls_hooks():
+    calls = []
+    hook = lambda *args: calls.append(args)  # noqa: E731
+    queries.add_hook(hook)
+    try:
+        cur = FakeCursor(FakeConnection(), [DatabaseError('23505')])
+        with pytest.raises(DatabaseError):
+            queries.execute(cur, 'latest_task', 'abc')
+        queries.execute(cur, 'latest_task', 'abc')
+    finally:
+        queries.remove_hook(hook)
+
+    assert queries.stats['latest_task']['count'] == 2
+    assert [(name, rows) for name, _, rows in calls] == [('latest_task', -1), ('latest_task', 1)]
@@ -0,0 +1,76 @@
+import pytest
+from werkzeug.exceptions import HTTPException
+
+from app.api import ratelimit
+from app.api.ratelimit import LocalStore, SQLiteStore, RateLimiter
+
+
+@pytest.fixture(params=['local', 'sqlite'])
+def store(request, tmp_path):
+    return LocalStore() if request.param == 'local' else SQLiteStore(str(tmp_path / 'buckets.db'))
+
+
+def test_admits_a_burst_then_waits_for_a_token(store):
+    assert [store.take('u', 1, 3, 1, 100) for _ in range(3)] == [0, 0, 0]
+    assert store.take('u', 1, 3, 1, 100) == pytest.approx(1)
+    assert store.take('u', 1, 3, 1, 100.25) == pytest.approx(0.75)
+
+
+def test_refills_at_the_rate_up_to_the_burst(store):
+    for _ in range(3):
+        store.take('u', 2, 3, 1, 100)
+    assert store.take('u', 2, 3, 1, 100.5) == 0
+    assert store.take('u', 2, 3, 1, 100.5) == pytest.approx(0.5)
+    # A long pause refills the bucket to its burst, not beyond
+    assert [store.take('u', 2, 3, 1, 1000) for _ in range(4)][:3] == [0, 0, 0]
+    assert store.take('u', 2, 3, 1, 1000) > 0
+
+
+def test_buckets_are_per_key(store):
+    assert store.take('a', 1, 1, 1, 100) == 0
+    assert store.take('a', 1, 1, 1, 100) > 0
+    assert store.take('b', 1, 1, 1, 100) == 0
+
+
+def test_cost_over_the_burst_is_admitted_into_debt(store):
+    assert store.take('u', 1, 5, 8, 100) == 0
+    # Three tokens in debt, so the next token is four seconds away
+    assert store.take('u', 1, 5, 1, 100) == pytest.approx(4)
+    assert store.take('u', 1, 5, 1, 104) == 0
+
+
+def test_unknown_endpoints_are_not_limited():
+    limiter = RateLimiter(limits={'publish': (1, 1)})
+    assert [limiter.check('u', 'other') for _ in range(3)] == [0, 0, 0]
+
+
+def test_store_errors_fail_open():
+    class BrokenStore:
+        def take(self, *args):
+            raise OSError('disk full')
+
+    limiter = RateLimiter(limits={'publish': (1, 1)}, store=BrokenStore())
+    assert limiter.check('u', 'publish') == 0
+
+
+def test_admit_rejects_with_retry_after(monkeypatch):
+    import run
+    monkeypatch.setattr(ratelimit, 'RATE_LIMIT_ENABLED', True)
+    monkeypatch.setattr(ratelimit, 'limiter', RateLimiter(limits={'publish': (0.25, 1)}))
+
+    with run.app.test_request_context():
+        ratelimit.admit('u', 'publish')
+        with pytest.raises(HTTPException) as e:
+            ratelimit.admit('u', 'publish')
+
+    resp = e.value.response
+    assert resp.status_code == 429
+    assert resp.headers['Retry-After'] == '4'
+    assert resp.get_json()['status'] == 'FAILED'
+
+
+def test_admit_does_nothing_when_disabled(monkeypatch):
+    monkeypatch.setattr(ratelimit, 'RATE_LIMIT_ENABLED', False)
+    monkeypatch.setattr(ratelimit, 'limiter', RateLimiter(limits={'publish': (0.25, 1)}))
+    for _ in range(3):
+        ratelimit.admit('u', 'publish')
@@ -0,0 +1,188 @@
+import json
+
+import pytest
+
+from app.api import scheduler, queries
+from app.api.scheduler import FakeFlowStarter, plan
+from config import PUBLISH_MAX_PER_USER
+
+FLOW_ARN = 'arn:aws:states:us-east-1:000000000000:stateMachine:Publish'
+
+
+def _task(uuid, owner, queued, priority=0):
+    return {'uuid': uuid, 'owner': owner, 'priority': priority, 'queued': queued, 'flow_arn': FLOW_ARN,
+            'input': json.dumps({'dlhub': {'owner': owner}})}
+
+
+class FakeConnection:
+    def __init__(self):
+        self.commits = 0
+        self.rollbacks = 0
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+class FakeDatabase:
+    """Answers queries.execute from canned rows per statement, and records the statements run"""
+
+    def __init__(self, locked=True, scheduled=(), queued=()):
+        self.rows = {'try_lock': [{'locked': locked}], 'scheduled_tasks': list(scheduled),
+                     'queued_tasks': list(queued)}
+        self.calls = []
+
+    def execute(self, cur, name, *params):
+        self.calls.append((name,) + params)
+        self.result = list(self.rows.get(name, []))
+        return self
+
+    def fetchone(self):
+        return self.result[0] if self.result else None
+
+    def fetchall(self):
+        return self.result
+
+    def statements(self, *names):
+        return [call for call in self.calls if call[0] in names]
+
+
+@pytest.fixture
+def database(monkeypatch):
+    def make(**rows):
+        db = FakeDatabase(**rows)
+        monkeypatch.setattr(queries, 'execute', db.execute)
+        return db
+    return make
+
+
+def test_plan_puts_production_before_test_publications():
+    queued = [_task('test', 'a', 0, priority=1), _task('prod', 'b', 5)]
+    assert [t['uuid'] for t in plan(queued, {})] == ['prod', 'test']
+
+
+def test_plan_favours_the_owner_with_fewest_running():
+    queued = [_task('bulk-0', 'bulk', 0), _task('bulk-1', 'bulk', 1), _task('single', 'user', 10)]
+    assert [t['uuid'] for t in plan(queued, {'bulk': 1}, max_running=3)] == ['single', 'bulk-0']
+
+
+def test_plan_takes_turns_between_owners_oldest_first():
+    queued = [_task('a-1', 'a', 1), _task('a-0', 'a', 0), _task('b-0', 'b', 2), _task('b-1', 'b', 3)]
+    assert [t['uuid'] for t in plan(queued, {})] == ['a-0', 'b-0', 'a-1', 'b-1']
+
+
+def test_plan_caps_builds_per_owner():
+    queued = [_task('a-{}'.format(i), 'a', i) for i in range(5)] + [_task('b-0', 'b', 10)]
+    picked = plan(queued, {'a': 1}, max_per_user=3)
+    assert [t['uuid'] for t in picked] == ['b-0', 'a-0', 'a-1']
+
+
+def test_plan_caps_builds_in_total():
+    queued = [_task('a-0', 'a', 0), _task('b-0', 'b', 1), _task('c-0', 'c', 2)]
+    assert plan(queued, {'x': 2}, max_running=3) == [queued[0]]
+    assert plan(queued, {'x': 3}, max_running=3) == []
+    assert len(plan(queued, {'x': 3}, max_running=0)) == 3
+
+
+def test_dispatch_starts_planned_flows(database):
+    db = database(queued=[_task('t1', 'a', 0), _task('t2', 'b', 1)])
+    starter = FakeFlowStarter()
+    conn = FakeConnection()
+
+    assert scheduler.dispatch(None, conn, starter) == {'t1': 'RUNNING', 't2': 'RUNNING'}
+
+    assert [input_data for _, input_data in starter.started] == [{'dlhub': {'owner': 'a'}}, {'dlhub': {'owner': 'b'}}]
+    assert db.statements('start_queued_task') == [('start_queued_task', 't1', starter.started[0][0]),
+                                                  ('start_queued_task', 't2', starter.started[1][0])]
+    assert conn.commits == 1
+
+
+def test_dispatch_respects_running_builds(database):
+    running = [{'uuid': 'r{}'.format(i), 'owner': 'a', 'arn': 'arn-{}'.format(i)} for i in range(PUBLISH_MAX_PER_USER)]
+    database(scheduled=running, queued=[_task('t1', 'a', 0), _task('t2', 'b', 1)])
+    assert scheduler.dispatch(None, FakeConnection(), FakeFlowStarter()) == {'t2': 'RUNNING'}
+
+
+def test_dispatch_does_nothing_without_the_lock(database):
+    db = database(locked=False, queued=[_task('t1', 'a', 0)])
+    starter = FakeFlowStarter()
+    conn = FakeConnection()
+
+    assert scheduler.dispatch(None, conn, starter) == {}
+
+    assert starter.started == []
+    assert [call[0] for call in db.calls] == ['try_lock']
+    assert conn.rollbacks == 1
+
+
+class ClientError(Exception):
+    def __init__(self, code):
+        super().__init__(code)
+        self.response = {'Error': {'Code': code}}
+
+
+class FailingFlowStarter(FakeFlowStarter):
+    def __init__(self, errors):
+        super().__init__()
+        self.errors = errors
+
+    def start(self, flow_arn, input_data, name):
+        if name in self.errors:
+            raise self.errors[name]
+        return super().start(flow_arn, input_data, name)
+
+
+def test_dispatch_retries_transient_and_fails_permanent_start_errors(database):
+    db = database(queued=[_task('ok', 'a', 0), _task('throttled', 'b', 1), _task('invalid', 'c', 2),
+                          _task('bad-input', 'd', 3)])
+    starter = FailingFlowStarter({'throttled': ClientError('ThrottlingException'),
+                                  'invalid': ClientError('InvalidExecutionInput'),
+                                  'bad-input': ValueError('not JSON serializable')})
+
+    started = scheduler.dispatch(None, FakeConnection(), starter)
+
+    assert started == {'ok': 'RUNNING', 'throttled': 'QUEUED', 'invalid': 'FAILED', 'bad-input': 'FAILED'}
+    assert [call[1] for call in db.statements('fail_queued_task')] == ['invalid', 'bad-input']
+    assert [call[1] for call in db.statements('start_queued_task')] == ['ok']
+
+
+def test_dispatch_rolls_back_on_database_errors(database, monkeypatch):
+    database(queued=[_task('t1', 'a', 0)])
+    monkeypatch.setattr(scheduler, 'plan', lambda *args: 1 / 0)
+    conn = FakeConnection()
+    assert scheduler.dispatch(None, conn, FakeFlowStarter()) == {}
+    assert (conn.commits, conn.rollbacks) == (0, 1)
+
+
+def test_reconcile_frees_the_slots_of_finished_builds(database):
+    starter = FakeFlowStarter()
+    running = []
+    for i in range(PUBLISH_MAX_PER_USER):
+        arn = starter.start(FLOW_ARN, {}, 'r{}'.format(i))['executionArn']
+        running.append({'uuid': 'r{}'.format(i), 'owner': 'a', 'arn': arn})
+    starter.finish(running[0]['arn'], 'FAILED')
+    db = database(scheduled=running, queued=[_task('t1', 'a', 0)])
+
+    assert scheduler.dispatch(None, FakeConnection(), starter, reconcile=True) == {'t1': 'RUNNING'}
+
+    assert db.statements('set_task_result') == [('set_task_result', 'r0', '', 'FAILED')]
+
+
+def test_submit_only_queues(monkeypatch):
+    queued = []
+    monkeypatch.setattr(scheduler.task_store, 'queue_tasks',
+                        lambda cur, conn, flow_arn, tasks: queued.extend(tasks) or ['u1', 'u2'])
+    inputs = [{'dlhub': {'owner': 'a'}}, {'dlhub': {'owner': 'b', 'test': True}}]
+
+    res = scheduler.submit(None, None, FLOW_ARN, inputs)
+
+    assert res == [{'status': 'QUEUED', 'task_id': 'u1'}, {'status': 'QUEUED', 'task_id': 'u2'}]
+    assert queued == [(inputs[0], 'a', 0), (inputs[1], 'b', 1)]
+
+
+def test_submit_reports_a_failure_to_queue(monkeypatch):
+    monkeypatch.setattr(scheduler.task_store, 'queue_tasks', lambda *args: [])
+    res = scheduler.submit(None, None, FLOW_ARN, [{}, {}])
+    assert [item['status'] for item in res] == ['FAILED', 'FAILED']
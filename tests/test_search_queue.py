@@ -0,0 +1,130 @@
+import os
+
+import pytest
+
+search_queue = pytest.importorskip('search_queue')
+from search_queue import SearchIngestQueue, FakeSearchClient  # noqa: E402
+
+
+def _task(i):
+    return {'dlhub': {'id': 'servable-{}'.format(i), 'name': 'model', 'fingerprint': 'abc', 'reuse': {}}}
+
+
+def _queue(tmp_path, client, **kwargs):
+    kwargs.setdefault('max_batch', 3)
+    kwargs.setdefault('max_wait', 60)
+    return SearchIngestQueue(index='index', client_factory=lambda: client, spool_dir=str(tmp_path), **kwargs)
+
+
+def _spooled(tmp_path):
+    return sorted(name for name in os.listdir(str(tmp_path)) if name.endswith('.json'))
+
+
+def test_flush_ingests_in_chunks_of_max_batch(tmp_path):
+    client = FakeSearchClient()
+    queue = _queue(tmp_path, client, max_batch=100)
+    for i in range(7):
+        queue.add(_task(i))
+    queue.max_batch = 3
+
+    assert queue.flush() == 7
+    assert [len(gmeta['ingest_data']['gmeta']) for _, gmeta in client.ingests] == [3, 3, 1]
+    assert _spooled(tmp_path) == []
+
+
+def test_full_batch_flushes_on_add(tmp_path):
+    client = FakeSearchClient()
+    queue = _queue(tmp_path, client)
+    assert queue.add(_task(0)) == 0
+    assert queue.add(_task(1)) == 0
+    assert queue.add(_task(2)) == 3
+    assert len(client.ingests) == 1
+
+
+def test_private_fields_are_not_ingested(tmp_path):
+    client = FakeSearchClient()
+    queue = _queue(tmp_path, client)
+    queue.add(_task(0))
+    queue.flush()
+    document = client.ingests[0][1]['ingest_data']['gmeta'][0]['content']
+    assert 'fingerprint' not in document['dlhub']
+    assert 'reuse' not in document['dlhub']
+
+
+def test_failed_ingest_is_requeued_with_backoff(tmp_path):
+    client = FakeSearchClient(fail=True)
+    queue = _queue(tmp_path, client, backoff=5, max_backoff=8)
+    queue.add(_task(0))
+    queue.add(_task(1))
+
+    assert queue.flush() == 0
+    assert len(queue._pending) == 2
+    assert len(_spooled(tmp_path)) == 2
+    assert not queue.due()
+    first = queue._retry_at
+
+    queue.flush()
+    assert queue._retry_at > first
+    # The delay doubles up to max_backoff
+    queue.flush()
+    assert queue._retry_at - first <= 8 + 1
+
+    client.fail = False
+    assert queue.flush() == 2
+    assert queue._retry_at == 0
+    assert _spooled(tmp_path) == []
+
+
+def test_failed_chunk_requeues_the_unsent_documents(tmp_path):
+    class FailSecond(FakeSearchClient):
+        def ingest(self, index, gmeta):
+            if self.ingests:
+                raise RuntimeError("Fake search endpoint failure")
+            return super().ingest(index, gmeta)
+
+    client = FailSecond()
+    queue = _queue(tmp_path, client, max_batch=100)
+    for i in range(5):
+        queue.add(_task(i))
+    queue.max_batch = 2
+
+    assert queue.flush() == 2
+    assert [attempts for _, _, attempts in queue._pending] == [1, 1, 0]
+    assert len(_spooled(tmp_path)) == 3
+
+
+def test_documents_out_of_attempts_are_dead_lettered(tmp_path):
+    client = FakeSearchClient(fail=True)
+    queue = _queue(tmp_path, client, max_attempts=3)
+    queue.add(_task(0))
+
+    for _ in range(3):
+        queue.flush()
+
+    assert queue._pending == []
+    assert _spooled(tmp_path) == []
+    assert len(os.listdir(str(tmp_path / 'failed'))) == 1
+
+
+def test_full_queue_rejects_documents(tmp_path):
+    queue = _queue(tmp_path, FakeSearchClient(), max_batch=10, max_pending=2)
+    queue.add(_task(0))
+    queue.add(_task(1))
+    with pytest.raises(RuntimeError):
+        queue.add(_task(2))
+
+
+def test_spool_is_replayed_once(tmp_path):
+    first = _queue(tmp_path, FakeSearchClient(fail=True), max_batch=10)
+    first.add(_task(0))
+    first.add(_task(1))
+
+    client = FakeSearchClient()
+    replay = _queue(tmp_path, client, max_batch=10)
+    assert replay.recover() == 2
+    # Another process finds the spool locked and leaves it alone
+    assert _queue(tmp_path, FakeSearchClient(), max_batch=10).recover() == 0
+
+    assert replay.flush() == 2
+    assert _spooled(tmp_path) == []
+    replay.stop()
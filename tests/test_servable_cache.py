@@ -0,0 +1,102 @@
+import sys
+import json
+import time
+import types
+import threading
+
+import pytest
+
+from servable_cache import ServableCache
+
+
+@pytest.fixture
+def loads(monkeypatch):
+    """Stand in for home_run, recording each servable created and taking a while to do it"""
+    created = []
+    failures = set()
+
+    def create_servable(metadata):
+        servable_id = metadata['dlhub']['id']
+        created.append(servable_id)
+        time.sleep(0.3)
+        if servable_id in failures:
+            failures.discard(servable_id)
+            raise RuntimeError('load failed')
+        return types.SimpleNamespace(id=servable_id, run=lambda inputs, **kwargs: inputs)
+
+    monkeypatch.setitem(sys.modules, 'home_run', types.SimpleNamespace(create_servable=create_servable))
+    return created, failures
+
+
+@pytest.fixture
+def home(tmp_path):
+    for servable_id in ('a', 'b'):
+        path = tmp_path / 'servables' / servable_id
+        path.mkdir(parents=True)
+        (path / 'dlhub.json').write_text(json.dumps({'dlhub': {'id': servable_id}}))
+    return str(tmp_path)
+
+
+def _get_all(cache, servable_ids):
+    results = [None] * len(servable_ids)
+
+    def get(i):
+        try:
+            results[i] = cache.get(servable_ids[i])
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=get, args=(i,)) for i in range(len(servable_ids))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_hit_after_load(loads, home):
+    cache = ServableCache(home=home)
+    shim, metadata, load_ms = cache.get('a')
+    assert shim.id == 'a' and metadata['dlhub']['id'] == 'a' and load_ms > 0
+    assert cache.get('a') == (shim, metadata, 0)
+    assert cache.stats == {'hits': 1, 'loads': 1, 'evictions': 0}
+
+
+def test_concurrent_misses_load_once(loads, home):
+    created, _ = loads
+    cache = ServableCache(home=home)
+    results = _get_all(cache, ['a'] * 5)
+    assert created == ['a']
+    assert len({id(shim) for shim, _, _ in results}) == 1
+
+
+def test_different_servables_load_in_parallel(loads, home):
+    created, _ = loads
+    cache = ServableCache(home=home)
+    start = time.time()
+    _get_all(cache, ['a', 'b'])
+    assert sorted(created) == ['a', 'b']
+    # Each load takes 0.3s, so they did not wait for each other
+    assert time.time() - start < 0.5
+
+
+def test_failed_load_is_retried_by_a_waiter(loads, home):
+    created, failures = loads
+    failures.add('a')
+    cache = ServableCache(home=home)
+    results = _get_all(cache, ['a', 'a'])
+    assert created == ['a', 'a']
+    assert sum(isinstance(r, RuntimeError) for r in results) == 1
+    assert cache._loading == {}
+    assert cache.get('a')[2] == 0
+
+
+def test_evicts_least_recently_used(loads, home, monkeypatch):
+    import servable_cache
+    rss = iter(range(0, 1000, 50))
+    monkeypatch.setattr(servable_cache, '_rss_mb', lambda: next(rss))
+    cache = ServableCache(memory_budget_mb=60, home=home)
+    cache.get('a')
+    cache.get('b')
+    assert list(cache._shims) == ['b']
+    assert cache.stats['evictions'] == 1
@@ -0,0 +1,110 @@
+import os
+import time
+import urllib.parse
+
+import pytest
+
+import staged_data
+from staged_data import _check_url, stage_result, REF_KEY
+
+
+def _signed(url, expires_in=3600, signed=None):
+    signed = time.gmtime(signed if signed is not None else time.time())
+    query = urllib.parse.urlencode({'X-Amz-Date': time.strftime('%Y%m%dT%H%M%SZ', signed),
+                                    'X-Amz-Expires': expires_in, 'X-Amz-Signature': 'abc'})
+    return '{}?{}'.format(url, query)
+
+
+@pytest.mark.parametrize('url', [
+    'https://dlhub-anl.s3.amazonaws.com/run_inputs/x',
+    'https://dlhub-anl.s3.us-east-1.amazonaws.com/run_inputs/x',
+    'https://s3.amazonaws.com/dlhub-anl/run_inputs/x',
+    'https://s3-us-west-2.amazonaws.com/dlhub-anl/run_inputs/x',
+])
+def test_accepts_presigned_bucket_urls(url):
+    _check_url(_signed(url))
+
+
+@pytest.mark.parametrize('url', [
+    'http://dlhub-anl.s3.amazonaws.com/run_inputs/x',
+    'https://dlhub-anl.s3.amazonaws.com:8443/run_inputs/x',
+    'https://user@dlhub-anl.s3.amazonaws.com/run_inputs/x',
+    'https://other-bucket.s3.amazonaws.com/run_inputs/x',
+    'https://s3.amazonaws.com/other-bucket/dlhub-anl/x',
+    'https://dlhub-anl.s3.amazonaws.com.example.com/run_inputs/x',
+    'https://169.254.169.254/latest/meta-data/',
+])
+def test_refuses_urls_outside_the_bucket(url):
+    with pytest.raises(ValueError):
+        _check_url(_signed(url))
+
+
+def test_refuses_expired_and_unsigned_urls():
+    url = 'https://dlhub-anl.s3.amazonaws.com/run_inputs/x'
+    with pytest.raises(ValueError):
+        _check_url(_signed(url, expires_in=60, signed=time.time() - 120))
+    with pytest.raises(ValueError):
+        _check_url(url)
+
+
+def test_small_results_stay_inline(monkeypatch):
+    monkeypatch.setattr(staged_data, 'INLINE_RESULT_BYTES', 1024)
+    assert stage_result({'x': 'small'}, {'put_url': 'not checked', 'get_url': 'not checked'}) == {'x': 'small'}
+
+
+def test_large_results_are_uploaded(monkeypatch):
+    sent = []
+
+    class Response:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            pass
+
+        def read(self):
+            return b''
+
+    def open_url(req, timeout):
+        sent.append((req.get_method(), req.full_url, b''.join(bytes(c) for c in req.data)))
+        return Response()
+
+    monkeypatch.setattr(staged_data, 'INLINE_RESULT_BYTES', 1024)
+    monkeypatch.setattr(staged_data._opener, 'open', open_url)
+    upload = {'put_url': _signed('https://dlhub-anl.s3.amazonaws.com/run_results/x'),
+              'get_url': _signed('https://dlhub-anl.s3.amazonaws.com/run_results/x')}
+
+    ref = stage_result(b'x' * 4096, upload)
+
+    assert ref[REF_KEY] == upload['get_url']
+    assert [(method, url) for method, url, _ in sent] == [('PUT', upload['put_url'])]
+    assert len(sent[0][2]) == ref['size']
+
+
+def test_cache_is_only_listed_when_over_budget(tmp_path, monkeypatch):
+    monkeypatch.setattr(staged_data, 'CACHE_DIR', str(tmp_path))
+    monkeypatch.setattr(staged_data, 'CACHE_MB', 10 / 1024)
+    monkeypatch.setattr(staged_data, '_cache_used', None)
+    scans = []
+    scan = staged_data._scan_cache
+    monkeypatch.setattr(staged_data, '_scan_cache', lambda: scans.append(1) or scan())
+
+    for i in range(12):
+        path = tmp_path / str(i)
+        path.write_bytes(b'x' * 1024)
+        os.utime(str(path), (i, i))
+        staged_data._trim_cache(1024)
+
+    # Once when first used, then only when the running total passed the budget
+    assert len(scans) == 2
+    assert sorted(os.listdir(str(tmp_path)), key=int) == [str(i) for i in range(2, 12)]
+
+
+def test_run_signed_url_returns_a_result_upload(api):
+    res = api.get('/api/v1/run/signed_url', headers={'Authorization': 'Bearer user'})
+    assert res.status_code == 200
+    body = res.get_json()
+    assert body['reference'][REF_KEY].startswith('https://dlhub-anl.s3.amazonaws.com/run_inputs/')
+    upload = body['result_upload']
+    assert upload['put_url'] == upload['get_url']
+    assert '/run_results/' in upload['put_url']
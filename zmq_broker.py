@@ -1,40 +1,562 @@
+import os
+import sys
+import json
+import time
+import uuid
+import signal
+import logging
+import argparse
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 import zmq
 
+# Control messages exchanged between the broker and workers
+READY = b'READY'
+HEARTBEAT = b'HEARTBEAT'
+REQUEST = b'REQUEST'
+RESULT = b'RESULT'
+DISCONNECT = b'DISCONNECT'
+
+# Status frame leading every reply to a client
+OK = b'OK'
+ERROR = b'ERROR'
+
+
+class WorkerInfo:
+    """
+    State the broker keeps about a registered worker.
+    """
+
+    def __init__(self, identity, capacity, servables):
+        self.identity = identity
+        self.capacity = max(int(capacity), 1)
+        self.servables = set(servables)
+        self.in_flight = {}
+        self.last_seen = time.monotonic()
+
+    @property
+    def load(self):
+        return len(self.in_flight) / self.capacity
+
+    @property
+    def free(self):
+        return len(self.in_flight) < self.capacity
+
 
 class ZMQBroker:
     """
     A ZMQ broker. Once started this will pass requests through to clients.
 
+    Clients connect to the frontend (e.g. with a REQ socket) and send
+    ``[servable_id, payload...]``. Replies are ``[status, payload...]``,
+    where status is OK or ERROR, and an error's payload is its message.
+    Workers connect to the backend with a DEALER socket and register with
+    their capacity and the servables they have loaded. Each request goes to
+    the least-loaded worker that already has the servable warm, falling back
+    to the least-loaded worker overall. Workers that miss heartbeats are
+    dropped and their in-flight requests are answered with an error.
+
+    At most ``max_pending`` requests wait for a free worker. Requests beyond
+    that, and requests that wait longer than ``request_timeout`` seconds, are
+    answered with an error. Malformed messages from workers are dropped.
+
     This should go away once Parsl interchanges can replace it.
     """
 
-    def start(self, port=50000):
+    def __init__(self, heartbeat_interval=1.0, heartbeat_liveness=3, max_pending=10000, request_timeout=60):
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_liveness = heartbeat_liveness
+        self.max_pending = max_pending
+        self.request_timeout = request_timeout
+        self.workers = {}
+        self.pending = deque()
+        self.stats = {'requests': 0, 'results': 0, 'dead_workers': 0, 'rejected': 0, 'expired': 0, 'malformed': 0}
+        self._frontend = None
+        self._backend = None
+        self._running = False
+        self._request_count = 0
+
+    def start(self, port=50000, backend_port=50001, frontend_addr=None, backend_addr=None, health_addr=None):
         """
         Start the broker
 
+        :param port: TCP port clients connect to
+        :param backend_port: TCP port workers connect to
+        :param frontend_addr: full address to bind for clients, overrides port
+        :param backend_addr: full address to bind for workers, overrides backend_port
+        :param health_addr: address to answer health probes on, disabled if None
         :return:
         """
 
         # Prepare our context and sockets
-        context = zmq.Context()
-        frontend = context.socket(zmq.ROUTER)
-        backend = context.socket(zmq.DEALER)
-        frontend.bind("tcp://*:%s" % port)
-        backend.bind("tcp://*:50001")
+        context = zmq.Context.instance()
+        self._frontend = context.socket(zmq.ROUTER)
+        self._backend = context.socket(zmq.ROUTER)
+        self._frontend.bind(frontend_addr or "tcp://*:%s" % port)
+        self._backend.bind(backend_addr or "tcp://*:%s" % backend_port)
 
         # Initialize poll set
         poller = zmq.Poller()
-        poller.register(frontend, zmq.POLLIN)
-        poller.register(backend, zmq.POLLIN)
+        poller.register(self._frontend, zmq.POLLIN)
+        poller.register(self._backend, zmq.POLLIN)
+        health = None
+        if health_addr:
+            health = context.socket(zmq.REP)
+            health.bind(health_addr)
+            poller.register(health, zmq.POLLIN)
 
         # Switch messages between sockets
+        self._running = True
+        next_heartbeat = time.monotonic() + self.heartbeat_interval
+        try:
+            while self._running:
+                timeout = max(next_heartbeat - time.monotonic(), 0) * 1000
+                socks = dict(poller.poll(timeout))
+
+                if socks.get(self._backend) == zmq.POLLIN:
+                    self._handle_backend(self._backend.recv_multipart(copy=False))
+
+                if socks.get(self._frontend) == zmq.POLLIN:
+                    self._handle_frontend(self._frontend.recv_multipart(copy=False))
+
+                if health is not None and socks.get(health) == zmq.POLLIN:
+                    health.recv()
+                    health.send_json(self.health())
+
+                now = time.monotonic()
+                if now >= next_heartbeat:
+                    self._send_heartbeats()
+                    self._purge_workers(now)
+                    self._expire_pending(now)
+                    next_heartbeat = now + self.heartbeat_interval
+        finally:
+            self._frontend.close(linger=0)
+            self._backend.close(linger=0)
+            if health is not None:
+                health.close(linger=0)
+
+    def stop(self):
+        """Stop the broker loop after the current iteration"""
+        self._running = False
+
+    def health(self):
+        """
+        Summarize the broker state for health probes
+
+        :return: dict of worker, queue and request counts
+        """
+        res = dict(self.stats)
+        res['workers'] = len(self.workers)
+        res['capacity'] = sum(w.capacity for w in self.workers.values())
+        res['in_flight'] = sum(len(w.in_flight) for w in self.workers.values())
+        res['pending'] = len(self.pending)
+        return res
+
+    def _handle_frontend(self, frames):
+        """
+        Queue a client request and dispatch it if a worker is free.
+
+        Frames are ``[envelope..., b'', servable_id, payload...]``. The
+        envelope is the client identity, plus any request id a DEALER client
+        adds, and is returned unchanged with the reply.
+        """
+        split = next((i for i, f in enumerate(frames) if not f.bytes), None)
+        if split is None or split + 1 >= len(frames):
+            return
+        envelope = [f.bytes for f in frames[:split + 1]]
+        servable = frames[split + 1].bytes
+        self.stats['requests'] += 1
+        if len(self.pending) >= self.max_pending:
+            self.stats['rejected'] += 1
+            self._reply(envelope, ERROR, [b'Broker queue is full'])
+            return
+        self.pending.append((envelope, servable, frames[split + 2:], time.monotonic()))
+        self._dispatch()
+
+    def _reply(self, envelope, status, frames):
+        self._frontend.send_multipart(envelope + [status] + list(frames), copy=False)
+
+    def _handle_backend(self, frames):
+        """Process a registration, heartbeat, result or disconnect from a worker"""
+        try:
+            self._handle_worker_message(frames)
+        except (IndexError, ValueError, UnicodeDecodeError) as e:
+            self.stats['malformed'] += 1
+            logging.warning("Dropped malformed message from worker {}: {}".format(frames[0].bytes.hex(), e))
+
+    def _handle_worker_message(self, frames):
+        if len(frames) < 2:
+            raise ValueError("no command frame")
+        identity = frames[0].bytes
+        command = frames[1].bytes
+        worker = self.workers.get(identity)
+
+        if command == READY:
+            capacity = int(frames[2].bytes) if len(frames) > 2 else 1
+            servables = json.loads(frames[3].bytes) if len(frames) > 3 else []
+            if not isinstance(servables, list):
+                raise ValueError("servables must be a list")
+            self.workers[identity] = WorkerInfo(identity, capacity, servables)
+            if worker is not None:
+                # Re-registration keeps track of requests the worker is still running
+                self.workers[identity].in_flight = worker.in_flight
+            self._dispatch()
+            return
+
+        if worker is None:
+            # Unknown worker, ask it to register again
+            self._backend.send_multipart([identity, DISCONNECT])
+            return
+        worker.last_seen = time.monotonic()
+
+        if command == RESULT:
+            request_id, status = frames[2].bytes, frames[3].bytes
+            if status not in (OK, ERROR):
+                raise ValueError("unknown status {!r}".format(status))
+            envelope = worker.in_flight.pop(request_id, None)
+            if envelope is not None:
+                self.stats['results'] += 1
+                self._reply(envelope, status, frames[4:])
+            self._dispatch()
+        elif command == HEARTBEAT:
+            if len(frames) > 2:
+                servables = json.loads(frames[2].bytes)
+                if not isinstance(servables, list):
+                    raise ValueError("servables must be a list")
+                worker.servables = set(servables)
+        elif command == DISCONNECT:
+            self._remove_worker(identity)
+        else:
+            raise ValueError("unknown command {!r}".format(command))
+
+    def _select_worker(self, servable):
+        """
+        Pick the least-loaded free worker, preferring ones with the servable warm.
+
+        :return: WorkerInfo or None if every worker is busy
+        """
+        best = None
+        for worker in self.workers.values():
+            if not worker.free:
+                continue
+            key = (servable.decode() not in worker.servables, worker.load)
+            if best is None or key < best[0]:
+                best = (key, worker)
+        return best[1] if best else None
+
+    def _dispatch(self):
+        """Send pending requests to workers while there is capacity"""
+        while self.pending:
+            envelope, servable, payload, _ = self.pending[0]
+            worker = self._select_worker(servable)
+            if worker is None:
+                return
+            self.pending.popleft()
+
+            self._request_count += 1
+            request_id = b'%d' % self._request_count
+            worker.in_flight[request_id] = envelope
+            worker.servables.add(servable.decode())
+            self._backend.send_multipart([worker.identity, REQUEST, request_id, servable] + payload, copy=False)
+
+    def _expire_pending(self, now):
+        """Fail requests that have waited too long for a worker"""
+        while self.pending and now - self.pending[0][3] > self.request_timeout:
+            envelope = self.pending.popleft()[0]
+            self.stats['expired'] += 1
+            self._reply(envelope, ERROR, [b'Timed out waiting for a worker'])
+
+    def _send_heartbeats(self):
+        for identity in self.workers:
+            self._backend.send_multipart([identity, HEARTBEAT])
+
+    def _purge_workers(self, now):
+        """Drop workers that have not been heard from within the liveness window"""
+        expiry = self.heartbeat_interval * self.heartbeat_liveness
+        for identity in [i for i, w in self.workers.items() if now - w.last_seen > expiry]:
+            self.stats['dead_workers'] += 1
+            self._remove_worker(identity)
+
+    def _remove_worker(self, identity):
+        """Forget a worker and fail any requests it was still running"""
+        worker = self.workers.pop(identity, None)
+        if worker is None:
+            return
+        for envelope in worker.in_flight.values():
+            self._reply(envelope, ERROR, [b'Worker lost before returning a result'])
+
+
+class ZMQWorker:
+    """
+    A worker that registers with the broker and serves requests.
+
+    The handler is called as ``handler(servable_id, payload_frames)`` and
+    must return a list of frames to send back to the client. If it raises,
+    the client gets an ERROR reply with the exception message. Up to
+    ``capacity`` requests are handled at once, on threads of their own, so
+    heartbeats keep flowing while a slow request runs.
+    """
+
+    def __init__(self, handler, address="tcp://localhost:50001", capacity=1, servables=None,
+                 heartbeat_interval=1.0):
+        self.handler = handler
+        self.address = address
+        self.capacity = capacity
+        self.servables = set(servables or [])
+        self.heartbeat_interval = heartbeat_interval
+        self._running = False
+        self._results_addr = "inproc://dlhub-worker-results-{}".format(uuid.uuid4().hex)
+        self._local = threading.local()
+
+    def start(self):
+        """Connect to the broker and serve requests until stopped"""
+        context = zmq.Context.instance()
+        socket = context.socket(zmq.DEALER)
+        socket.connect(self.address)
+        # Handler threads pass their results back to this thread, which owns the broker socket
+        results = context.socket(zmq.PULL)
+        results.bind(self._results_addr)
+        poller = zmq.Poller()
+        poller.register(socket, zmq.POLLIN)
+        poller.register(results, zmq.POLLIN)
+        pool = ThreadPoolExecutor(max_workers=self.capacity, thread_name_prefix='dlhub_handler')
+        self._register(socket)
+
+        self._running = True
+        next_heartbeat = time.monotonic() + self.heartbeat_interval
+        try:
+            while self._running:
+                timeout = max(next_heartbeat - time.monotonic(), 0) * 1000
+                socks = dict(poller.poll(timeout))
+                if socks.get(socket) == zmq.POLLIN:
+                    frames = socket.recv_multipart(copy=False)
+                    command = frames[0].bytes
+                    if command == REQUEST and len(frames) >= 3:
+                        pool.submit(self._handle, frames[1].bytes, frames[2].bytes, frames[3:])
+                    elif command == DISCONNECT:
+                        self._register(socket)
+                if socks.get(results) == zmq.POLLIN:
+                    request_id, servable, *reply = results.recv_multipart(copy=False)
+                    self.servables.add(servable.bytes.decode())
+                    socket.send_multipart([RESULT, request_id] + reply, copy=False)
+                if time.monotonic() >= next_heartbeat:
+                    socket.send_multipart([HEARTBEAT, json.dumps(sorted(self.servables)).encode()])
+                    next_heartbeat = time.monotonic() + self.heartbeat_interval
+            socket.send_multipart([DISCONNECT])
+        finally:
+            pool.shutdown(wait=False)
+            socket.close(linger=100)
+            results.close(linger=0)
+
+    def stop(self):
+        """Stop serving. Requests still running are abandoned and the broker fails them"""
+        self._running = False
+
+    def _handle(self, request_id, servable, payload):
+        """Run the handler on a pool thread and pass the reply to the broker thread"""
+        try:
+            reply = [OK] + list(self.handler(servable.decode(), payload))
+        except Exception as e:
+            logging.exception("Handler failed for {}".format(servable))
+            reply = [ERROR, str(e).encode()]
+        push = getattr(self._local, 'push', None)
+        if push is None:
+            push = self._local.push = zmq.Context.instance().socket(zmq.PUSH)
+            push.setsockopt(zmq.LINGER, 0)
+            push.connect(self._results_addr)
+        push.send_multipart([request_id, servable] + reply, copy=False)
+
+    def _register(self, socket):
+        socket.send_multipart([READY, str(self.capacity).encode(),
+                               json.dumps(sorted(self.servables)).encode()])
+
+
+class BrokerClient:
+    """
+    Hand requests to the host's broker without blocking the web worker.
+
+    A background thread in each process owns the DEALER socket connected to
+    the broker, so the client can be created before gunicorn forks.
+    ``submit`` passes the request to that thread and returns straight away.
+    The thread calls ``on_reply(request_id, status, frames)`` with each
+    reply, and with an ERROR reply for requests the broker has not answered
+    within ``timeout`` seconds.
+    """
+
+    def __init__(self, address, on_reply, timeout=900, max_outstanding=1000):
+        self.address = address
+        self.on_reply = on_reply
+        self.timeout = timeout
+        self.max_outstanding = max_outstanding
+        self._pid = None
+        self._local = None
+        self._requests_addr = None
+        self._lock = threading.Lock()
+
+    def submit(self, servable, frames, request_id=None):
+        """
+        Queue a request for a servable.
+
+        :param servable: id of the servable to run
+        :param frames: list of payload frames
+        :param request_id: bytes identifying the request in on_reply, a random id if None
+        :return: the request id
+        :raises zmq.Again: if too many requests are waiting to be sent
+        """
+        self._ensure_started()
+        request_id = request_id or uuid.uuid4().bytes
+        push = getattr(self._local, 'push', None)
+        if push is None:
+            push = self._local.push = zmq.Context.instance().socket(zmq.PUSH)
+            push.setsockopt(zmq.SNDHWM, self.max_outstanding)
+            push.setsockopt(zmq.LINGER, 0)
+            push.connect(self._requests_addr)
+        push.send_multipart([request_id, servable.encode()] + list(frames), flags=zmq.NOBLOCK, copy=False)
+        return request_id
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # Sockets and threads do not survive a fork, so each process starts its own
+            self._pid = os.getpid()
+            self._local = threading.local()
+            self._requests_addr = "inproc://dlhub-client-requests-{}".format(uuid.uuid4().hex)
+            started = threading.Event()
+            threading.Thread(target=self._loop, args=(started,), name='dlhub_broker_client', daemon=True).start()
+            started.wait()
+
+    def _loop(self, started):
+        """Forward requests to the broker and hand its replies to on_reply"""
+        context = zmq.Context.instance()
+        requests = context.socket(zmq.PULL)
+        requests.bind(self._requests_addr)
+        socket = context.socket(zmq.DEALER)
+        socket.setsockopt(zmq.SNDHWM, self.max_outstanding)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(self.address)
+        poller = zmq.Poller()
+        poller.register(requests, zmq.POLLIN)
+        poller.register(socket, zmq.POLLIN)
+        started.set()
+
+        deadlines = {}
         while True:
-            socks = dict(poller.poll())
+            socks = dict(poller.poll(1000))
+            if socks.get(requests) == zmq.POLLIN:
+                request_id, servable, *payload = requests.recv_multipart(copy=False)
+                request_id = request_id.bytes
+                try:
+                    socket.send_multipart([request_id, b'', servable] + payload, flags=zmq.NOBLOCK, copy=False)
+                    deadlines[request_id] = time.monotonic() + self.timeout
+                except zmq.Again:
+                    self._reply(request_id, ERROR, [b'Broker is not accepting requests'])
+            if socks.get(socket) == zmq.POLLIN:
+                frames = socket.recv_multipart()
+                if len(frames) >= 3 and deadlines.pop(frames[0], None) is not None:
+                    self._reply(frames[0], frames[2], frames[3:])
+            now = time.monotonic()
+            for request_id in [r for r, deadline in deadlines.items() if deadline <= now]:
+                del deadlines[request_id]
+                self._reply(request_id, ERROR, [b'No reply from broker'])
+
+    def _reply(self, request_id, status, frames):
+        try:
+            self.on_reply(request_id, status, frames)
+        except Exception:
+            logging.exception("Reply handler failed for request {!r}".format(request_id))
+
+
+def probe_health(address, timeout=1.0):
+    """
+    Ask a broker for its health summary.
+
+    :param address: health address of the broker
+    :param timeout: seconds to wait for a reply
+    :return: dict of broker statistics, or None if it did not answer
+    """
+    socket = zmq.Context.instance().socket(zmq.REQ)
+    socket.setsockopt(zmq.LINGER, 0)
+    socket.connect(address)
+    try:
+        socket.send(b'PING')
+        if socket.poll(timeout * 1000):
+            return socket.recv_json()
+        return None
+    finally:
+        socket.close()
+
+
+def _run_broker(frontend_addr, backend_addr, health_addr):
+    # The forked child inherits the supervisor's handler, which would ignore terminate()
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    ZMQBroker().start(frontend_addr=frontend_addr, backend_addr=backend_addr, health_addr=health_addr)
+
+
+def supervise(frontend_addr, backend_addr, health_addr, probe_interval=5.0, max_failures=3, max_backoff=30):
+    """
+    Run the broker in a child process and restart it when it dies or stops answering health probes.
+
+    :param frontend_addr: address web workers connect to
+    :param backend_addr: address compute workers connect to
+    :param health_addr: address the broker answers health probes on
+    :param probe_interval: seconds between health probes
+    :param max_failures: consecutive failed probes before the broker is restarted
+    :param max_backoff: maximum seconds to wait between restarts
+    """
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda *args: stopping.append(True))
+    backoff = 1
+
+    while not stopping:
+        process = multiprocessing.Process(target=_run_broker, name='dlhub_broker',
+                                          args=(frontend_addr, backend_addr, health_addr))
+        process.start()
+        logging.info("Started broker process {}".format(process.pid))
+        started = time.monotonic()
+        failures = 0
+
+        while not stopping and process.is_alive():
+            time.sleep(probe_interval)
+            if probe_health(health_addr) is None:
+                failures += 1
+                logging.warning("Broker health probe failed ({}/{})".format(failures, max_failures))
+                if failures >= max_failures:
+                    break
+            else:
+                failures = 0
+
+        if process.is_alive():
+            process.terminate()
+        process.join(10)
+        if process.is_alive():
+            process.kill()
+            process.join()
+        if stopping:
+            break
+
+        # Back off if the broker keeps dying straight after starting
+        backoff = 1 if time.monotonic() - started > max_backoff else min(backoff * 2, max_backoff)
+        logging.error("Broker exited with code {}, restarting in {}s".format(process.exitcode, backoff))
+        time.sleep(backoff)
+
+
+if __name__ == "__main__":
+    from config import BROKER_FRONTEND, BROKER_BACKEND, BROKER_HEALTH
 
-            if socks.get(frontend) == zmq.POLLIN:
-                message = frontend.recv_multipart()
-                backend.send_multipart(message)
+    parser = argparse.ArgumentParser(description="Run the DLHub ZMQ broker under a supervisor")
+    parser.add_argument('--frontend', default=BROKER_FRONTEND, help='Address for web workers')
+    parser.add_argument('--backend', default=BROKER_BACKEND, help='Address for compute workers')
+    parser.add_argument('--health', default=BROKER_HEALTH, help='Address for health probes')
+    parser.add_argument('--probe', action='store_true', help='Probe a running broker and exit')
+    args = parser.parse_args()
 
-            if socks.get(backend) == zmq.POLLIN:
-                message = backend.recv_multipart()
-                frontend.send_multipart(message)
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+    if args.probe:
+        status = probe_health(args.health)
+        print(json.dumps(status))
+        sys.exit(0 if status is not None else 1)
+    supervise(args.frontend, args.backend, args.health)